@@ -3,77 +3,112 @@ import os
 import sys
 import json
 import subprocess
+import tempfile
+from functools import partial
+import SimpleITK as sitk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Quantitative Evaluation using Dice Score"))
+from series_index import ct_folders_by_uid, load_series_index
+# Consensus files in the formats written by analyze_disagreement_dice_score.py (--consensus-format)
+from consensus_io import consensus_structure_name, read_bitpacked
+
+def load_consensus_mask(consensus_file):
+    # Consensus mask in any of the consensus_io.CONSENSUS_SUFFIXES formats as SimpleITK image
+    if consensus_file.endswith(".npz"):
+        return read_bitpacked(consensus_file)
+    return sitk.ReadImage(consensus_file)
+
+def as_nifti(consensus_file, temp_dir):
+    # itkimage2segimage reads NIfTI only, so bit-packed masks are decoded to a temporary uncompressed NIfTI
+    if not consensus_file.endswith(".npz"):
+        return consensus_file
+    nifti_file = os.path.join(temp_dir, os.path.basename(consensus_file).replace(".npz", ".nii"))
+    sitk.WriteImage(read_bitpacked(consensus_file), nifti_file, useCompression=False)
+    return nifti_file
 
 def find_nifti_files(base_dir):
     nifti_data = []
     for root, _, files in os.walk(base_dir):
-        nii_files = [os.path.join(root, f) for f in files if f.endswith(".nii.gz")]
+        nii_files = [os.path.join(root, f) for f in files if consensus_structure_name(f) is not None]
         if nii_files:
             nifti_data.append((root, nii_files))
     return nifti_data
 
-def find_matching_dicom_folder(nifti_folder, dicom_base_dir):
-    ct_id = os.path.basename(nifti_folder).split("_")[-1] 
-    for root, _, _ in os.walk(dicom_base_dir):
-        if ct_id in root:
-            return root
-    return None
-
-def create_output_folder_structure(nifti_folder, base_dir, output_base):
-    relative_path = os.path.relpath(nifti_folder, base_dir)
-    output_folder = os.path.join(output_base, relative_path)
-    os.makedirs(output_folder, exist_ok=True)
-    return output_folder
-
-def convert_nifti_to_dicom(nifti_base_dir, output_base_dir, dicom_base_dir, itkimage2segimage_path):
-    nifti_data = find_nifti_files(nifti_base_dir)
-
-    if not nifti_data:
-        print("No NIfTI files found. Please check the directory structure.")
-        return
-
-    for folder, nii_files in nifti_data:
-        print(f"\nProcessing NIfTI files in: {folder}")
-
-        json_file = os.path.join(folder, "Overlap-dcmqi_seg_dict.json")
+def find_matching_dicom_folder(nifti_folder, dicom_folders):
+    # `dicom_folders` maps SeriesInstanceUIDs to CT folders (series_index.ct_folders_by_uid)
+    ct_id = os.path.basename(nifti_folder).split("_")[-1]
+    return dicom_folders.get(ct_id)
+
+def write_native_seg(json_data, expected_structures, nifti_mapping, dicom_ct_folder, output_dicom):
+    # Write the SEG in-process (dicom_seg_writer.py): each mask is read once, straight into the bit-packed frames
+    from dicom_seg_writer import read_ct_series, write_segmentation
+
+    segments = [
+        (segment[0], partial(load_consensus_mask, nifti_mapping[structure]))
+        for segment, structure in zip(json_data["segmentAttributes"], expected_structures)
+        if structure in nifti_mapping
+    ]
+    return write_segmentation(segments, json_data, read_ct_series(dicom_ct_folder), output_dicom)
+
+def convert_consensus_folder(folder, nii_files, dicom_ct_folder, output_dicom, itkimage2segimage_path=None, json_data=None):
+    """
+    Convert the consensus masks of one CT series (`nii_files` in `folder`) into the DICOM SEG `output_dicom`.
+
+    The segment metadata is read from `<folder>/Consensus-dcmqi_seg_dict.json`, written by
+    convert_csv_to_json_for_consensus.py, unless it is passed as `json_data`. Returns True if the
+    SEG file was written.
+    """
+    from convert_csv_to_json_for_consensus import algorithm
+
+    if json_data is None:
+        json_file = os.path.join(folder, f"{algorithm}-dcmqi_seg_dict.json")
         if not os.path.exists(json_file):
             print(f"Missing JSON metadata in {folder}, skipping...")
-            continue
+            return False
 
         with open(json_file, "r") as f:
             json_data = json.load(f)
 
-        expected_structures = [segment[0]["SegmentLabel"].lower() for segment in json_data["segmentAttributes"]]
+    expected_structures = [segment[0]["SegmentLabel"].lower() for segment in json_data["segmentAttributes"]]
 
-        nifti_mapping = {os.path.basename(f).replace("_overlap.nii.gz", "").lower(): f for f in nii_files}
+    nifti_mapping = {consensus_structure_name(os.path.basename(f)).lower(): f for f in nii_files}
 
-        missing_files = [structure for structure in expected_structures if structure not in nifti_mapping]
-        if missing_files:
-            print(f"Missing NIfTI files for expected structures: {missing_files}")
+    missing_files = [structure for structure in expected_structures if structure not in nifti_mapping]
+    if missing_files:
+        print(f"Missing NIfTI files for expected structures: {missing_files}")
 
-        sorted_nifti_files = [nifti_mapping[structure] for structure in expected_structures if structure in nifti_mapping]
+    sorted_nifti_files = [nifti_mapping[structure] for structure in expected_structures if structure in nifti_mapping]
 
-        print(f"Number of matched and sorted NIfTI files: {len(sorted_nifti_files)}")
+    print(f"Number of matched and sorted NIfTI files: {len(sorted_nifti_files)}")
 
-        if not sorted_nifti_files:
-            print(f"No matching NIfTI files found for {folder}, skipping...")
-            continue
+    if not sorted_nifti_files:
+        print(f"No matching NIfTI files found for {folder}, skipping...")
+        return False
 
-        output_folder = create_output_folder_structure(folder, nifti_base_dir, output_base_dir)
-        dicom_ct_folder = find_matching_dicom_folder(folder, dicom_base_dir)
+    os.makedirs(os.path.dirname(output_dicom), exist_ok=True)
 
-        if not dicom_ct_folder:
-            print(f"No matching DICOM folder found for {folder}, skipping...")
-            continue
+    print(f"Converting NIfTI → DICOM SEG for folder: {folder}")
 
-        output_dicom = os.path.join(output_folder, "SEG_Consensus.dcm")
+    if not itkimage2segimage_path:
+        try:
+            num_frames = write_native_seg(json_data, expected_structures, nifti_mapping, dicom_ct_folder, output_dicom)
+            if num_frames:
+                print(f"SEG DICOM saved at: {output_dicom} ({num_frames} frames)")
+            return bool(num_frames)
+        except Exception as e:
+            print(f"Conversion failed for {folder}: {e}")
+            return False
 
-        print(f"Converting NIfTI → DICOM SEG for folder: {folder}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        metadata_file = os.path.join(temp_dir, f"{algorithm}-dcmqi_seg_dict.json")
+        with open(metadata_file, "w") as f:
+            json.dump(json_data, f)
 
         command = [
             itkimage2segimage_path,
-            "--inputImageList", ",".join(sorted_nifti_files),
-            "--inputMetadata", json_file,
+            "--inputImageList", ",".join(as_nifti(f, temp_dir) for f in sorted_nifti_files),
+            "--inputMetadata", metadata_file,
             "--inputDICOMDirectory", dicom_ct_folder,
             "--outputDICOM", output_dicom,
             "--verbose"
@@ -82,20 +117,51 @@ def convert_nifti_to_dicom(nifti_base_dir, output_base_dir, dicom_base_dir, itki
         try:
             subprocess.run(command, check=True)
             print(f"SEG DICOM saved at: {output_dicom}")
+            return True
         except subprocess.CalledProcessError as e:
             print(f"Conversion failed for {folder}: {e}")
+            return False
 
-    print("Conversion finished successfully!")
+def convert_nifti_to_dicom(nifti_base_dir, output_base_dir, dicom_base_dir, itkimage2segimage_path=None):
+    """
+    Convert the consensus masks of every CT series below `nifti_base_dir` into one DICOM SEG per series.
 
+    The SEG files are written in-process by dicom_seg_writer.py. If `itkimage2segimage_path` is
+    given, dcmqi's itkimage2segimage is called instead. The series index of `dicom_base_dir` is
+    stored in `output_base_dir`.
+    """
+    nifti_data = find_nifti_files(nifti_base_dir)
+
+    if not nifti_data:
+        print("No NIfTI files found. Please check the directory structure.")
+        return
+
+    dicom_folders = ct_folders_by_uid(load_series_index(dicom_base_dir, index_dir=output_base_dir))
+
+    for folder, nii_files in nifti_data:
+        print(f"\nProcessing NIfTI files in: {folder}")
+
+        dicom_ct_folder = find_matching_dicom_folder(folder, dicom_folders)
+
+        if not dicom_ct_folder:
+            print(f"No matching DICOM folder found for {folder}, skipping...")
+            continue
+
+        output_folder = os.path.join(output_base_dir, os.path.relpath(folder, nifti_base_dir))
+        output_dicom = os.path.join(output_folder, "SEG_Consensus.dcm")
+
+        convert_consensus_folder(folder, nii_files, dicom_ct_folder, output_dicom, itkimage2segimage_path)
+
+    print("Conversion finished successfully!")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 5:
-        print("Usage: python script.py <nifti_base_dir> <output_base_dir> <dicom_base_dir> <itkimage2segimage_path>")
+    if len(sys.argv) not in (4, 5):
+        print("Usage: python script.py <nifti_base_dir> <output_base_dir> <dicom_base_dir> [<itkimage2segimage_path>]")
         sys.exit(1)
 
     nifti_base_dir = sys.argv[1]
     output_base_dir = sys.argv[2]
     dicom_base_dir = sys.argv[3]
-    itkimage2segimage_path = sys.argv[4]
+    itkimage2segimage_path = sys.argv[4] if len(sys.argv) == 5 else None
 
     convert_nifti_to_dicom(nifti_base_dir, output_base_dir, dicom_base_dir, itkimage2segimage_path)
\ No newline at end of file
@@ -5,14 +5,8 @@ import pandas as pd
 import re
 import sys
 
-def process_csv_to_json(csv_path, algorithm, overview_csv):
-    
-    df = pd.read_csv(csv_path, delimiter=",")   
-    df_overview = pd.read_csv(overview_csv, delimiter=",") 
-    print(df_overview.columns)
-    print(f"Processing CSV: {csv_path}")
-    print(df.columns)
-
+def consensus_seg_dict(df, df_overview):
+    # dcmqi segmentation dictionary of the structures in `df` (a filtered_structures.csv table)
     dcmqi_seg_dict = {
         "ContentCreatorName": "IDC",
         "ClinicalTrialSeriesID": "Session1",
@@ -58,7 +52,9 @@ def process_csv_to_json(csv_path, algorithm, overview_csv):
 
         dcmqi_seg_dict["segmentAttributes"].append([segment_attributes])
 
-    output_folder = os.path.dirname(csv_path)
+    return dcmqi_seg_dict
+
+def write_seg_dict(dcmqi_seg_dict, output_folder, algorithm):
     json_filename = f"{algorithm}-dcmqi_seg_dict.json"
     output_path = os.path.join(output_folder, json_filename)
 
@@ -66,6 +62,17 @@ def process_csv_to_json(csv_path, algorithm, overview_csv):
         json.dump(dcmqi_seg_dict, outfile, indent=2)
 
     print(f"JSON saved to: {output_path}")
+    return output_path
+
+def process_csv_to_json(csv_path, algorithm, overview_csv):
+    
+    df = pd.read_csv(csv_path, delimiter=",")   
+    df_overview = pd.read_csv(overview_csv, delimiter=",") 
+    print(df_overview.columns)
+    print(f"Processing CSV: {csv_path}")
+    print(df.columns)
+
+    write_seg_dict(consensus_seg_dict(df, df_overview), os.path.dirname(csv_path), algorithm)
 
 def process_all_csv_in_folders(base_folder, algorithm, overview_csv):
     for root, _, files in os.walk(base_folder):
@@ -76,11 +83,12 @@ def process_all_csv_in_folders(base_folder, algorithm, overview_csv):
 
 algorithm = "Consensus"
 
-if len(sys.argv) != 3:
-    print("Usage: python script.py <base_folder> <overview_csv>")
-    sys.exit(1)
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python script.py <base_folder> <overview_csv>")
+        sys.exit(1)
 
-base_folder = sys.argv[1]
-overview_csv = sys.argv[2]
+    base_folder = sys.argv[1]
+    overview_csv = sys.argv[2]
 
-process_all_csv_in_folders(base_folder, algorithm, overview_csv)
\ No newline at end of file
+    process_all_csv_in_folders(base_folder, algorithm, overview_csv)
\ No newline at end of file
@@ -4,36 +4,44 @@ import os
 import sys
 import pandas as pd
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Quantitative Evaluation using Dice Score"))
+from consensus_io import consensus_structure_name
+
 def find_existing_structures(folder):
 
     existing_structures = set()
     for file in os.listdir(folder):
-        if file.endswith("_overlap.nii.gz"):
-            structure_name = file.replace("_overlap.nii.gz", "")
+        # Consensus masks in any of the formats written with --consensus-format
+        structure_name = consensus_structure_name(file)
+        if structure_name is not None:
             existing_structures.add(structure_name)
     return existing_structures
 
+def filter_structures(df, folder):
+    # Rows of the structure table with a consensus mask in `folder`, or None if the folder has none
+    existing_structures = find_existing_structures(folder)
+    if not existing_structures:
+        return None
+    df_filtered = df[df['label_name'].str.lower().isin(existing_structures)]
+    output_csv_path = os.path.join(folder, "filtered_structures.csv")
+    df_filtered.to_csv(output_csv_path, index=False)
+    print(f"Filtered CSV saved to: {output_csv_path}")
+    return df_filtered
+
 def filter_csv_for_each_folder(base_folder, csv_file):
     
     df = pd.read_csv(csv_file)
     
     for root, dirs, _ in os.walk(base_folder):
         for folder in dirs:
-            folder_path = os.path.join(root, folder)
-            existing_structures = find_existing_structures(folder_path)
-            print(existing_structures)
-            if existing_structures:
-                df_filtered = df[df['label_name'].str.lower().isin(existing_structures)]
-                print(df['label_name'])
-                output_csv_path = os.path.join(folder_path, "filtered_structures.csv")
-                df_filtered.to_csv(output_csv_path, index=False)
-                print(f"Filtered CSV saved to: {output_csv_path}")
-
-if len(sys.argv) != 3:
-    print("Usage: python script.py <base_folder> <csv_file>")
-    sys.exit(1)
-
-base_folder = sys.argv[1]
-csv_file = sys.argv[2]
-
-filter_csv_for_each_folder(base_folder, csv_file)
\ No newline at end of file
+            filter_structures(df, os.path.join(root, folder))
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python script.py <base_folder> <csv_file>")
+        sys.exit(1)
+
+    base_folder = sys.argv[1]
+    csv_file = sys.argv[2]
+
+    filter_csv_for_each_folder(base_folder, csv_file)
\ No newline at end of file
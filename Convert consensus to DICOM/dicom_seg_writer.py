@@ -0,0 +1,326 @@
+# In-process writing of binary DICOM SEG files from in-memory masks and dcmqi segment metadata
+import os
+from datetime import datetime
+
+import numpy as np
+import pydicom
+import SimpleITK as sitk
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.errors import InvalidDicomError
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+
+SEGMENTATION_STORAGE = "1.2.840.10008.5.1.4.1.1.66.4"
+
+# Attributes of the referenced CT that are copied into the SEG (patient, study, frame of reference, equipment)
+COPIED_CT_ATTRIBUTES = (
+    "PatientName", "PatientID", "PatientBirthDate", "PatientSex", "PatientAge",
+    "StudyInstanceUID", "StudyDate", "StudyTime", "StudyID", "AccessionNumber",
+    "ReferringPhysicianName", "StudyDescription",
+    "FrameOfReferenceUID", "PositionReferenceIndicator",
+)
+
+
+def read_ct_series(dicom_folder):
+    """
+    Read the headers of the slices of a CT series and derive its volume grid.
+
+    Only the headers are read (no pixel data). Files that are not DICOM images are ignored.
+
+    Returns:
+        A dictionary with the slice headers sorted along the slice normal and the grid in
+        SimpleITK conventions: origin, spacing, direction and size (columns, rows, slices).
+    """
+    slices = []
+    for file_name in sorted(os.listdir(dicom_folder)):
+        try:
+            ds = pydicom.dcmread(os.path.join(dicom_folder, file_name), stop_before_pixels=True)
+        except (InvalidDicomError, IsADirectoryError, PermissionError):
+            continue
+        if "ImagePositionPatient" in ds and "ImageOrientationPatient" in ds:
+            slices.append(ds)
+    if not slices:
+        raise ValueError(f"No CT slices found in {dicom_folder}")
+
+    orientation = np.array(slices[0].ImageOrientationPatient, dtype=float)
+    row_direction, column_direction = orientation[:3], orientation[3:]
+    normal = np.cross(row_direction, column_direction)
+    slices.sort(key=lambda ds: float(np.dot(np.array(ds.ImagePositionPatient, dtype=float), normal)))
+
+    positions = np.array([ds.ImagePositionPatient for ds in slices], dtype=float)
+    projections = positions @ normal
+    if len(slices) > 1:
+        slice_spacing = float(np.median(np.diff(projections)))
+    else:
+        slice_spacing = float(slices[0].get("SliceThickness") or 1.0)
+    row_spacing, column_spacing = (float(v) for v in slices[0].PixelSpacing)
+
+    return {
+        "datasets": slices,
+        "origin": tuple(positions[0]),
+        "spacing": (column_spacing, row_spacing, slice_spacing),
+        "direction": tuple(np.column_stack([row_direction, column_direction, normal]).ravel()),
+        "size": (int(slices[0].Columns), int(slices[0].Rows), len(slices)),
+    }
+
+
+def mask_on_ct_grid(mask, ct_series, tolerance=1e-4):
+    """
+    Return a binary mask as a boolean (slices, rows, columns) array on the grid of a CT series.
+
+    Masks on another grid (e.g. a NIfTI with flipped axes) are resampled with nearest-neighbour
+    interpolation first.
+    """
+    same_grid = (
+        mask.GetSize() == ct_series["size"]
+        and np.allclose(mask.GetOrigin(), ct_series["origin"], atol=tolerance)
+        and np.allclose(mask.GetSpacing(), ct_series["spacing"], atol=tolerance)
+        and np.allclose(mask.GetDirection(), ct_series["direction"], atol=tolerance)
+    )
+    if not same_grid:
+        mask = sitk.Resample(
+            mask, ct_series["size"], sitk.Transform(), sitk.sitkNearestNeighbor,
+            ct_series["origin"], ct_series["spacing"], ct_series["direction"], 0, mask.GetPixelID(),
+        )
+    return sitk.GetArrayViewFromImage(mask) > 0
+
+
+def rgb_to_dicom_lab(rgb):
+    """Convert an sRGB color (0-255) to the scaled CIELab values of RecommendedDisplayCIELabValue, as dcmqi does."""
+    rgb = np.asarray(rgb, dtype=float) / 255.0
+    linear = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+    xyz = np.array([
+        [0.4124564, 0.3575761, 0.1804375],
+        [0.2126729, 0.7151522, 0.0721750],
+        [0.0193339, 0.1191920, 0.9503041],
+    ]) @ linear
+    # D65 reference white
+    ratios = xyz / np.array([0.95047, 1.0, 1.08883])
+    f = np.where(ratios > 216 / 24389, np.cbrt(ratios), (24389 / 27 * ratios + 16) / 116)
+    lab = (116 * f[1] - 16, 500 * (f[0] - f[1]), 200 * (f[1] - f[2]))
+    return [
+        int(round(lab[0] * 65535 / 100)),
+        int(round((lab[1] + 128) * 65535 / 255)),
+        int(round((lab[2] + 128) * 65535 / 255)),
+    ]
+
+
+def _code_item(code):
+    item = Dataset()
+    item.CodeValue = str(code["CodeValue"])
+    item.CodingSchemeDesignator = code["CodingSchemeDesignator"]
+    item.CodeMeaning = code["CodeMeaning"]
+    return item
+
+
+def _segment_item(segment_number, attributes):
+    # One item of the SegmentSequence from the dcmqi segment attributes (convert_csv_to_json_for_consensus.py)
+    item = Dataset()
+    item.SegmentNumber = segment_number
+    item.SegmentLabel = attributes.get("SegmentLabel", f"Segment {segment_number}")
+    if "SegmentDescription" in attributes:
+        item.SegmentDescription = attributes["SegmentDescription"]
+    item.SegmentAlgorithmType = attributes.get("SegmentAlgorithmType", "AUTOMATIC")
+    if "SegmentAlgorithmName" in attributes:
+        item.SegmentAlgorithmName = attributes["SegmentAlgorithmName"]
+    item.SegmentedPropertyCategoryCodeSequence = Sequence([_code_item(attributes["SegmentedPropertyCategoryCodeSequence"])])
+
+    type_item = _code_item(attributes["SegmentedPropertyTypeCodeSequence"])
+    if "SegmentedPropertyTypeModifierCodeSequence" in attributes:
+        type_item.SegmentedPropertyTypeModifierCodeSequence = Sequence(
+            [_code_item(attributes["SegmentedPropertyTypeModifierCodeSequence"])]
+        )
+    item.SegmentedPropertyTypeCodeSequence = Sequence([type_item])
+
+    if "AnatomicRegionSequence" in attributes:
+        region_item = _code_item(attributes["AnatomicRegionSequence"])
+        if "AnatomicRegionModifierSequence" in attributes:
+            region_item.AnatomicRegionModifierSequence = Sequence([_code_item(attributes["AnatomicRegionModifierSequence"])])
+        item.AnatomicRegionSequence = Sequence([region_item])
+
+    if attributes.get("recommendedDisplayRGBValue"):
+        item.RecommendedDisplayCIELabValue = rgb_to_dicom_lab(attributes["recommendedDisplayRGBValue"])
+    return item
+
+
+def _frame_item(segment_number, slice_index, ct_slice, derivation_code, purpose_code):
+    # Per-frame functional groups of one frame: dimension index, position, segment and source CT slice
+    frame_content = Dataset()
+    frame_content.DimensionIndexValues = [segment_number, slice_index + 1]
+
+    plane_position = Dataset()
+    plane_position.ImagePositionPatient = list(ct_slice.ImagePositionPatient)
+
+    segment_identification = Dataset()
+    segment_identification.ReferencedSegmentNumber = segment_number
+
+    source_image = Dataset()
+    source_image.ReferencedSOPClassUID = ct_slice.SOPClassUID
+    source_image.ReferencedSOPInstanceUID = ct_slice.SOPInstanceUID
+    source_image.PurposeOfReferenceCodeSequence = Sequence([purpose_code])
+    derivation_image = Dataset()
+    derivation_image.DerivationCodeSequence = Sequence([derivation_code])
+    derivation_image.SourceImageSequence = Sequence([source_image])
+
+    item = Dataset()
+    item.FrameContentSequence = Sequence([frame_content])
+    item.PlanePositionSequence = Sequence([plane_position])
+    item.SegmentIdentificationSequence = Sequence([segment_identification])
+    item.DerivationImageSequence = Sequence([derivation_image])
+    return item
+
+
+def _dimension_item(dimension_organization_uid, index_pointer, group_pointer, label):
+    item = Dataset()
+    item.DimensionOrganizationUID = dimension_organization_uid
+    item.DimensionIndexPointer = index_pointer
+    item.FunctionalGroupPointer = group_pointer
+    item.DimensionDescriptionLabel = label
+    return item
+
+
+def write_segmentation(segments, metadata, ct_series, output_file):
+    """
+    Write binary masks as one BINARY DICOM SEG that references a CT series.
+
+    The SEG is built directly from the masks in memory: every mask is brought onto the CT grid
+    (mask_on_ct_grid), one frame is written per CT slice the mask covers (empty frames are
+    skipped), and the frames are bit-packed, 8 pixels per byte. Patient, study and frame of
+    reference are copied from the CT; series and segment attributes are taken from the dcmqi
+    metadata (convert_csv_to_json_for_consensus.py).
+
+    Args:
+        segments: Iterable of (segment_attributes, mask) pairs: one item of the dcmqi
+            segmentAttributes and the mask as SimpleITK image, or a function returning it (called
+            when the segment is written, so only one mask is in memory at a time). Segments are
+            numbered in this order.
+        metadata: The dcmqi metadata dictionary (series attributes).
+        ct_series: Result of read_ct_series.
+        output_file: Path of the SEG file to write.
+
+    Returns:
+        The number of frames written; no file is written if all masks are empty.
+    """
+    ct_slices = ct_series["datasets"]
+    reference = ct_slices[0]
+    num_columns, num_rows, _ = ct_series["size"]
+
+    derivation_code = _code_item({"CodeValue": "113076", "CodingSchemeDesignator": "DCM", "CodeMeaning": "Segmentation"})
+    purpose_code = _code_item(
+        {"CodeValue": "121322", "CodingSchemeDesignator": "DCM", "CodeMeaning": "Source image for image processing operation"}
+    )
+
+    segment_items, frame_items = [], []
+    packed_frames, carry_bits = [], np.zeros(0, dtype=bool)
+    for segment_number, (attributes, mask) in enumerate(segments, start=1):
+        segment_items.append(_segment_item(segment_number, attributes))
+        frames = mask_on_ct_grid(mask() if callable(mask) else mask, ct_series)
+        slice_indices = np.flatnonzero(frames.reshape(len(frames), -1).any(axis=1))
+        for slice_index in slice_indices:
+            frame_items.append(_frame_item(segment_number, int(slice_index), ct_slices[slice_index], derivation_code, purpose_code))
+        # Frames are packed back to back; bits that do not fill a byte are carried over to the next segment
+        bits = np.concatenate([carry_bits, frames[slice_indices].ravel()])
+        num_packed_bits = len(bits) // 8 * 8
+        packed_frames.append(np.packbits(bits[:num_packed_bits], bitorder="little").tobytes())
+        carry_bits = bits[num_packed_bits:]
+
+    if not frame_items:
+        print(f"All masks are empty, {output_file} is not written.")
+        return 0
+    packed_frames.append(np.packbits(carry_bits, bitorder="little").tobytes())
+    pixel_data = b"".join(packed_frames)
+    if len(pixel_data) % 2:
+        pixel_data += b"\x00"
+
+    now = datetime.now()
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = SEGMENTATION_STORAGE
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds.SpecificCharacterSet = "ISO_IR 192"
+    ds.SOPClassUID = SEGMENTATION_STORAGE
+    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+    for keyword in COPIED_CT_ATTRIBUTES:
+        if keyword in reference:
+            setattr(ds, keyword, reference.data_element(keyword).value)
+
+    ds.Modality = "SEG"
+    ds.SeriesInstanceUID = generate_uid()
+    ds.SeriesNumber = metadata.get("SeriesNumber", "300")
+    ds.SeriesDescription = metadata.get("SeriesDescription", "Segmentation")
+    ds.InstanceNumber = metadata.get("InstanceNumber", "1")
+    ds.SeriesDate = ds.ContentDate = now.strftime("%Y%m%d")
+    ds.SeriesTime = ds.ContentTime = now.strftime("%H%M%S")
+    for keyword in ("ClinicalTrialSeriesID", "ClinicalTrialTimePointID", "ClinicalTrialCoordinatingCenterName"):
+        if keyword in metadata:
+            setattr(ds, keyword, metadata[keyword])
+
+    ds.Manufacturer = "IDC"
+    ds.ManufacturerModelName = "dicom_seg_writer.py"
+    ds.DeviceSerialNumber = "1"
+    ds.SoftwareVersions = pydicom.__version__
+
+    ds.ImageType = ["DERIVED", "PRIMARY"]
+    ds.ContentLabel = "SEGMENTATION"
+    ds.ContentDescription = metadata.get("SeriesDescription", "Segmentation")[:64]
+    ds.ContentCreatorName = metadata.get("ContentCreatorName", "")
+    ds.SegmentationType = "BINARY"
+    ds.LossyImageCompression = "00"
+    ds.SegmentSequence = Sequence(segment_items)
+
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.Rows = num_rows
+    ds.Columns = num_columns
+    ds.BitsAllocated = 1
+    ds.BitsStored = 1
+    ds.HighBit = 0
+    ds.PixelRepresentation = 0
+
+    # Multi-frame dimensions: frames are indexed by segment number and CT slice position
+    dimension_organization_uid = generate_uid()
+    dimension_organization = Dataset()
+    dimension_organization.DimensionOrganizationUID = dimension_organization_uid
+    ds.DimensionOrganizationSequence = Sequence([dimension_organization])
+    ds.DimensionIndexSequence = Sequence([
+        _dimension_item(dimension_organization_uid, 0x0062000B, 0x0062000A, "ReferencedSegmentNumber"),
+        _dimension_item(dimension_organization_uid, 0x00200032, 0x00209113, "ImagePositionPatient"),
+    ])
+
+    pixel_measures = Dataset()
+    pixel_measures.PixelSpacing = list(reference.PixelSpacing)
+    pixel_measures.SliceThickness = reference.get("SliceThickness") or ct_series["spacing"][2]
+    pixel_measures.SpacingBetweenSlices = round(ct_series["spacing"][2], 6)
+    plane_orientation = Dataset()
+    plane_orientation.ImageOrientationPatient = list(reference.ImageOrientationPatient)
+    shared_functional_groups = Dataset()
+    shared_functional_groups.PixelMeasuresSequence = Sequence([pixel_measures])
+    shared_functional_groups.PlaneOrientationSequence = Sequence([plane_orientation])
+    ds.SharedFunctionalGroupsSequence = Sequence([shared_functional_groups])
+    ds.PerFrameFunctionalGroupsSequence = Sequence(frame_items)
+    ds.NumberOfFrames = len(frame_items)
+
+    # Common instance reference: every slice of the CT series
+    referenced_instances = []
+    for ct_slice in ct_slices:
+        instance = Dataset()
+        instance.ReferencedSOPClassUID = ct_slice.SOPClassUID
+        instance.ReferencedSOPInstanceUID = ct_slice.SOPInstanceUID
+        referenced_instances.append(instance)
+    referenced_series = Dataset()
+    referenced_series.SeriesInstanceUID = reference.SeriesInstanceUID
+    referenced_series.ReferencedInstanceSequence = Sequence(referenced_instances)
+    ds.ReferencedSeriesSequence = Sequence([referenced_series])
+
+    ds.add_new(0x7FE00010, "OB", pixel_data)
+
+    try:
+        pydicom.dcmwrite(output_file, ds, enforce_file_format=True)
+    except TypeError:
+        # pydicom < 3
+        ds.is_little_endian, ds.is_implicit_VR = True, False
+        pydicom.dcmwrite(output_file, ds, write_like_original=False)
+    return len(frame_items)
@@ -1,32 +1,79 @@
 import os
+import argparse
+import itertools
+import shutil
 import subprocess
 import json
 import numpy as np
 import pandas as pd
 import SimpleITK as sitk
-from functools import reduce
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache, partial, reduce
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from label_maps import compact_label_dtype, label_bounding_boxes
+from series_index import find_ct_folders, load_series_index
 
-def extract_all_segments(dicom_files, temp_output_folder, segimage2itkimage_path):
+from consensus_kernels import (
+    consensus_and_overlap_counts,
+    dice_from_counts,
+    joint_label_counts,
+    labelmap_consensus,
+    labelmap_vote_histograms,
+    pairwise_intersection_counts,
+    pairwise_label_intersection_counts,
+    vote_counts,
+    vote_histograms,
+)
+from consensus_io import CONSENSUS_FORMATS, CONSENSUS_MASK_SUFFIX, write_consensus_image
+from dicom_seg_decoder import decode_label_map, decode_segment, index_seg_file, normalize_segment_name
+from run_manifest import (
+    case_input_hash,
+    code_version,
+    empty_manifest,
+    file_sha256,
+    is_case_current,
+    list_outputs,
+    load_manifest,
+    save_manifest,
+)
+from results_store import RESULTS_FOLDER, prune_results, read_results, remove_case_results, write_case_results
+from surface_metrics import surface_metric_pairs
+
+
+# Written into a segimage2itkimage output folder once the conversion has finished
+EXTRACTION_COMPLETE_MARKER = ".extraction_complete"
+
+
+def extract_all_segments(dicom_files, temp_output_folder, segimage2itkimage_path, extra_arguments=()):
     os.makedirs(temp_output_folder, exist_ok=True)
 
     for dicom_file in dicom_files:
         dicom_filename = os.path.basename(dicom_file).replace(".dcm", "")
         dicom_output_folder = os.path.join(temp_output_folder, dicom_filename)
-        os.makedirs(dicom_output_folder, exist_ok=True)
+        marker_path = os.path.join(dicom_output_folder, EXTRACTION_COMPLETE_MARKER)
 
-        if os.listdir(dicom_output_folder):
+        if os.path.exists(marker_path):
             print(f"Segments already extracted for {dicom_file}")
             continue
+        if os.path.isdir(dicom_output_folder) and os.listdir(dicom_output_folder):
+            # Left over from an interrupted conversion
+            print(f"Removing incomplete extraction for {dicom_file}")
+            shutil.rmtree(dicom_output_folder)
+        os.makedirs(dicom_output_folder, exist_ok=True)
 
         command = [
             segimage2itkimage_path,
             "--inputDICOM", dicom_file,
-            "--outputDirectory", dicom_output_folder
+            "--outputDirectory", dicom_output_folder,
+            *extra_arguments
         ]
         try:
             subprocess.run(command, check=True)
+            open(marker_path, "w").close()
             print(f"All segments extracted to: {dicom_output_folder}")
         except subprocess.CalledProcessError as e:
             print(f"Error extracting segments from {dicom_file}: {e}")
@@ -42,31 +89,206 @@ def load_meta_json(json_path):
     label_map = {}
     for segment in meta_data["segmentAttributes"]:
         segment_info = segment[0]
-        segment_label = (
-            segment_info["SegmentDescription"]
-            .split(":")[-1]
-            .strip()
-            .lower()
-            .replace(" ", "_")
-        )
+        segment_label = normalize_segment_name(segment_info["SegmentDescription"])
         label_id = str(segment_info["labelID"])
         label_map[label_id] = segment_label
     
     return label_map
 
 
+def load_merged_meta_json(json_path):
+    # With --mergeSegments, segmentAttributes holds one list of segments per output file (1.nrrd, 2.nrrd, ...)
+    with open(json_path, "r") as f:
+        meta_data = json.load(f)
+
+    file_label_maps = {}
+    for file_index, segments in enumerate(meta_data["segmentAttributes"], start=1):
+        file_label_maps[str(file_index)] = {
+            int(segment_info["labelID"]): normalize_segment_name(segment_info["SegmentDescription"])
+            for segment_info in segments
+        }
+    return file_label_maps
+
+
+def load_merged_label_map(subdir_path, label_codes, dtype=np.uint16):
+    # Combine the merged dcmqi output files of one SEG into a single label map with harmonized codes.
+    # dcmqi writes overlapping segments to different files; the structures that lose voxels to a
+    # later file are returned as well, like decode_label_map does.
+    file_label_maps = load_merged_meta_json(os.path.join(subdir_path, "meta.json"))
+    label_map = None
+    combined = None
+    overwritten_codes = set()
+    for f in sorted(os.listdir(subdir_path)):
+        file_index = os.path.basename(f).split(".")[0]
+        if not f.endswith(".nrrd") or file_index not in file_label_maps:
+            continue
+        image = sitk.ReadImage(os.path.join(subdir_path, f))
+        array = sitk.GetArrayViewFromImage(image)
+        lookup = np.zeros(max(int(array.max()), *file_label_maps[file_index]) + 1, dtype=dtype)
+        for label_id, structure_name in file_label_maps[file_index].items():
+            if structure_name in label_codes:
+                lookup[label_id] = label_codes[structure_name]
+        coded = lookup[array]
+        if label_map is None:
+            label_map = image
+            combined = coded
+        else:
+            foreground = coded > 0
+            previous = combined[foreground]
+            overwritten_codes.update(np.unique(previous[(previous != 0) & (previous != coded[foreground])]).tolist())
+            combined[foreground] = coded[foreground]
+    if label_map is None:
+        return None, set()
+
+    merged = sitk.GetImageFromArray(combined)
+    merged.CopyInformation(label_map)
+    overlapping = {
+        structure_name for structure_name, code in label_codes.items() if code in overwritten_codes
+    }
+    return merged, overlapping
+
+
 def load_nrrd_segmentation(nrrd_file):
     if nrrd_file and os.path.exists(nrrd_file):
         return sitk.ReadImage(nrrd_file)
     return None
 
 
-def resample_image(image, reference_image):
+def geometry_key(image):
+    return (
+        tuple(image.GetSize()),
+        tuple(image.GetOrigin()),
+        tuple(image.GetSpacing()),
+        tuple(image.GetDirection()),
+    )
+
+
+@lru_cache(maxsize=256)
+def axis_index_maps(source_geometry, reference_geometry, tie_tolerance=1e-6):
+    """
+    Precompute a separable nearest-neighbour index map from a reference grid into a source grid.
+
+    This works when the source axes are parallel to the reference axes, i.e. the grids differ
+    only by origin, spacing, axis flips or axis permutations. For every reference axis the map
+    holds the matching source axis and, for each reference index along it, the nearest source
+    index (-1 if outside the source image). The result is cached per pair of geometries, so all
+    structures of a model on the same case share one map.
+
+    Returns:
+        A tuple (source_axes, index_arrays), or None if the grids are not axis-aligned or a voxel
+        centre falls within `tie_tolerance` of a rounding boundary (where only the SimpleITK
+        resampler is guaranteed to give its own result).
+    """
+    source_size, source_origin, source_spacing, source_direction = source_geometry
+    reference_size, reference_origin, reference_spacing, reference_direction = reference_geometry
+
+    source_matrix = np.array(source_direction).reshape(3, 3)
+    reference_matrix = np.array(reference_direction).reshape(3, 3)
+    # Column a of `axis_alignment` expresses reference axis a in source axes
+    axis_alignment = source_matrix.T @ reference_matrix
+    source_axes = np.argmax(np.abs(axis_alignment), axis=0)
+    if sorted(source_axes) != [0, 1, 2]:
+        return None
+    signs = axis_alignment[source_axes, [0, 1, 2]]
+    expected = np.zeros((3, 3))
+    expected[source_axes, [0, 1, 2]] = signs
+    if not np.allclose(np.abs(signs), 1.0, atol=1e-6) or not np.allclose(axis_alignment, expected, atol=1e-6):
+        return None
+
+    # Continuous source index of the first reference voxel (ITK convention: voxel centres at integers)
+    start_index = np.linalg.solve(
+        source_matrix * np.array(source_spacing),
+        np.array(reference_origin) - np.array(source_origin)
+    )
+
+    index_arrays = []
+    for axis, source_axis in enumerate(source_axes):
+        step = signs[axis] * reference_spacing[axis] / source_spacing[source_axis]
+        continuous = start_index[source_axis] + step * np.arange(reference_size[axis])
+        if np.any(np.abs(continuous - np.floor(continuous) - 0.5) < tie_tolerance):
+            return None
+        nearest = np.floor(continuous + 0.5).astype(np.int64)
+        inside = (continuous >= -0.5) & (continuous < source_size[source_axis] - 0.5)
+        index_arrays.append(np.where(inside, nearest, -1))
+
+    return tuple(int(a) for a in source_axes), tuple(index_arrays)
+
+
+def _as_slice(indices):
+    # Contiguous index runs (identity, crop or flip) become a slice, so no copy is made
+    if len(indices) > 1 and np.all(np.diff(indices) == indices[1] - indices[0]) and abs(indices[1] - indices[0]) == 1:
+        step = int(indices[1] - indices[0])
+        stop = int(indices[-1]) + step
+        return slice(int(indices[0]), stop if stop >= 0 else None, step)
+    if len(indices) == 1:
+        return slice(int(indices[0]), int(indices[0]) + 1)
+    return indices
+
+
+def resample_with_index_maps(image, index_maps, target_size, binarize=True):
+    source_axes, index_arrays = index_maps
+    # Work in SimpleITK (x, y, z) axis order, with the source axes ordered like the reference axes
+    source = sitk.GetArrayViewFromImage(image).transpose(2, 1, 0).transpose(source_axes)
+
+    result = np.zeros(target_size, dtype=np.uint8 if binarize else source.dtype)
+    valid = [np.flatnonzero(indices >= 0) for indices in index_arrays]
+    if all(len(v) for v in valid):
+        # Inside voxels form one contiguous block, because the index maps are monotonic
+        block = tuple(slice(v[0], v[-1] + 1) for v in valid)
+        selectors = [_as_slice(indices[v]) for indices, v in zip(index_arrays, valid)]
+        if all(isinstance(selector, slice) for selector in selectors):
+            values = source[tuple(selectors)]
+        else:
+            values = source[np.ix_(*[
+                np.arange(source.shape[axis])[selector] if isinstance(selector, slice) else selector
+                for axis, selector in enumerate(selectors)
+            ])]
+        result[block] = (values >= 1) & (values <= 255) if binarize else values
+    return result.transpose(2, 1, 0)
+
+
+def resample_image(image, reference_image, crop=None, binarize=True):
+    """
+    Nearest-neighbour resample a mask onto the reference grid and binarize it.
+
+    Args:
+        image: The mask to resample.
+        reference_image: Image defining the output grid.
+        crop: Optional (start, size) region of the reference grid; only this region is resampled.
+        binarize: Set to False to keep the label values (for label maps).
+
+    Returns:
+        A UInt8 image with values 0/1 on the reference grid (or on the cropped region of it),
+        or an image with the input pixel type if `binarize` is False.
+    """
+    index_maps = axis_index_maps(geometry_key(image), geometry_key(reference_image))
+    if index_maps is not None:
+        # Grids that match or differ only by origin, spacing, flips or permutations: array indexing
+        source_axes, index_arrays = index_maps
+        if crop:
+            start, size = crop
+            index_arrays = tuple(
+                indices[offset:offset + length] for indices, offset, length in zip(index_arrays, start, size)
+            )
+        target_size = tuple(len(indices) for indices in index_arrays)
+        binary_image = sitk.GetImageFromArray(
+            np.ascontiguousarray(
+                resample_with_index_maps(image, (source_axes, index_arrays), target_size, binarize)
+            )
+        )
+        binary_image.SetOrigin(reference_image.TransformIndexToPhysicalPoint(crop[0]) if crop else reference_image.GetOrigin())
+        binary_image.SetSpacing(reference_image.GetSpacing())
+        binary_image.SetDirection(reference_image.GetDirection())
+        return binary_image
+
+    target_image = sitk.RegionOfInterest(reference_image, crop[1], crop[0]) if crop else reference_image
     resampler = sitk.ResampleImageFilter()
-    resampler.SetReferenceImage(reference_image)
+    resampler.SetReferenceImage(target_image)
     resampler.SetInterpolator(sitk.sitkNearestNeighbor)
     # resampler.SetOutputPixelType(sitk.sitkUInt8)
     resampled_image = resampler.Execute(image)
+    if not binarize:
+        return resampled_image
     binary_image = sitk.BinaryThreshold(
         resampled_image,
         lowerThreshold=1,
@@ -77,6 +299,239 @@ def resample_image(image, reference_image):
     return binary_image
 
 
+def mask_bounding_box(image):
+    # Index bounding box (start, stop) in (x, y, z) order of the non-zero voxels, None if empty
+    array = sitk.GetArrayViewFromImage(image)
+    nonzero = [np.flatnonzero(array.any(axis=axes)) for axes in ((0, 1), (0, 2), (1, 2))]
+    if any(len(indices) == 0 for indices in nonzero):
+        return None
+    return (
+        tuple(int(indices[0]) for indices in nonzero),
+        tuple(int(indices[-1]) + 1 for indices in nonzero),
+    )
+
+
+def union_bounding_box(images, reference_image, padding=1):
+    """
+    Compute the union bounding box of all mask voxels in the index space of the reference image.
+
+    The bounding box of each mask is mapped through physical space onto the reference grid,
+    so masks on different grids can be combined. The box is padded and clipped to the
+    reference extent.
+
+    Returns:
+        A tuple (start, size) usable with sitk.RegionOfInterest, or None if all masks are
+        empty or lie outside the reference image.
+    """
+    reference_size = np.array(reference_image.GetSize())
+    lower = np.full(3, np.inf)
+    upper = np.full(3, -np.inf)
+
+    for image in images:
+        bounding_box = mask_bounding_box(image)
+        if bounding_box is None:
+            continue
+        # Voxel i covers the continuous index range [i - 0.5, i + 0.5]
+        for corner in itertools.product(*zip(*bounding_box)):
+            point = image.TransformContinuousIndexToPhysicalPoint([c - 0.5 for c in corner])
+            index = reference_image.TransformPhysicalPointToContinuousIndex(point)
+            lower = np.minimum(lower, index)
+            upper = np.maximum(upper, index)
+
+    if not np.all(np.isfinite(lower)):
+        return None
+
+    start = np.clip(np.floor(lower).astype(int) - padding, 0, reference_size)
+    stop = np.clip(np.ceil(upper).astype(int) + 1 + padding, 0, reference_size)
+    if np.any(stop <= start):
+        return None
+    return [int(v) for v in start], [int(v) for v in stop - start]
+
+
+def label_map_crops(label_maps, label_codes, padding=1):
+    """
+    Compute the union bounding box of every label over N label maps on the same grid.
+
+    The bounding boxes of all labels of a map are found in one pass (label_maps.label_bounding_boxes),
+    so each structure can then be compared inside its own box instead of on the full volume.
+
+    Returns:
+        A dictionary mapping each label code with at least one voxel to a tuple of array slices
+        in (z, y, x) order, padded by `padding` voxels and clipped to the label map extent.
+    """
+    shape = np.asarray(label_maps[0]).shape
+    lower = {}
+    upper = {}
+    for label_map in label_maps:
+        for code, (index, size) in label_bounding_boxes(sitk.GetImageFromArray(label_map)).items():
+            if code not in label_codes:
+                continue
+            start = np.array(index[::-1])
+            stop = start + np.array(size[::-1])
+            lower[code] = np.minimum(lower.get(code, start), start)
+            upper[code] = np.maximum(upper.get(code, stop), stop)
+    return {
+        code: tuple(
+            slice(max(int(start) - padding, 0), min(int(stop) + padding, extent))
+            for start, stop, extent in zip(lower[code], upper[code], shape)
+        )
+        for code in lower
+    }
+
+
+def paste_into_reference(mask, reference_image, start):
+    # Place a cropped mask back into an empty image on the full reference grid
+    full_image = sitk.Image(reference_image.GetSize(), mask.GetPixelID())
+    full_image.CopyInformation(reference_image)
+    return sitk.Paste(full_image, mask, mask.GetSize(), [0, 0, 0], start)
+
+
+def compute_consensus_and_dice_sitk(model_masks):
+    # Reference implementation: N-way AND, then one overlap filter pass per model
+    overlap = reduce(sitk.And, [mask for mask in model_masks.values()])
+    overlap_filter = sitk.LabelOverlapMeasuresImageFilter()
+    dice_scores = {}
+    for model, mask in model_masks.items():
+        overlap_filter.Execute(mask, overlap)
+        dice_scores[model] = overlap_filter.GetDiceCoefficient()
+    return overlap, dice_scores
+
+
+def compute_consensus_and_dice_numpy(model_masks, bitpack=True):
+    # Consensus and all per-model overlap counts from one pass over the stacked (bit-packed) masks
+    arrays = [sitk.GetArrayViewFromImage(mask) for mask in model_masks.values()]
+    consensus, intersection_counts, mask_counts, consensus_count = consensus_and_overlap_counts(
+        arrays, bitpack=bitpack
+    )
+    overlap = sitk.GetImageFromArray(consensus.astype(np.uint8))
+    overlap.CopyInformation(next(iter(model_masks.values())))
+    dice_scores = {
+        model: dice_from_counts(intersection_count, mask_count, consensus_count)
+        for model, intersection_count, mask_count in zip(model_masks, intersection_counts, mask_counts)
+    }
+    return overlap, dice_scores
+
+
+def compute_consensus_and_dice(model_masks, kernel="numpy"):
+    """
+    Compute the AND consensus of the model masks and the Dice score of each model against it.
+
+    Args:
+        model_masks: Dictionary mapping model name to a binary mask on a common grid.
+        kernel: "numpy" for the vectorized kernel, "sitk" for the SimpleITK filters, or
+            "validate" to run both and raise if the consensus or any Dice score differs.
+
+    Returns:
+        A tuple (overlap, dice_scores) with the consensus image and a dictionary of Dice scores.
+    """
+    if kernel == "sitk":
+        return compute_consensus_and_dice_sitk(model_masks)
+    if kernel == "numpy":
+        return compute_consensus_and_dice_numpy(model_masks)
+
+    overlap, dice_scores = compute_consensus_and_dice_sitk(model_masks)
+    numpy_overlap, numpy_dice_scores = compute_consensus_and_dice_numpy(model_masks)
+    if not np.array_equal(
+        sitk.GetArrayViewFromImage(overlap), sitk.GetArrayViewFromImage(numpy_overlap)
+    ):
+        raise ValueError("Kernel validation failed: consensus masks differ")
+    if numpy_dice_scores != dice_scores:
+        raise ValueError(
+            f"Kernel validation failed: Dice scores differ ({numpy_dice_scores} vs {dice_scores})"
+        )
+    print(f"Kernel validation passed for {len(model_masks)} models")
+    return overlap, dice_scores
+
+
+def pairwise_dice_rows(series_uid, structure_name, model_names, intersection_counts):
+    """
+    Turn an N x N matrix of pairwise intersection counts into long-format result rows.
+
+    The diagonal of `intersection_counts` must hold the voxel count of each model, so every
+    Dice score is derived from the shared counts without another pass over the masks.
+
+    Returns:
+        One row per ordered pair of models (including each model with itself).
+    """
+    rows = []
+    for i, model_a in enumerate(model_names):
+        for j, model_b in enumerate(model_names):
+            rows.append({
+                "CT_SeriesInstanceUID": series_uid,
+                "Structure": structure_name,
+                "Model_A": model_a,
+                "Model_B": model_b,
+                "Intersection_Voxels": int(intersection_counts[i, j]),
+                "Voxels_A": int(intersection_counts[i, i]),
+                "Voxels_B": int(intersection_counts[j, j]),
+                "Dice_Score": dice_from_counts(
+                    intersection_counts[i, j], intersection_counts[i, i], intersection_counts[j, j]
+                )
+            })
+    return rows
+
+
+def agreement_dice_rows(series_uid, structure_name, model_names, model_histograms, consensus_histogram):
+    """
+    Compute the Dice score of each model against the k-of-N consensus for every agreement level k.
+
+    Args:
+        model_histograms: Array (N, >= N + 1) with the number of voxels of each model mask
+            that received 0, 1, 2, ... votes.
+        consensus_histogram: Array (>= N + 1,) with the number of voxels that received
+            0, 1, 2, ... votes.
+
+    Returns:
+        One row per model and level k = 1..N, where the level-k consensus holds all voxels
+        with at least k votes (k = N is the unanimous consensus).
+    """
+    num_models = len(model_names)
+
+    def at_least(histogram):
+        # Number of voxels with at least k votes, for k = 0..N
+        return np.cumsum(histogram[num_models::-1])[::-1]
+
+    consensus_counts = at_least(consensus_histogram)
+    rows = []
+    for model, histogram in zip(model_names, model_histograms):
+        intersection_counts = at_least(histogram)
+        for required_votes in range(1, num_models + 1):
+            rows.append({
+                "CT_SeriesInstanceUID": series_uid,
+                "Structure": structure_name,
+                "Model": model,
+                "Required_Votes": required_votes,
+                "Num_Models": num_models,
+                "Consensus_Voxels": int(consensus_counts[required_votes]),
+                "Dice_Score": dice_from_counts(
+                    intersection_counts[required_votes], intersection_counts[1], consensus_counts[required_votes]
+                )
+            })
+    return rows
+
+
+def surface_metric_rows(series_uid, structure_name, mask_names, masks, spacing, tolerance):
+    """
+    Compute HD95, ASSD and surface Dice for every ordered pair of masks as long-format result rows.
+
+    Returns:
+        One row per ordered pair of different masks; the metrics are symmetric.
+    """
+    pair_metrics = surface_metric_pairs(masks, spacing, tolerance)
+    rows = []
+    for (i, j), metrics in pair_metrics.items():
+        for model_a, model_b in ((mask_names[i], mask_names[j]), (mask_names[j], mask_names[i])):
+            rows.append({
+                "CT_SeriesInstanceUID": series_uid,
+                "Structure": structure_name,
+                "Model_A": model_a,
+                "Model_B": model_b,
+                **metrics,
+                "Tolerance_mm": tolerance
+            })
+    return rows
+
+
 def extract_model_name(file_name):
     models = {
         "TotalSegmentator_v15": "TotalSegmentator_1.5",
@@ -92,128 +547,619 @@ def extract_model_name(file_name):
     return "Unknown"
 
 
-def process_ct_folders(base_folder, output_nii, csv_file, segimage2itkimage_path):
-    df_structures = pd.read_csv(csv_file, delimiter=",")
-    # structures that are segmented by 4 or more models
-    structures_list = (df_structures[df_structures["count"] >= 4]["final_label"].str.lower().tolist()
+def collect_segments_dcmqi(segmentation_files, ct_path, structures_list, segimage2itkimage_path):
+    # Convert each SEG to per-segment NRRD files with segimage2itkimage and load them from disk
+    temp_output_folder = os.path.join(ct_path, "temp_nifti")
+
+    print(f"Converting all DICOM segmentations to NRRD for {os.path.basename(ct_path)}")
+    temp_output_folder = extract_all_segments(
+        segmentation_files,
+        temp_output_folder,
+        segimage2itkimage_path
     )
-    
-    results = []
+    if not temp_output_folder:
+        return None
 
-    for root, dirs, _ in os.walk(base_folder):
-        for ct_folder in dirs:
-            if not ct_folder.startswith("CT_"):
-                continue
+    segment_loaders = {}
+    for file in segmentation_files:
+        model_name = extract_model_name(file)
+        dicom_filename = os.path.basename(file).replace(".dcm", "")
+        subdir_path = os.path.join(temp_output_folder, dicom_filename)
 
-            print(f"Processing CT folder: {ct_folder}")    
-            series_uid = ct_folder.split("_")[-1]
-            ct_path = os.path.join(root, ct_folder)
+        if os.path.isdir(subdir_path):
+            meta_json_path = os.path.join(subdir_path, "meta.json")
+            if os.path.exists(meta_json_path):
+                label_map = load_meta_json(meta_json_path)
+                nifti_data = {
+                    os.path.basename(f).split(".")[0]: os.path.join(subdir_path, f)
+                    for f in os.listdir(subdir_path)
+                    if f.endswith(".nrrd")
+                }
 
-            if not os.path.exists(ct_path):
-                continue
+                for label_id, structure_name in label_map.items():
+                    if structure_name in structures_list and label_id in nifti_data:
+                        nifti_path = nifti_data[label_id]
+                        segment_loaders.setdefault(structure_name, []).append(
+                            (model_name, partial(load_nrrd_segmentation, nifti_path))
+                        )
+    return segment_loaders
+
+
+def collect_segments_native(segmentation_files, structures_list):
+    # Index the SEG frames in-process; segments are only decoded when their loader is called
+    segment_loaders = {}
+    for file in segmentation_files:
+        model_name = extract_model_name(file)
+        try:
+            seg_index = index_seg_file(file, structures=set(structures_list))
+        except Exception as e:
+            print(f"Error reading DICOM SEG {file}: {e}")
+            continue
+
+        for structure_name in seg_index["segments"]:
+            segment_loaders.setdefault(structure_name, []).append(
+                (model_name, partial(decode_segment, seg_index, structure_name))
+            )
+    return segment_loaders
+
+
+def collect_label_maps_dcmqi(segmentation_files, ct_path, structures_list, segimage2itkimage_path):
+    # Convert each SEG with --mergeSegments, so every model is loaded as one label map
+    temp_output_folder = os.path.join(ct_path, "temp_nifti_merged")
+
+    print(f"Converting all DICOM segmentations to merged NRRD label maps for {os.path.basename(ct_path)}")
+    temp_output_folder = extract_all_segments(
+        segmentation_files,
+        temp_output_folder,
+        segimage2itkimage_path,
+        extra_arguments=("--mergeSegments",)
+    )
+    if not temp_output_folder:
+        return None
+
+    label_map_loaders = {}
+    for file in segmentation_files:
+        model_name = extract_model_name(file)
+        subdir_path = os.path.join(temp_output_folder, os.path.basename(file).replace(".dcm", ""))
+        meta_json_path = os.path.join(subdir_path, "meta.json")
+        if not os.path.exists(meta_json_path):
+            continue
+
+        structures = {
+            structure_name
+            for file_label_map in load_merged_meta_json(meta_json_path).values()
+            for structure_name in file_label_map.values()
+            if structure_name in structures_list
+        }
+        label_map_loaders[model_name] = (structures, partial(load_merged_label_map, subdir_path))
+    return label_map_loaders
+
+
+def collect_label_maps_native(segmentation_files, structures_list):
+    # One label map loader per model, together with the structures that model segments
+    label_map_loaders = {}
+    for file in segmentation_files:
+        model_name = extract_model_name(file)
+        try:
+            seg_index = index_seg_file(file, structures=set(structures_list))
+        except Exception as e:
+            print(f"Error reading DICOM SEG {file}: {e}")
+            continue
+
+        label_map_loaders[model_name] = (set(seg_index["segments"]), partial(decode_label_map, seg_index))
+    return label_map_loaders
+
+
+def process_ct_folder_labelmap(
+    ct_path, base_folder, output_nii, structures_list, segimage2itkimage_path=None, surface_tolerance=None,
+    consensus_format="nii.gz", write_votes=False
+):
+    """
+    Compute consensus masks and Dice scores for all structures of a CT series from one label map per model.
+
+    Each model is loaded, resampled and counted once: the consensus of all structures comes
+    from one vectorized pass over the label maps and the Dice scores from one joint histogram
+    (np.bincount) per model, instead of one pass per model and structure. The k-of-N agreement
+    only needs the vote histograms, so the vote-count volume of every structure costs an extra
+    pass over all models and is only written if `write_votes` is set.
+
+    Returns:
+        A dictionary of result rows, in the same format as process_ct_folder.
+    """
+    ct_folder = os.path.basename(ct_path)
+    print(f"Processing CT folder: {ct_folder}")
+    series_uid = ct_folder.split("_")[-1]
+    results = {"dice": [], "pairwise": [], "agreement": [], "surface": []}
+
+    if not os.path.exists(ct_path):
+        return results
+
+    segmentation_files = find_segmentation_files(ct_path)
+
+    if not segmentation_files:
+        return results
+
+    if segimage2itkimage_path:
+        label_map_loaders = collect_label_maps_dcmqi(
+            segmentation_files, ct_path, structures_list, segimage2itkimage_path
+        )
+    else:
+        label_map_loaders = collect_label_maps_native(segmentation_files, structures_list)
+    if not label_map_loaders:
+        return results
+
+    if "Auto3Dseg" not in label_map_loaders:
+        print(f"No valid reference image (Auto3DSeg) in {ct_folder}, skipping...")
+        return results
+
+    # Same selection as the per-structure mode: at least 4 models, including the Auto3DSeg reference
+    model_names = list(label_map_loaders)
+    evaluated_structures = []
+    for structure_name in structures_list:
+        num_models = sum(structure_name in label_map_loaders[model][0] for model in model_names)
+        if structure_name not in label_map_loaders["Auto3Dseg"][0]:
+            continue
+        if num_models < 4:
+            print(f"Skipping {structure_name}, not all models available.")
+            continue
+        evaluated_structures.append(structure_name)
+
+    if not evaluated_structures:
+        return results
+
+    label_codes = {structure_name: code for code, structure_name in enumerate(evaluated_structures, start=1)}
+    num_labels = len(label_codes) + 1
+    label_dtype = compact_label_dtype(num_labels)
+
+    reference_image, overlapping = label_map_loaders["Auto3Dseg"][1](label_codes, dtype=label_dtype)
+    label_maps = []
+    for model_name in model_names:
+        if model_name == "Auto3Dseg":
+            image = reference_image
+        else:
+            image, model_overlapping = label_map_loaders[model_name][1](label_codes, dtype=label_dtype)
+            overlapping |= model_overlapping
+        resampled = resample_image(image, reference_image, binarize=False)
+        label_maps.append(sitk.GetArrayFromImage(resampled).astype(label_dtype, copy=False))
+
+    # A label map holds one label per voxel, so structures that lost voxels to an overlapping
+    # segment of the same model are removed from it and evaluated one structure at a time instead
+    if overlapping:
+        fallback_structures = [structure_name for structure_name in label_codes if structure_name in overlapping]
+        print(f"Overlapping segments in {ct_folder}, evaluating per structure: {', '.join(fallback_structures)}")
+        keep = np.arange(num_labels, dtype=label_dtype)
+        for structure_name in fallback_structures:
+            keep[label_codes.pop(structure_name)] = 0
+        label_maps = [keep[label_map] for label_map in label_maps]
+        fallback_results = process_ct_folder(
+            ct_path, base_folder, output_nii, fallback_structures, segimage2itkimage_path,
+            surface_tolerance=surface_tolerance, consensus_format=consensus_format, write_votes=write_votes
+        )
+        for table, rows in fallback_results.items():
+            results[table].extend(rows)
+        if not label_codes:
+            return results
+
+    required_votes = np.zeros(num_labels, dtype=np.uint8)
+    for structure_name, code in label_codes.items():
+        required_votes[code] = sum(structure_name in label_map_loaders[model][0] for model in model_names)
 
-            segmentation_files = [
-                os.path.join(ct_path, f)
-                for f in os.listdir(ct_path)
-                if f.endswith(".dcm")
-            ]
+    # Every evaluated structure is segmented by Auto3DSeg, so its label map holds the candidate labels
+    consensus = labelmap_consensus(label_maps, required_votes, model_names.index("Auto3Dseg"))
 
-            if not segmentation_files:
+    # Per-structure masks are only compared inside the padded bounding box of the structure
+    crops = label_map_crops(label_maps, set(label_codes.values()))
+    empty_crop = (slice(0, 0),) * consensus.ndim
+
+    # Save one consensus NIfTI per structure, mirroring the CT folder structure under output_nii
+    relative_path = os.path.relpath(ct_path, base_folder)
+    save_path = os.path.join(output_nii, relative_path)
+    os.makedirs(save_path, exist_ok=True)
+    for structure_name, code in label_codes.items():
+        crop = crops.get(code, empty_crop)
+        overlap_array = np.zeros(consensus.shape, dtype=np.uint8)
+        overlap_array[crop] = consensus[crop] == code
+        overlap = sitk.GetImageFromArray(overlap_array)
+        overlap.CopyInformation(reference_image)
+        output_file = write_consensus_image(
+            overlap, os.path.join(save_path, f"{structure_name}{CONSENSUS_MASK_SUFFIX}"), consensus_format
+        )
+        print(f"Overlap for {structure_name} saved to: {output_file}")
+
+        if not write_votes:
+            continue
+        votes_array = np.zeros(consensus.shape, dtype=np.uint8)
+        votes_array[crop] = vote_counts([label_map[crop] == code for label_map in label_maps])
+        votes_image = sitk.GetImageFromArray(votes_array)
+        votes_image.CopyInformation(reference_image)
+        votes_file = write_consensus_image(
+            votes_image, os.path.join(save_path, f"{structure_name}_votes"), consensus_format
+        )
+        print(f"Vote counts for {structure_name} saved to: {votes_file}")
+
+    for model_name, label_map in zip(model_names, label_maps):
+        counts = joint_label_counts(label_map, consensus, num_labels)
+        for structure_name, code in label_codes.items():
+            if structure_name not in label_map_loaders[model_name][0]:
                 continue
+            dice = dice_from_counts(counts[code, code], counts[code, :].sum(), counts[:, code].sum())
+            results["dice"].append({
+                "CT_SeriesInstanceUID": series_uid,
+                "Structure": structure_name,
+                "Model": model_name,
+                "Dice_Score": dice
+            })
+
+    # Pairwise agreement of all structures from one shared-label histogram per pair of models,
+    # and k-of-N agreement of all structures from one (label, votes) histogram per model
+    pairwise_counts = pairwise_label_intersection_counts(label_maps, num_labels)
+    model_histograms, consensus_histogram = labelmap_vote_histograms(label_maps, num_labels)
+    for structure_name, code in label_codes.items():
+        owners = [i for i, model in enumerate(model_names) if structure_name in label_map_loaders[model][0]]
+        owner_names = [model_names[i] for i in owners]
+        results["pairwise"].extend(pairwise_dice_rows(
+            series_uid,
+            structure_name,
+            owner_names,
+            pairwise_counts[np.ix_(owners, owners, [code])][..., 0]
+        ))
+        results["agreement"].extend(agreement_dice_rows(
+            series_uid, structure_name, owner_names, model_histograms[owners, code], consensus_histogram[code]
+        ))
+        if surface_tolerance is not None:
+            crop = crops.get(code, empty_crop)
+            results["surface"].extend(surface_metric_rows(
+                series_uid,
+                structure_name,
+                owner_names + ["Consensus"],
+                [label_maps[i][crop] == code for i in owners] + [consensus[crop] == code],
+                reference_image.GetSpacing(),
+                surface_tolerance
+            ))
 
-            temp_output_folder = os.path.join(ct_path, "temp_nifti")
-            
-            print(f"Converting all DICOM segmentations to NIfTI for {ct_folder}")
-            temp_output_folder = extract_all_segments(
-                segmentation_files,
-                temp_output_folder,
-                segimage2itkimage_path
+    return results
+
+
+def find_segmentation_files(ct_path):
+    return [
+        os.path.join(ct_path, f)
+        for f in os.listdir(ct_path)
+        if f.endswith(".dcm")
+    ]
+
+
+def process_ct_folder(
+    ct_path, base_folder, output_nii, structures_list, segimage2itkimage_path=None, crop_to_structure=True,
+    kernel="numpy", surface_tolerance=None, consensus_format="nii.gz", write_votes=True
+):
+    """
+    Compute consensus masks, Dice scores against the consensus and pairwise Dice scores for one CT series.
+
+    If `surface_tolerance` (mm) is given, HD95, ASSD and surface Dice are computed as well,
+    for every model against the consensus and for every pair of models. Consensus masks and
+    vote-count volumes are written in `consensus_format` (see consensus_io.CONSENSUS_FORMATS).
+
+    Returns:
+        A dictionary with the result rows per output table: "dice" (each model vs the
+        consensus), "pairwise" (each model vs each other model), "agreement" (each model
+        vs the consensus of every k-of-N agreement level) and "surface" (surface-distance
+        metrics, empty unless `surface_tolerance` is given).
+    """
+    ct_folder = os.path.basename(ct_path)
+    print(f"Processing CT folder: {ct_folder}")    
+    series_uid = ct_folder.split("_")[-1]
+    results = {"dice": [], "pairwise": [], "agreement": [], "surface": []}
+
+    if not os.path.exists(ct_path):
+        return results
+
+    segmentation_files = find_segmentation_files(ct_path)
+
+    if not segmentation_files:
+        return results
+
+    if segimage2itkimage_path:
+        segment_loaders = collect_segments_dcmqi(
+            segmentation_files, ct_path, structures_list, segimage2itkimage_path
+        )
+    else:
+        segment_loaders = collect_segments_native(segmentation_files, structures_list)
+    if segment_loaders is None:
+        return results
+
+    for structure_name, loaders in segment_loaders.items():
+        print(f"Processing structure: {structure_name}")
+        if len(loaders) < 4:
+            print(f"Skipping {structure_name}, not all models available.")
+            print(len(loaders))
+            print([model for model, _ in loaders])
+            continue
+        
+        model_masks = {}
+        auto3dseg_loader = next(
+            (loader for model, loader in loaders if model == "Auto3Dseg"),
+            None
+        )
+        reference_image = auto3dseg_loader() if auto3dseg_loader else None
+        if reference_image is None:
+            print(
+                f"No valid reference image (Auto3DSeg) for {structure_name} "
+                f"in {ct_folder}, skipping..."
             )
-            if not temp_output_folder:
+            continue
+
+        model_images = {}
+        for model_name, loader in loaders:
+            image = reference_image if model_name == "Auto3Dseg" else loader()
+            if image is None:
+                print(f"Could not load {structure_name} for {model_name}, skipping this model.")
                 continue
+            model_images[model_name] = image
 
-            nifti_files = {}
-            for file in segmentation_files:
-                model_name = extract_model_name(file)
-                dicom_filename = os.path.basename(file).replace(".dcm", "")
-                subdir_path = os.path.join(temp_output_folder, dicom_filename)
-                
-                if os.path.isdir(subdir_path):
-                    meta_json_path = os.path.join(subdir_path, "meta.json")
-                    if os.path.exists(meta_json_path):
-                        label_map = load_meta_json(meta_json_path)
-                        nifti_data = {
-                            os.path.basename(f).split(".")[0]: os.path.join(subdir_path, f)
-                            for f in os.listdir(subdir_path)
-                            if f.endswith(".nrrd")
-                        }
-                        
-                        for label_id, structure_name in label_map.items():
-                            if structure_name in structures_list and label_id in nifti_data:
-                                nifti_path = nifti_data[label_id]
-                                nifti_files.setdefault(structure_name, []).append(
-                                    (model_name, nifti_path)
-                                )
-            
-            for structure_name, paths in nifti_files.items():
-                print(f"Processing structure: {structure_name}")
-                if len(paths) < 4:
-                    print(f"Skipping {structure_name}, not all models available.")
-                    print(len(paths))
-                    print(paths)
-                    continue
-                
-                model_masks = {}
-                auto3dseg_path = next(
-                    (path for model, path in paths if model == "Auto3Dseg"),
-                    None
-                )
-                reference_image = load_nrrd_segmentation(auto3dseg_path)
-                if reference_image is None:
-                    print(
-                        f"No valid reference image (Auto3DSeg) for {structure_name} "
-                        f"in {ct_folder}, skipping..."
-                    )
-                    continue
-
-                for model_name, seg_file in paths:
-                    image = load_nrrd_segmentation(seg_file)
-                    if image is None:
-                        print(f"Could not load NRRD file {seg_file}, skipping this model.")
-                        continue
-                    model_masks[model_name] = resample_image(image, reference_image)
-                
-                if not model_masks:
-                    print(f"No valid masks for {structure_name} in {ct_folder}, skipping...")
-                    continue
-
-                # Compute consensus overlap
-                overlap = reduce(sitk.And, [mask for mask in model_masks.values()])
-
-                # Save consensus NIfTI, mirroring the CT folder structure under output_nii
-                relative_path = os.path.relpath(ct_path, base_folder)
-                save_path = os.path.join(output_nii, relative_path)
-                os.makedirs(save_path, exist_ok=True)
-
-                output_file = os.path.join(save_path, f"{structure_name}_overlap.nii.gz")
-                sitk.WriteImage(overlap, output_file)
-                print(f"Overlap for {structure_name} saved to: {output_file}")
-
-                # Compute Dice scores vs overlap
-                overlap_filter = sitk.LabelOverlapMeasuresImageFilter()
-                for model, mask in model_masks.items():
-                    overlap_filter.Execute(mask, overlap)
-                    dice = overlap_filter.GetDiceCoefficient()
-                    results.append({
-                        "CT_SeriesInstanceUID": series_uid,
-                        "Structure": structure_name,
-                        "Model": model,
-                        "Dice_Score": dice
-                    })
+        # Restrict resampling, consensus and overlap counting to the union bounding box of all masks
+        crop = union_bounding_box(model_images.values(), reference_image) if crop_to_structure else None
+
+        for model_name, image in model_images.items():
+            model_masks[model_name] = resample_image(image, reference_image, crop)
+        
+        if not model_masks:
+            print(f"No valid masks for {structure_name} in {ct_folder}, skipping...")
+            continue
+
+        # Compute consensus overlap and Dice scores vs overlap
+        overlap, dice_scores = compute_consensus_and_dice(model_masks, kernel=kernel)
+
+        # One uint8 vote-count volume holds the k-of-N consensus for every agreement level
+        mask_arrays = [sitk.GetArrayViewFromImage(mask) for mask in model_masks.values()]
+        votes = vote_counts(mask_arrays)
+
+        # Save consensus NIfTI, mirroring the CT folder structure under output_nii
+        relative_path = os.path.relpath(ct_path, base_folder)
+        save_path = os.path.join(output_nii, relative_path)
+        os.makedirs(save_path, exist_ok=True)
+
+        full_overlap = paste_into_reference(overlap, reference_image, crop[0]) if crop else overlap
+        output_file = write_consensus_image(
+            full_overlap, os.path.join(save_path, f"{structure_name}{CONSENSUS_MASK_SUFFIX}"), consensus_format
+        )
+        print(f"Overlap for {structure_name} saved to: {output_file}")
+
+        if write_votes:
+            votes_image = sitk.GetImageFromArray(votes)
+            votes_image.CopyInformation(overlap)
+            full_votes = paste_into_reference(votes_image, reference_image, crop[0]) if crop else votes_image
+            votes_file = write_consensus_image(
+                full_votes, os.path.join(save_path, f"{structure_name}_votes"), consensus_format
+            )
+            print(f"Vote counts for {structure_name} saved to: {votes_file}")
+
+        for model, dice in dice_scores.items():
+            results["dice"].append({
+                "CT_SeriesInstanceUID": series_uid,
+                "Structure": structure_name,
+                "Model": model,
+                "Dice_Score": dice
+            })
+
+        # Pairwise Dice scores share one matrix of intersection counts across all model pairs
+        intersection_counts = pairwise_intersection_counts(mask_arrays)
+        results["pairwise"].extend(
+            pairwise_dice_rows(series_uid, structure_name, list(model_masks), intersection_counts)
+        )
+
+        model_histograms, consensus_histogram = vote_histograms(mask_arrays, votes)
+        results["agreement"].extend(agreement_dice_rows(
+            series_uid, structure_name, list(model_masks), model_histograms, consensus_histogram
+        ))
+
+        if surface_tolerance is not None:
+            results["surface"].extend(surface_metric_rows(
+                series_uid,
+                structure_name,
+                list(model_masks) + ["Consensus"],
+                mask_arrays + [sitk.GetArrayViewFromImage(overlap)],
+                reference_image.GetSpacing(),
+                surface_tolerance
+            ))
+
+    return results
+
+
+def init_worker(sitk_threads):
+    # Split the cores between the worker processes instead of letting every SimpleITK filter use all of them
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(sitk_threads)
+
+
+def run_isolated(process_case, ct_path, sitk_threads):
+    # Run one case in a pool of its own, so that a crashing worker can only take this case down
+    with ProcessPoolExecutor(max_workers=1, initializer=init_worker, initargs=(sitk_threads,)) as executor:
+        return executor.submit(process_case, ct_path).result()
+
+
+def run_ct_folders(ct_paths, process_case, on_result, workers=1):
+    """
+    Run `process_case` for every CT folder, serially or in a process pool.
+
+    `process_case` returns a dictionary of result rows per output table, which is passed to
+    `on_result(ct_path, case_results)` in the main process. Results are handed over in the
+    order of `ct_paths`, independent of the order in which the workers finish, so that a
+    parallel run produces the same output as a serial run, and are not kept in memory
+    afterwards. At most two cases per worker are submitted ahead of the oldest unfinished
+    one, so finished results never pile up behind a slow case. A case that raises is
+    reported and skipped.
+
+    If a worker process dies (e.g. killed for running out of memory), the pool is broken for
+    every case in flight. Those cases are rerun one at a time in a fresh process, so only the
+    case that crashes again is reported as failed, and the remaining cases continue in a new pool.
+
+    Returns:
+        The CT folders that could not be processed.
+    """
+    failed_cases = []
+
+    def hand_over(ct_path, get_results):
+        try:
+            on_result(ct_path, get_results())
+        except BrokenProcessPool:
+            print(f"Error processing {ct_path}: the worker process died")
+            failed_cases.append(ct_path)
+        except Exception as e:
+            print(f"Error processing {ct_path}: {e}")
+            failed_cases.append(ct_path)
+
+    if workers <= 1:
+        for ct_path in ct_paths:
+            hand_over(ct_path, partial(process_case, ct_path))
+        return failed_cases
+
+    sitk_threads = max(1, (os.cpu_count() or 1) // workers)
+    max_in_flight = 2 * workers
+    remaining = deque(ct_paths)
+    while remaining:
+        pending = deque()
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=init_worker, initargs=(sitk_threads,)
+        ) as executor:
+            try:
+                while remaining or pending:
+                    while remaining and len(pending) < max_in_flight:
+                        pending.append((remaining[0], executor.submit(process_case, remaining[0])))
+                        remaining.popleft()
+                    ct_path, future = pending[0]
+                    if isinstance(future.exception(), BrokenProcessPool):
+                        raise future.exception()
+                    pending.popleft()
+                    hand_over(ct_path, future.result)
+            except BrokenProcessPool:
+                print(f"A worker process died, rerunning the {len(pending)} case(s) in flight one at a time")
+
+        # Cases that finished before the pool broke keep their results, the others are rerun in isolation
+        for ct_path, future in pending:
+            if future.done() and not isinstance(future.exception(), BrokenProcessPool):
+                hand_over(ct_path, future.result)
+            else:
+                hand_over(ct_path, partial(run_isolated, process_case, ct_path, sitk_threads))
+    return failed_cases
+
+
+def process_ct_folders(
+    base_folder, output_nii, csv_file, segimage2itkimage_path=None, workers=1, crop_to_structure=True,
+    kernel="numpy", labelmap=False, rerun_all=False, surface_tolerance=None, consensus_format="nii.gz",
+    write_votes=False, index_dir=None
+):
+    """
+    Compute consensus masks and Dice scores for all CT series under `base_folder` and save the results.
+
+    The result rows of each CT series are written to the long-format results store in
+    `<output_nii>/results` (one Parquet file per table and CT series) as soon as the series
+    is finished, so a crash does not lose finished cases. The Dice pivot CSV is built from
+    the store at the end.
+
+    Each CT series is recorded in a manifest in `output_nii`, together with a hash of the SEG
+    files, the structure CSV and the analysis code. A CT series whose inputs did not change
+    since the last run is not processed again and keeps its stored results. Pass
+    `rerun_all` to ignore the manifest.
+
+    Vote-count volumes are always written in the per-structure mode; in `labelmap` mode only
+    if `write_votes` is set.
+
+    The CT folders are read from the series index of `base_folder` (see series_index.py), which
+    is stored in `index_dir` (default: `output_nii`), so the input tree is not modified.
+    """
+    df_structures = pd.read_csv(csv_file, delimiter=",")
+    # structures that are segmented by 4 or more models
+    structures_list = (df_structures[df_structures["count"] >= 4]["final_label"].str.lower().tolist()
+    )
+
+    ct_paths = find_ct_folders(load_series_index(base_folder, index_dir=index_dir or output_nii))
+    store_folder = os.path.join(output_nii, RESULTS_FOLDER)
+
+    manifest = empty_manifest() if rerun_all else load_manifest(output_nii)
+    settings = {
+        "structure_csv": file_sha256(csv_file),
+        "code_version": code_version(),
+        "labelmap": labelmap,
+        "votes": write_votes or not labelmap,
+        # The SEG files are decoded in-process or converted with dcmqi, which may differ in edge cases
+        "seg_decoder": "segimage2itkimage" if segimage2itkimage_path else "native",
+        "surface_tolerance": surface_tolerance,
+        "consensus_format": consensus_format,
+    }
+
+    def case_key(ct_path):
+        return os.path.relpath(ct_path, base_folder)
+
+    input_hashes = {}
+    pending_paths = []
+    for ct_path in ct_paths:
+        input_hashes[ct_path] = case_input_hash(
+            find_segmentation_files(ct_path), settings, manifest["file_hashes"]
+        )
+        if not is_case_current(manifest, case_key(ct_path), input_hashes[ct_path], output_nii):
+            pending_paths.append(ct_path)
+
+    # Forget cases that are no longer part of the cohort, and drop the outdated results of the others
+    current_keys = {case_key(ct_path) for ct_path in ct_paths}
+    manifest["cases"] = {key: entry for key, entry in manifest["cases"].items() if key in current_keys}
+    prune_results(store_folder, [case_key(ct_path) for ct_path in ct_paths])
+    for ct_path in pending_paths:
+        manifest["cases"].pop(case_key(ct_path), None)
+        remove_case_results(store_folder, case_key(ct_path))
+    save_manifest(output_nii, manifest)
+    print(
+        f"{len(ct_paths) - len(pending_paths)} of {len(ct_paths)} CT series unchanged since the last run, "
+        f"processing {len(pending_paths)}"
+    )
+
+    def record_case(ct_path, case_results):
+        result_files = write_case_results(store_folder, case_key(ct_path), case_results)
+        manifest["cases"][case_key(ct_path)] = {
+            "input_hash": input_hashes[ct_path],
+            "outputs": list_outputs(os.path.join(output_nii, case_key(ct_path)), output_nii) + [
+                os.path.relpath(path, output_nii) for path in result_files
+            ],
+        }
+        save_manifest(output_nii, manifest)
+
+    if labelmap:
+        process_case = partial(
+            process_ct_folder_labelmap,
+            base_folder=base_folder,
+            output_nii=output_nii,
+            structures_list=structures_list,
+            segimage2itkimage_path=segimage2itkimage_path,
+            surface_tolerance=surface_tolerance,
+            consensus_format=consensus_format,
+            write_votes=write_votes,
+        )
+    else:
+        process_case = partial(
+            process_ct_folder,
+            base_folder=base_folder,
+            output_nii=output_nii,
+            structures_list=structures_list,
+            segimage2itkimage_path=segimage2itkimage_path,
+            crop_to_structure=crop_to_structure,
+            kernel=kernel,
+            surface_tolerance=surface_tolerance,
+            consensus_format=consensus_format,
+        )
+    failed_cases = run_ct_folders(pending_paths, process_case, record_case, workers=workers)
+
+    if failed_cases:
+        print(f"{len(failed_cases)} CT folder(s) failed and were skipped:")
+        for ct_path in failed_cases:
+            print(f"  {ct_path}")
     
     # Aggregate and save Dice scores
-    if results:
-        df_results = pd.DataFrame(results)
+    df_results = read_results(
+        store_folder,
+        "dice",
+        case_names=[case_key(ct_path) for ct_path in ct_paths],
+        columns=["CT_SeriesInstanceUID", "Structure", "Model", "Dice_Score"]
+    )
+    if not df_results.empty:
+        print(f"Long-format results saved to: {store_folder}")
         df_pivot = df_results.pivot_table(
             values="Dice_Score",
             index=["Structure"],
@@ -229,14 +1175,91 @@ def process_ct_folders(base_folder, output_nii, csv_file, segimage2itkimage_path
         return None
 
 
-if __name__ == "__main__":
-    if len(sys.argv) != 5:
-        print("Usage: python script.py <base_folder> <output_nii_folder> <csv_file> <segimage2itkimage_path>")
-        sys.exit(1)
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compute consensus segmentations and Dice scores across segmentation models."
+    )
+    parser.add_argument("base_folder", help="Base directory containing the DICOM SEG files per CT series")
+    parser.add_argument("output_nii", help="Output directory for consensus NIfTI masks and the Dice CSV")
+    parser.add_argument("csv_file", help="Structure overview CSV")
+    parser.add_argument(
+        "segimage2itkimage_path",
+        nargs="?",
+        default=None,
+        help="Optional path to dcmqi segimage2itkimage. If omitted, SEG files are decoded in-process."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of CT series processed in parallel, one series per worker process (default: 1)"
+    )
+    parser.add_argument(
+        "--no-crop",
+        action="store_true",
+        help="Compute consensus and Dice scores on the full reference volume instead of the structure bounding box"
+    )
+    parser.add_argument(
+        "--kernel",
+        choices=["numpy", "sitk", "validate"],
+        default="numpy",
+        help="Consensus/Dice implementation: vectorized NumPy kernel, SimpleITK filters, "
+             "or both with a bit-for-bit comparison (default: numpy)"
+    )
+    parser.add_argument(
+        "--labelmap",
+        action="store_true",
+        help="Load each model once as a label map and compute all structures in one pass "
+             "(--no-crop and --kernel do not apply)"
+    )
+    parser.add_argument(
+        "--votes",
+        action="store_true",
+        help="In --labelmap mode, also write the vote-count volume of every structure "
+             "(always written in the default mode)"
+    )
+    parser.add_argument(
+        "--surface-tolerance",
+        type=float,
+        default=None,
+        metavar="MM",
+        help="Also compute HD95, ASSD and surface Dice, using this tolerance in mm for the surface Dice"
+    )
+    parser.add_argument(
+        "--consensus-format",
+        choices=list(CONSENSUS_FORMATS),
+        default="nii.gz",
+        help="File format of the consensus masks and vote-count volumes: gzip-compressed NIfTI, "
+             "uncompressed NIfTI, NIfTI gzip-compressed in parallel threads, or bit-packed .npz (default: nii.gz)"
+    )
+    parser.add_argument(
+        "--index-dir",
+        default=None,
+        help="Directory in which the series index of base_folder is stored (default: output_nii)"
+    )
+    parser.add_argument(
+        "--rerun-all",
+        action="store_true",
+        help="Ignore the results of previous runs and process every CT series again"
+    )
+    return parser.parse_args()
 
-    base_folder = sys.argv[1]
-    output_nii = sys.argv[2]
-    csv_file = sys.argv[3]
-    segimage2itkimage_path = sys.argv[4]
 
-    process_ct_folders(base_folder, output_nii, csv_file, segimage2itkimage_path)
+if __name__ == "__main__":
+    args = parse_args()
+
+    process_ct_folders(
+        args.base_folder,
+        args.output_nii,
+        args.csv_file,
+        args.segimage2itkimage_path,
+        workers=args.workers,
+        crop_to_structure=not args.no_crop,
+        kernel=args.kernel,
+        labelmap=args.labelmap,
+        rerun_all=args.rerun_all,
+        surface_tolerance=args.surface_tolerance,
+        consensus_format=args.consensus_format,
+        write_votes=args.votes,
+        index_dir=args.index_dir,
+    )
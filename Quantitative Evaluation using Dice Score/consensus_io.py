@@ -0,0 +1,134 @@
+# Output formats for the consensus masks and vote-count volumes
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import SimpleITK as sitk
+
+
+# Format name -> file extension
+CONSENSUS_FORMATS = {
+    "nii.gz": ".nii.gz",
+    "nii": ".nii",
+    "nii.gz-threaded": ".nii.gz",
+    "bitpacked": ".npz",
+}
+
+# Consensus mask files are named <structure_name><CONSENSUS_MASK_SUFFIX><extension>, in any of CONSENSUS_FORMATS
+CONSENSUS_MASK_SUFFIX = "_overlap"
+CONSENSUS_SUFFIXES = tuple(dict.fromkeys(CONSENSUS_MASK_SUFFIX + extension for extension in CONSENSUS_FORMATS.values()))
+
+# Uncompressed bytes per gzip member in the threaded writer
+GZIP_BLOCK_SIZE = 4 * 1024 * 1024
+GZIP_LEVEL = 1
+
+
+def _gzip_member(block):
+    # Each block is an independent gzip member; concatenated members form a valid gzip stream
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush()
+
+
+def consensus_structure_name(file_name):
+    # Structure name of a consensus mask file, or None if the file is not one
+    for suffix in CONSENSUS_SUFFIXES:
+        if file_name.endswith(suffix):
+            return file_name[:-len(suffix)]
+    return None
+
+
+def write_nifti_gzip_threaded(image, path, threads=None):
+    """
+    Write a .nii.gz file, compressing blocks of the NIfTI stream in parallel threads.
+
+    zlib releases the GIL while compressing, so the blocks are compressed concurrently. The
+    result is a multi-member gzip file, which NIfTI readers (ITK, nibabel, gzip) read like
+    any other .nii.gz file. The uncompressed NIfTI is read back one batch of blocks per thread
+    at a time, and the output is written to a temporary file that replaces `path` when complete.
+    """
+    threads = max(1, threads or sitk.ProcessObject.GetGlobalDefaultNumberOfThreads())
+    nifti_path = f"{path[:-len('.nii.gz')]}.tmp.nii"
+    temp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    sitk.WriteImage(image, nifti_path, useCompression=False)
+    try:
+        with open(nifti_path, "rb") as source, open(temp_path, "wb") as target, \
+                ThreadPoolExecutor(max_workers=threads) as executor:
+            while True:
+                blocks = [block for block in (source.read(GZIP_BLOCK_SIZE) for _ in range(threads)) if block]
+                if not blocks:
+                    break
+                for member in executor.map(_gzip_member, blocks):
+                    target.write(member)
+        os.replace(temp_path, path)
+    finally:
+        for leftover in (nifti_path, temp_path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+def write_bitpacked(image, path):
+    """
+    Write an integer image as bit planes packed 8 voxels per byte, together with its geometry.
+
+    A binary mask needs a single bit plane (1 bit per voxel); a vote-count volume of N models
+    needs ceil(log2(N + 1)) planes. The file is an uncompressed NumPy .npz archive.
+    """
+    array = sitk.GetArrayViewFromImage(image)
+    num_planes = max(1, int(array.max()).bit_length()) if array.size else 1
+    planes = np.stack([np.packbits(((array >> plane) & 1).reshape(-1)) for plane in range(num_planes)])
+    np.savez(
+        path,
+        planes=planes,
+        shape=np.array(array.shape),
+        origin=np.array(image.GetOrigin()),
+        spacing=np.array(image.GetSpacing()),
+        direction=np.array(image.GetDirection()),
+    )
+
+
+def read_bitpacked(path):
+    # Inverse of write_bitpacked, returning a UInt8 SimpleITK image
+    with np.load(path) as container:
+        shape = tuple(int(v) for v in container["shape"])
+        num_voxels = int(np.prod(shape))
+        array = np.zeros(num_voxels, dtype=np.uint8)
+        for plane, bits in enumerate(container["planes"]):
+            array |= np.unpackbits(bits, count=num_voxels) << plane
+        image = sitk.GetImageFromArray(array.reshape(shape))
+        image.SetOrigin(tuple(container["origin"]))
+        image.SetSpacing(tuple(container["spacing"]))
+        image.SetDirection(tuple(container["direction"]))
+    return image
+
+
+def write_consensus_image(image, path_stem, output_format="nii.gz"):
+    """
+    Write a consensus mask or vote-count volume in one of CONSENSUS_FORMATS.
+
+    Args:
+        image: UInt8 SimpleITK image.
+        path_stem: Output path without extension, e.g. ".../heart_overlap".
+        output_format: "nii.gz" (gzip, single-threaded), "nii" (uncompressed and
+            memory-mappable), "nii.gz-threaded" (gzip compressed in parallel threads) or
+            "bitpacked" (bit planes in an .npz archive).
+
+    Returns:
+        The path of the written file.
+    """
+    path = path_stem + CONSENSUS_FORMATS[output_format]
+    # Remove a file of the same consensus left in another format by an earlier run
+    for extension in set(CONSENSUS_FORMATS.values()) - {CONSENSUS_FORMATS[output_format]}:
+        if os.path.exists(path_stem + extension):
+            os.remove(path_stem + extension)
+
+    if output_format == "nii.gz":
+        sitk.WriteImage(image, path)
+    elif output_format == "nii":
+        sitk.WriteImage(image, path, useCompression=False)
+    elif output_format == "nii.gz-threaded":
+        write_nifti_gzip_threaded(image, path)
+    else:
+        write_bitpacked(image, path)
+    return path
+
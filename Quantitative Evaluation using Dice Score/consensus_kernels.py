@@ -0,0 +1,191 @@
+# Vectorized NumPy kernels for consensus masks and overlap counts
+import numpy as np
+
+
+if hasattr(np, "bitwise_count"):
+    def popcount(packed):
+        return np.bitwise_count(packed)
+else:
+    _POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def popcount(packed):
+        return _POPCOUNT_TABLE[packed]
+
+
+def pack_masks(masks):
+    # Stack binary masks as one bit-packed row per mask, shape (N, ceil(voxels / 8))
+    return np.stack([np.packbits(np.asarray(mask).reshape(-1) != 0) for mask in masks])
+
+
+def consensus_and_overlap_counts(masks, bitpack=True):
+    """
+    Compute the AND consensus of N binary masks and the voxel counts needed for Dice in one pass.
+
+    Args:
+        masks: Sequence of equally shaped arrays; non-zero voxels are inside the mask.
+        bitpack: Operate on masks packed with np.packbits (8 voxels per byte) instead of
+            one byte per voxel.
+
+    Returns:
+        A tuple (consensus, intersection_counts, mask_counts, consensus_count) with the boolean
+        consensus mask, the per-mask number of voxels shared with the consensus, the per-mask
+        voxel counts and the consensus voxel count.
+    """
+    shape = np.asarray(masks[0]).shape
+    num_voxels = int(np.prod(shape))
+
+    if bitpack:
+        packed = pack_masks(masks)
+        consensus_packed = np.bitwise_and.reduce(packed, axis=0)
+        mask_counts = popcount(packed).sum(axis=1, dtype=np.int64)
+        intersection_counts = popcount(packed & consensus_packed).sum(axis=1, dtype=np.int64)
+        consensus_count = int(popcount(consensus_packed).sum(dtype=np.int64))
+        consensus = np.unpackbits(consensus_packed, count=num_voxels).astype(bool).reshape(shape)
+    else:
+        stack = np.stack([np.asarray(mask).reshape(-1) != 0 for mask in masks])
+        consensus_flat = np.logical_and.reduce(stack, axis=0)
+        mask_counts = stack.sum(axis=1, dtype=np.int64)
+        intersection_counts = (stack & consensus_flat).sum(axis=1, dtype=np.int64)
+        consensus_count = int(consensus_flat.sum(dtype=np.int64))
+        consensus = consensus_flat.reshape(shape)
+
+    return consensus, intersection_counts, mask_counts, consensus_count
+
+
+def dice_from_counts(intersection_count, mask_count, reference_count):
+    # Evaluated as 2J / (1 + J) from the Jaccard index J, exactly like sitk.LabelOverlapMeasuresImageFilter,
+    # so the floating point result is bit-identical (including inf when both masks are empty)
+    union_count = float(mask_count + reference_count - intersection_count)
+    if union_count == 0:
+        return float("inf")
+    jaccard = float(intersection_count) / union_count
+    return 2.0 * jaccard / (1.0 + jaccard)
+
+
+def labelmap_consensus(label_maps, required_votes, reference_index):
+    """
+    Compute the consensus label map of N harmonized label maps in one vectorized pass over the models.
+
+    A voxel gets label s if every model that segments s assigns s to it. Since the reference
+    model segments every evaluated label, only its label can reach agreement at a voxel, so the
+    votes for it are accumulated once over all models instead of once per candidate label.
+
+    Args:
+        label_maps: Sequence of equally shaped integer arrays using the same label codes.
+        required_votes: Array indexed by label code with the number of models segmenting
+            that label (0 for labels that are not evaluated).
+        reference_index: Index of the label map of a model that segments every evaluated label.
+
+    Returns:
+        The consensus label map (0 where the models do not agree).
+    """
+    candidate = label_maps[reference_index]
+    votes = np.zeros(candidate.shape, dtype=np.uint8)
+    for label_map in label_maps:
+        votes += label_map == candidate
+    # The reference always votes for its own label, so the background (0 required votes) never agrees
+    return np.where(votes == required_votes[candidate], candidate, 0).astype(candidate.dtype, copy=False)
+
+
+def joint_label_counts(label_map, consensus, num_labels):
+    # Joint histogram of (model label, consensus label) codes from a single bincount
+    combined = label_map.astype(np.int64).reshape(-1) * num_labels + consensus.reshape(-1)
+    return np.bincount(combined, minlength=num_labels * num_labels).reshape(num_labels, num_labels)
+
+
+def pairwise_intersection_counts(masks):
+    """
+    Count the voxels shared by every pair of N binary masks.
+
+    Each mask is bit-packed once and every unordered pair is intersected once on the packed
+    rows, so the N x N matrix costs N (N + 1) / 2 AND + popcount passes over 1/8 of the voxels.
+
+    Returns:
+        A symmetric (N, N) int64 array; the diagonal holds the voxel count of each mask.
+    """
+    packed = pack_masks(masks)
+    num_masks = len(packed)
+    counts = np.zeros((num_masks, num_masks), dtype=np.int64)
+    for i in range(num_masks):
+        row = popcount(packed[i] & packed[i:]).sum(axis=1, dtype=np.int64)
+        counts[i, i:] = row
+        counts[i:, i] = row
+    return counts
+
+
+def pairwise_label_intersection_counts(label_maps, num_labels):
+    """
+    Count, for every pair of label maps and every label code, the voxels both maps assign to that label.
+
+    Returns:
+        A symmetric (N, N, num_labels) int64 array; entry [i, i] holds the label histogram of map i.
+    """
+    flat_maps = [np.asarray(label_map).reshape(-1) for label_map in label_maps]
+    num_maps = len(flat_maps)
+    counts = np.zeros((num_maps, num_maps, num_labels), dtype=np.int64)
+    for i in range(num_maps):
+        counts[i, i] = np.bincount(flat_maps[i], minlength=num_labels)[:num_labels]
+        for j in range(i + 1, num_maps):
+            shared = flat_maps[i][flat_maps[i] == flat_maps[j]]
+            counts[i, j] = counts[j, i] = np.bincount(shared, minlength=num_labels)[:num_labels]
+    return counts
+
+
+def vote_counts(masks):
+    # Number of masks covering each voxel, accumulated in a single uint8 volume (up to 255 masks)
+    votes = np.zeros(np.asarray(masks[0]).shape, dtype=np.uint8)
+    for mask in masks:
+        votes += np.asarray(mask) != 0
+    return votes
+
+
+def vote_histograms(masks, votes):
+    """
+    Histogram the vote counts inside each mask and over the whole volume.
+
+    Returns:
+        A tuple (model_histograms, consensus_histogram): an (N, N + 1) array with, for each
+        mask, the number of its voxels that received 0..N votes, and an (N + 1,) array with
+        the number of voxels of the volume that received 0..N votes.
+    """
+    num_levels = len(masks) + 1
+    model_histograms = np.stack([
+        np.bincount(votes[np.asarray(mask) != 0], minlength=num_levels)[:num_levels] for mask in masks
+    ]).astype(np.int64)
+    consensus_histogram = np.bincount(votes.reshape(-1), minlength=num_levels)[:num_levels].astype(np.int64)
+    return model_histograms, consensus_histogram
+
+
+def labelmap_vote_histograms(label_maps, num_labels):
+    """
+    Histogram the vote counts of every label for N harmonized label maps.
+
+    At each voxel, the vote count of a label is the number of label maps assigning that label.
+
+    Returns:
+        A tuple (model_histograms, consensus_histogram): an (N, num_labels, N + 1) array with,
+        for each map and label, the number of voxels of that label that received 0..N votes,
+        and a (num_labels, N + 1) array with the number of voxels where the label received
+        0..N votes (every voxel counted once per label, bin 0 is not filled).
+    """
+    num_maps = len(label_maps)
+    num_levels = num_maps + 1
+    model_histograms = np.zeros((num_maps, num_labels, num_levels), dtype=np.int64)
+    consensus_histogram = np.zeros((num_labels, num_levels), dtype=np.int64)
+    for i, candidate in enumerate(label_maps):
+        votes = np.zeros(candidate.shape, dtype=np.uint8)
+        # A voxel is added to the consensus histogram by the first map assigning its label
+        first = np.ones(candidate.shape, dtype=bool)
+        for j, label_map in enumerate(label_maps):
+            same = label_map == candidate
+            votes += same
+            if j < i:
+                first &= ~same
+        combined = candidate.astype(np.int64).reshape(-1) * num_levels + votes.reshape(-1)
+        model_histograms[i] = np.bincount(
+            combined, minlength=num_labels * num_levels
+        ).reshape(num_labels, num_levels)
+        consensus_histogram += np.bincount(
+            combined[first.reshape(-1)], minlength=num_labels * num_levels
+        ).reshape(num_labels, num_levels)
+    return model_histograms, consensus_histogram
@@ -0,0 +1,248 @@
+# In-process decoding of DICOM SEG files into binary masks and label maps
+import numpy as np
+import pydicom
+import SimpleITK as sitk
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
+
+
+# Transfer syntaxes whose PixelData can be read frame by frame straight from the file
+NATIVE_TRANSFER_SYNTAXES = (ExplicitVRLittleEndian, ImplicitVRLittleEndian)
+
+
+def normalize_segment_name(segment_description):
+    """Normalize a segment description the same way as the dcmqi meta.json labels."""
+    return (
+        str(segment_description)
+        .split(":")[-1]
+        .strip()
+        .lower()
+        .replace(" ", "_")
+    )
+
+
+def _functional_group_item(ds, frame_group, sequence_name):
+    # Per-frame values take precedence over the shared functional groups
+    if frame_group is not None and sequence_name in frame_group:
+        return frame_group[sequence_name].value[0]
+    shared = ds.get("SharedFunctionalGroupsSequence")
+    if shared and sequence_name in shared[0]:
+        return shared[0][sequence_name].value[0]
+    return None
+
+
+def compute_seg_geometry(ds):
+    """
+    Compute the volume grid spanned by all frames of a SEG and the slice index of every frame.
+
+    Returns:
+        A dictionary with origin, spacing, direction (SimpleITK conventions), size as
+        (slices, rows, columns) and the slice index of each frame.
+    """
+    per_frame = ds.PerFrameFunctionalGroupsSequence
+    first_frame = per_frame[0] if len(per_frame) else None
+
+    orientation = np.array(
+        _functional_group_item(ds, first_frame, "PlaneOrientationSequence").ImageOrientationPatient,
+        dtype=float
+    )
+    row_direction = orientation[:3]
+    column_direction = orientation[3:]
+    normal = np.cross(row_direction, column_direction)
+
+    pixel_measures = _functional_group_item(ds, first_frame, "PixelMeasuresSequence")
+    row_spacing, column_spacing = (float(v) for v in pixel_measures.PixelSpacing)
+
+    positions = np.array(
+        [
+            _functional_group_item(ds, frame_group, "PlanePositionSequence").ImagePositionPatient
+            for frame_group in per_frame
+        ],
+        dtype=float
+    ).reshape(-1, 3)
+    projections = positions @ normal
+
+    unique_projections = np.unique(np.round(projections, 4))
+    slice_spacing = pixel_measures.get("SpacingBetweenSlices")
+    if slice_spacing:
+        slice_spacing = float(slice_spacing)
+    elif len(unique_projections) > 1:
+        slice_spacing = float(np.min(np.diff(unique_projections)))
+    else:
+        slice_spacing = float(pixel_measures.get("SliceThickness") or 1.0)
+
+    first_slice = int(np.argmin(projections))
+    slice_indices = np.rint((projections - projections[first_slice]) / slice_spacing).astype(int)
+    num_slices = int(slice_indices.max()) + 1 if len(slice_indices) else 1
+
+    return {
+        "origin": tuple(positions[first_slice]) if len(positions) else (0.0, 0.0, 0.0),
+        "spacing": (column_spacing, row_spacing, slice_spacing),
+        "direction": tuple(np.column_stack([row_direction, column_direction, normal]).ravel()),
+        "size": (num_slices, int(ds.Rows), int(ds.Columns)),
+        "slice_indices": slice_indices,
+    }
+
+
+def index_seg_file(seg_file, structures=None):
+    """
+    Read the header of a DICOM SEG and index its frames by segment.
+
+    The pixel data is not loaded. Only segments whose normalized name is in `structures`
+    are indexed (all segments if `structures` is None).
+
+    Returns:
+        A dictionary holding the dataset, its geometry and a mapping from structure name
+        to the frame numbers (0-based) of that segment.
+    """
+    ds = pydicom.dcmread(seg_file, defer_size="1 KB")
+
+    segment_names = {}
+    for segment in ds.SegmentSequence:
+        description = segment.get("SegmentDescription") or segment.get("SegmentLabel", "")
+        name = normalize_segment_name(description)
+        if structures is None or name in structures:
+            segment_names[int(segment.SegmentNumber)] = name
+
+    segments = {name: [] for name in segment_names.values()}
+    for frame_number, frame_group in enumerate(ds.PerFrameFunctionalGroupsSequence):
+        segment_number = int(
+            frame_group.SegmentIdentificationSequence[0].ReferencedSegmentNumber
+        )
+        if segment_number in segment_names:
+            segments[segment_names[segment_number]].append(frame_number)
+
+    return {
+        "file": seg_file,
+        "dataset": ds,
+        "geometry": compute_seg_geometry(ds),
+        "segments": segments,
+    }
+
+
+def _read_native_frame_range(seg_index, first, last):
+    # Read only the byte range that covers frames first..last from the PixelData element
+    ds = seg_index["dataset"]
+    rows, columns = int(ds.Rows), int(ds.Columns)
+    frame_size = rows * columns
+    bits_allocated = int(ds.BitsAllocated)
+
+    start_bit = first * frame_size * bits_allocated
+    end_bit = (last + 1) * frame_size * bits_allocated
+    start_byte, end_byte = start_bit // 8, -(-end_bit // 8)
+
+    element = ds.get_item("PixelData")
+    if getattr(element, "value", None) is None and hasattr(element, "value_tell"):
+        with open(seg_index["file"], "rb") as f:
+            f.seek(element.value_tell + start_byte)
+            buffer = f.read(end_byte - start_byte)
+    else:
+        buffer = bytes(ds.PixelData[start_byte:end_byte])
+
+    if bits_allocated == 1:
+        bits = np.unpackbits(np.frombuffer(buffer, dtype=np.uint8), bitorder="little")
+        bit_offset = start_bit - start_byte * 8
+        values = bits[bit_offset:bit_offset + (last - first + 1) * frame_size]
+    else:
+        values = np.frombuffer(buffer, dtype=np.uint8)
+
+    return values.reshape(-1, rows, columns)
+
+
+def _iter_native_frames(seg_index, frame_numbers, chunk_frames=64):
+    # Decode the requested frames in chunks of at most `chunk_frames` consecutive frames
+    frame_numbers = sorted(frame_numbers)
+    chunk_start = 0
+    while chunk_start < len(frame_numbers):
+        first = frame_numbers[chunk_start]
+        chunk_end = chunk_start
+        while chunk_end + 1 < len(frame_numbers) and frame_numbers[chunk_end + 1] - first < chunk_frames:
+            chunk_end += 1
+        frames = _read_native_frame_range(seg_index, first, frame_numbers[chunk_end])
+        for frame_number in frame_numbers[chunk_start:chunk_end + 1]:
+            yield frame_number, frames[frame_number - first]
+        chunk_start = chunk_end + 1
+
+
+def _iter_encapsulated_frames(seg_index, frame_numbers):
+    # Compressed transfer syntaxes are decoded by pydicom's pixel data handlers
+    pixel_array = seg_index["dataset"].pixel_array
+    if pixel_array.ndim == 2:
+        pixel_array = pixel_array[np.newaxis]
+    for frame_number in sorted(frame_numbers):
+        yield frame_number, pixel_array[frame_number]
+
+
+def _iter_frames(seg_index, frame_numbers):
+    if seg_index["dataset"].file_meta.TransferSyntaxUID in NATIVE_TRANSFER_SYNTAXES:
+        return _iter_native_frames(seg_index, frame_numbers)
+    return _iter_encapsulated_frames(seg_index, frame_numbers)
+
+
+def _image_on_seg_grid(array, geometry):
+    image = sitk.GetImageFromArray(array)
+    image.SetOrigin(geometry["origin"])
+    image.SetSpacing(geometry["spacing"])
+    image.SetDirection(geometry["direction"])
+    return image
+
+
+def decode_segment(seg_index, structure_name):
+    """
+    Decode the frames of one segment into a binary SimpleITK image on the SEG grid.
+
+    Returns:
+        A UInt8 SimpleITK image (1 inside the segment), or None if the segment is not indexed.
+    """
+    if structure_name not in seg_index["segments"]:
+        return None
+
+    geometry = seg_index["geometry"]
+    mask = np.zeros(geometry["size"], dtype=np.uint8)
+    frame_numbers = seg_index["segments"][structure_name]
+
+    if frame_numbers:
+        for frame_number, frame in _iter_frames(seg_index, frame_numbers):
+            slice_index = geometry["slice_indices"][frame_number]
+            mask[slice_index] |= (frame > 0).astype(np.uint8)
+
+    return _image_on_seg_grid(mask, geometry)
+
+
+def decode_label_map(seg_index, label_codes, dtype=np.uint16):
+    """
+    Decode all indexed segments into one label map on the SEG grid.
+
+    Args:
+        seg_index: Result of index_seg_file.
+        label_codes: Dictionary mapping structure name to the label value to use. Segments
+            without a code are ignored.
+        dtype: Integer NumPy dtype of the label map.
+
+    Returns:
+        A tuple (label_map, overlapping) with the SimpleITK label map image and the set of
+        structures that lost voxels to another segment. Where segments overlap, the segment
+        stored in the later frame wins, so only the structures not in `overlapping` are complete.
+    """
+    geometry = seg_index["geometry"]
+    label_map = np.zeros(geometry["size"], dtype=dtype)
+
+    frame_codes = {
+        frame_number: label_codes[structure_name]
+        for structure_name, frame_numbers in seg_index["segments"].items()
+        if structure_name in label_codes
+        for frame_number in frame_numbers
+    }
+    overwritten_codes = set()
+    if frame_codes:
+        for frame_number, frame in _iter_frames(seg_index, list(frame_codes)):
+            slice_index = geometry["slice_indices"][frame_number]
+            code = frame_codes[frame_number]
+            foreground = frame > 0
+            previous = label_map[slice_index][foreground]
+            overwritten_codes.update(np.unique(previous[(previous != 0) & (previous != code)]).tolist())
+            label_map[slice_index][foreground] = code
+
+    overlapping = {
+        structure_name for structure_name, code in label_codes.items() if code in overwritten_codes
+    }
+    return _image_on_seg_grid(label_map, geometry), overlapping
@@ -0,0 +1,95 @@
+# Long-format columnar results store: one Parquet file per result table and CT series
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+RESULTS_FOLDER = "results"
+
+
+def case_results_file(store_folder, table, case_name):
+    # `case_name` is the path of the CT folder relative to the input base folder, mirrored under each table
+    return os.path.join(store_folder, table, f"{case_name}.parquet")
+
+
+def write_case_results(store_folder, case_name, case_results):
+    """
+    Write the result rows of one CT series, one Parquet file per table.
+
+    Each file is written to a hidden temporary file first and then renamed, so a crash never
+    leaves a partial file behind and the results of finished cases are never lost.
+
+    Returns:
+        The paths of the written files.
+    """
+    written_files = []
+    for table, rows in case_results.items():
+        path = case_results_file(store_folder, table, case_name)
+        if not rows:
+            if os.path.exists(path):
+                os.remove(path)
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Files starting with "." are skipped when the table folder is read as a dataset
+        temp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+        pq.write_table(pa.Table.from_pylist(rows), temp_path)
+        os.replace(temp_path, path)
+        written_files.append(path)
+    return written_files
+
+
+def remove_case_results(store_folder, case_name):
+    # Remove the results of one CT series from every table
+    if not os.path.isdir(store_folder):
+        return
+    for table in os.listdir(store_folder):
+        path = case_results_file(store_folder, table, case_name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def prune_results(store_folder, case_names):
+    # Remove the results of all CT series that are not in `case_names`
+    if not os.path.isdir(store_folder):
+        return
+    for table in os.listdir(store_folder):
+        keep_files = {os.path.normpath(case_results_file(store_folder, table, case_name)) for case_name in case_names}
+        for root, _, files in os.walk(os.path.join(store_folder, table)):
+            for file_name in files:
+                path = os.path.normpath(os.path.join(root, file_name))
+                if path not in keep_files:
+                    os.remove(path)
+
+
+def read_results(store_folder, table, case_names=None, columns=None):
+    """
+    Read one result table of the store into a DataFrame.
+
+    Args:
+        store_folder: Folder containing one subfolder per table.
+        table: Name of the table, e.g. "dice".
+        case_names: Optional CT series to read, in this order (all series if None).
+        columns: Optional subset of columns to read.
+
+    Returns:
+        A DataFrame, empty if the table holds no results.
+    """
+    table_folder = os.path.join(store_folder, table)
+    if case_names is None:
+        case_names = sorted(
+            os.path.relpath(os.path.join(root, f), table_folder)[:-len(".parquet")]
+            for root, _, files in os.walk(table_folder)
+            for f in files
+            if f.endswith(".parquet") and not f.startswith(".")
+        )
+
+    tables = [
+        pq.read_table(path, columns=columns)
+        for path in (case_results_file(store_folder, table, case_name) for case_name in case_names)
+        if os.path.exists(path)
+    ]
+    if not tables:
+        return pd.DataFrame(columns=columns)
+    return pa.concat_tables(tables).to_pandas()
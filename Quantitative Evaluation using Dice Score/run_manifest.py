@@ -0,0 +1,121 @@
+# Content-hash manifest that lets a rerun skip CT series whose inputs did not change
+import hashlib
+import json
+import os
+
+
+MANIFEST_FILE = "dice_manifest.json"
+MANIFEST_VERSION = 2
+
+# Source files whose content determines the results, relative to this folder: the analysis script and every module
+# it imports (including label_maps.py and series_index.py in the repository root). A change to any of them
+# invalidates all cases
+CODE_FILES = (
+    "analyze_disagreement_dice_score.py", "consensus_io.py", "consensus_kernels.py", "dicom_seg_decoder.py",
+    "results_store.py", "run_manifest.py", "surface_metrics.py",
+    os.path.join("..", "label_maps.py"), os.path.join("..", "series_index.py"),
+)
+
+
+def empty_manifest():
+    return {"version": MANIFEST_VERSION, "file_hashes": {}, "cases": {}}
+
+
+def load_manifest(output_folder):
+    """Load the manifest of a previous run, or return an empty one if there is none or it is unreadable."""
+    manifest_path = os.path.join(output_folder, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return empty_manifest()
+    try:
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Could not read manifest {manifest_path}, recomputing all cases: {e}")
+        return empty_manifest()
+    if manifest.get("version") != MANIFEST_VERSION:
+        return empty_manifest()
+    return manifest
+
+
+def save_manifest(output_folder, manifest):
+    # Write to a temporary file first, so an interrupted run never leaves a truncated manifest
+    os.makedirs(output_folder, exist_ok=True)
+    manifest_path = os.path.join(output_folder, MANIFEST_FILE)
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(temp_path, manifest_path)
+
+
+def file_sha256(path, file_hashes=None):
+    """
+    Compute the SHA-256 of a file's content.
+
+    If a `file_hashes` cache is given, the hash is reused as long as the file's size and
+    modification time are unchanged, so unchanged SEG files are not read again on a rerun.
+    """
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    if file_hashes is not None:
+        cached = file_hashes.get(key)
+        if cached and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+            return cached["sha256"]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    sha256 = digest.hexdigest()
+
+    if file_hashes is not None:
+        file_hashes[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256}
+    return sha256
+
+
+def code_version():
+    # Hash of the analysis sources, so results computed by an older version are not reused
+    code_folder = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256()
+    for file_name in CODE_FILES:
+        digest.update(file_name.encode())
+        digest.update(file_sha256(os.path.join(code_folder, file_name)).encode())
+    return digest.hexdigest()
+
+
+def case_input_hash(segmentation_files, settings, file_hashes=None):
+    """
+    Combine the content hashes of a CT series' SEG files with the run settings into one hash.
+
+    Args:
+        segmentation_files: Paths of the DICOM SEG files of the CT series.
+        settings: JSON-serializable dictionary of everything else the results depend on
+            (structure CSV hash, code version, mode).
+        file_hashes: Optional cache passed on to file_sha256.
+    """
+    inputs = {
+        "settings": settings,
+        "segmentations": {
+            os.path.basename(path): file_sha256(path, file_hashes)
+            for path in sorted(segmentation_files)
+        },
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def list_outputs(case_folder, root_folder):
+    # Files written into a case's output folder, relative to the root output folder
+    if not os.path.isdir(case_folder):
+        return []
+    return sorted(
+        os.path.relpath(os.path.join(case_folder, f), root_folder)
+        for f in os.listdir(case_folder)
+        if os.path.isfile(os.path.join(case_folder, f))
+    )
+
+
+def is_case_current(manifest, case_key, input_hash, root_folder):
+    """Return True if the stored results of a case were computed from the same inputs and its outputs still exist."""
+    entry = manifest["cases"].get(case_key)
+    if not entry or entry["input_hash"] != input_hash:
+        return False
+    return all(os.path.exists(os.path.join(root_folder, f)) for f in entry["outputs"])
@@ -0,0 +1,147 @@
+# Round trip of synthetic masks through dicom_seg_writer.py (Convert consensus to DICOM) and dicom_seg_decoder.py
+import os
+import sys
+
+import numpy as np
+import pydicom
+import pytest
+import SimpleITK as sitk
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Convert consensus to DICOM"))
+from dicom_seg_decoder import decode_label_map, decode_segment, index_seg_file
+from dicom_seg_writer import read_ct_series, write_segmentation
+
+
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+
+
+def write_ct_series(folder, num_slices, rows, columns, pixel_spacing=(0.8, 0.7), slice_spacing=2.5):
+    # Minimal CT series with axial slices, written in reverse order so the writer has to sort them
+    study_uid, series_uid, frame_uid = generate_uid(), generate_uid(), generate_uid()
+    for k in reversed(range(num_slices)):
+        ds = Dataset()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+        ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.SOPClassUID = CT_IMAGE_STORAGE
+        ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+        ds.StudyInstanceUID, ds.SeriesInstanceUID, ds.FrameOfReferenceUID = study_uid, series_uid, frame_uid
+        ds.Modality = "CT"
+        ds.PatientID = "P1"
+        ds.PatientName = "Synthetic"
+        ds.InstanceNumber = k + 1
+        ds.ImagePositionPatient = [-10.0, -20.0, 5.0 + k * slice_spacing]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = list(pixel_spacing)
+        ds.SliceThickness = slice_spacing
+        ds.Rows, ds.Columns = rows, columns
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 1
+        ds.PixelData = np.zeros((rows, columns), dtype=np.int16).tobytes()
+        ds.save_as(os.path.join(folder, f"slice_{num_slices - k:03d}.dcm"), enforce_file_format=True)
+    # A non-DICOM file in the series folder is ignored
+    with open(os.path.join(folder, "notes.txt"), "w") as f:
+        f.write("not a DICOM file")
+    return read_ct_series(folder)
+
+
+def on_ct_grid(array, ct_series):
+    image = sitk.GetImageFromArray(array.astype(np.uint8))
+    image.SetOrigin(ct_series["origin"])
+    image.SetSpacing(ct_series["spacing"])
+    image.SetDirection(ct_series["direction"])
+    return image
+
+
+def segment_attributes(name):
+    return {
+        "labelID": 1,
+        "SegmentLabel": name,
+        "SegmentDescription": name,
+        "SegmentAlgorithmType": "AUTOMATIC",
+        "SegmentAlgorithmName": "Consensus",
+        "SegmentedPropertyCategoryCodeSequence": {
+            "CodeValue": "123037004", "CodingSchemeDesignator": "SCT", "CodeMeaning": "Anatomical Structure"
+        },
+        "SegmentedPropertyTypeCodeSequence": {"CodeValue": "80891009", "CodingSchemeDesignator": "SCT", "CodeMeaning": name},
+        "recommendedDisplayRGBValue": [200, 80, 40],
+    }
+
+
+def decoded_on_ct_grid(image, ct_series):
+    # The decoded SEG grid only spans the slices with frames; resample it onto the full CT grid
+    reference = on_ct_grid(np.zeros(ct_series["size"][::-1], dtype=np.uint8), ct_series)
+    resampled = sitk.Resample(image, reference, sitk.Transform(), sitk.sitkNearestNeighbor, 0, image.GetPixelID())
+    return sitk.GetArrayFromImage(resampled)
+
+
+@pytest.mark.parametrize("rows, columns", [(16, 24), (7, 5), (9, 13)])
+def test_round_trip(tmp_path, rows, columns):
+    # Odd frame sizes leave bits of a frame in a partial byte that is carried over to the next frame and segment
+    ct_series = write_ct_series(str(tmp_path), 6, rows, columns)
+    rng = np.random.default_rng(rows * columns)
+    shape = ct_series["size"][::-1]
+    masks = {
+        "liver": rng.random(shape) < 0.3,
+        "spleen": np.zeros(shape, dtype=bool),
+        "heart": np.zeros(shape, dtype=bool),
+        "aorta": rng.random(shape) < 0.5,
+    }
+    masks["heart"][2:4, 1:rows - 1, 2:columns - 1] = True
+    masks["aorta"][[0, 3, 4]] = False
+    output_file = str(tmp_path / "seg" / "SEG_Consensus.dcm")
+    os.makedirs(os.path.dirname(output_file))
+
+    num_frames = write_segmentation(
+        [(segment_attributes(name), on_ct_grid(mask, ct_series)) for name, mask in masks.items()],
+        {"SeriesDescription": "Consensus"}, ct_series, output_file,
+    )
+    assert num_frames == sum(int(mask.reshape(len(mask), -1).any(axis=1).sum()) for mask in masks.values())
+
+    ds = pydicom.dcmread(output_file)
+    assert int(ds.NumberOfFrames) == num_frames
+    # All frames are packed back to back, 8 pixels per byte, padded to an even length
+    num_bytes = -(-num_frames * rows * columns // 8)
+    assert len(ds.PixelData) == num_bytes + num_bytes % 2
+    assert [segment.SegmentLabel for segment in ds.SegmentSequence] == list(masks)
+
+    seg_index = index_seg_file(output_file)
+    assert seg_index["segments"]["spleen"] == []
+    for name, mask in masks.items():
+        decoded = decode_segment(seg_index, name)
+        if mask.any():
+            np.testing.assert_array_equal(decoded_on_ct_grid(decoded, ct_series), mask, err_msg=name)
+        else:
+            assert not sitk.GetArrayViewFromImage(decoded).any()
+
+    label_map, overlapping = decode_label_map(seg_index, {"liver": 1, "heart": 2})
+    expected = np.where(masks["heart"], 2, np.where(masks["liver"], 1, 0))
+    np.testing.assert_array_equal(decoded_on_ct_grid(label_map, ct_series), expected)
+    assert overlapping == ({"liver"} if (masks["heart"] & masks["liver"]).any() else set())
+
+
+def test_flipped_mask_axes(tmp_path):
+    # A mask on a grid with flipped axes (e.g. a NIfTI in another orientation) is resampled onto the CT grid
+    ct_series = write_ct_series(str(tmp_path), 5, 11, 9)
+    mask = np.zeros(ct_series["size"][::-1], dtype=bool)
+    mask[1:4, 2:6, 1:4] = True
+    mask[4, 10, 8] = True
+    flipped = sitk.Flip(on_ct_grid(mask, ct_series), [True, True, True])
+    assert flipped.GetDirection() != ct_series["direction"]
+
+    output_file = str(tmp_path / "SEG_Consensus.dcm")
+    assert write_segmentation([(segment_attributes("kidney"), lambda: flipped)], {}, ct_series, output_file) == 4
+    decoded = decode_segment(index_seg_file(output_file), "kidney")
+    np.testing.assert_array_equal(decoded_on_ct_grid(decoded, ct_series), mask)
+
+
+def test_all_masks_empty(tmp_path):
+    ct_series = write_ct_series(str(tmp_path), 3, 7, 5)
+    output_file = str(tmp_path / "SEG_Consensus.dcm")
+    empty = on_ct_grid(np.zeros(ct_series["size"][::-1]), ct_series)
+    assert write_segmentation([(segment_attributes("liver"), empty)], {}, ct_series, output_file) == 0
+    assert not os.path.exists(output_file)
@@ -0,0 +1,39 @@
+# The code version of the manifest must cover every local module the analysis script imports
+import ast
+import os
+
+from run_manifest import CODE_FILES, code_version
+
+
+CODE_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+def imported_local_modules(script):
+    # Modules imported anywhere in `script` that are files of this folder or of the repository root
+    with open(os.path.join(CODE_FOLDER, script), "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            names.add(node.module.split(".")[0])
+        elif isinstance(node, ast.Import):
+            names.update(alias.name.split(".")[0] for alias in node.names)
+    local_files = set()
+    for name in names:
+        for folder in (".", ".."):
+            if os.path.exists(os.path.join(CODE_FOLDER, folder, f"{name}.py")):
+                local_files.add(os.path.normpath(os.path.join(folder, f"{name}.py")))
+                break
+    return local_files
+
+
+def test_code_files_cover_local_imports():
+    code_files = {os.path.normpath(f) for f in CODE_FILES}
+    assert "analyze_disagreement_dice_score.py" in code_files
+    assert imported_local_modules("analyze_disagreement_dice_score.py") <= code_files
+    for code_file in code_files:
+        assert os.path.exists(os.path.join(CODE_FOLDER, code_file)), code_file
+
+
+def test_code_version_is_stable():
+    assert code_version() == code_version()
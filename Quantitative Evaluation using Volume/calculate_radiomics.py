@@ -1,44 +1,30 @@
 #!/usr/bin/env python3
 
-from concurrent.futures import ThreadPoolExecutor
+# Only standard-library modules are imported at module level, so that the convert mode and every
+# spawned worker process start quickly. numpy, SimpleITK, nibabel, pandas, psutil, tqdm and
+# PyRadiomics are imported inside the functions that need them.
+import csv
 from datetime import datetime
-from functools import partial
-from idc_index import index
-import glob
+from functools import lru_cache
+import hashlib
 import json
 import logging
-import matplotlib.pyplot as plt
 import multiprocessing
-import nibabel as nib
-import numpy as np
 #import nvidia_smi
 import os
 from pathlib import Path
-import pandas as pd
-import psutil
-import pydicom
-from pydicom.filereader import dcmread
-from pydicom.sr.codedict import codes
-from pydicom.uid import generate_uid
-import radiomics
-from radiomics import featureextractor, generalinfo
-import random
+import queue
 import re
-import shutil
-import SimpleITK as sitk
 import subprocess
 import sys
 import time
-from time import sleep, asctime, localtime
-from tqdm import tqdm
-from tqdm.contrib.concurrent import process_map
+
+# Shared helpers of the repository (label_maps.py)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
 # -------------------------------------------------------------------------
 # 1) Convert SEG and CT Files to nifti files
 # -------------------------------------------------------------------------
-import os
-import re
-import subprocess
 
 def mirror_and_convert_dicom(base_input_dir: str, base_output_dir: str, dcm2niix_path: str, segimage2itkimage_path: str):
 
@@ -115,15 +101,88 @@ def mirror_and_convert_dicom(base_input_dir: str, base_output_dir: str, dcm2niix
     dtype={"SegmentedPropertyTypeModifierCodeSequence.CodeValue": str},
 )'''
 
-totalsegmentator_radiomics_features_code_mapping_df = pd.read_csv(
-    "https://raw.githubusercontent.com/ImagingDataCommons/CloudSegmentator/main/workflows/TotalSegmentator/resources/radiomicsFeaturesMaps.csv",
-    index_col=[0]
-)
+# A versioned copy of the radiomics feature map is bundled next to the script, so conversion and extraction never
+# access the network and run on compute nodes without internet access. The JSON file next to it records its version,
+# source and checksum; only refresh-feature-map downloads it again from FEATURE_MAP_URL.
+FEATURE_MAP_FILE = Path(__file__).resolve().parent / "resources" / "radiomicsFeaturesMaps.csv"
+FEATURE_MAP_INFO_FILE = FEATURE_MAP_FILE.with_suffix(".json")
+FEATURE_MAP_URL = "https://raw.githubusercontent.com/ImagingDataCommons/CloudSegmentator/main/workflows/TotalSegmentator/resources/radiomicsFeaturesMaps.csv"
+
+
+@lru_cache(maxsize=None)
+def load_feature_map(feature_map_file: Path = FEATURE_MAP_FILE) -> dict:
+    """
+    Read the feature names per PyRadiomics feature class from the feature map.
+
+    Returns:
+        A dictionary mapping the feature class (e.g. "shape") to the list of its feature names.
 
-logger = radiomics.logger
-logger.setLevel(logging.WARNING)
+    Raises:
+        FileNotFoundError: If the feature map is missing; it is not downloaded automatically.
+    """
+    if not Path(feature_map_file).exists():
+        raise FileNotFoundError(
+            f"The radiomics feature map {feature_map_file} is missing; restore it from the repository or run "
+            "'python calculate_radiomics.py refresh-feature-map' on a machine with network access"
+        )
+    features_by_class = {}
+    with open(feature_map_file, "r", newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            features_by_class.setdefault(row["pyradiomics_feature_class"], []).append(row["feature"])
+    return features_by_class
+
+
+def refresh_feature_map(url: str = FEATURE_MAP_URL) -> bool:
+    """
+    Download the feature map from `url` and replace the bundled copy.
+
+    This is the only place where the script accesses the network. The download is checked for
+    the columns the extraction uses before it replaces the bundled copy; its source, date and
+    SHA-256 are recorded in the JSON info file and the version there is increased.
+
+    Returns:
+        True if the download succeeded and is stored; False leaves the bundled copy unchanged.
+    """
+    import urllib.error
+    import urllib.request
+
+    try:
+        with urllib.request.urlopen(url, timeout=60) as response:
+            content = response.read()
+    except (urllib.error.URLError, OSError) as e:
+        print(f"[ERROR] Could not download the radiomics feature map from {url}: {e}")
+        return False
+    columns = next(csv.reader(content.decode("utf-8").splitlines()), [])
+    if not {"feature", "pyradiomics_feature_class"} <= set(columns):
+        print(f"[ERROR] {url} is not a radiomics feature map (columns: {columns}), keeping the bundled copy.")
+        return False
+
+    sha256 = hashlib.sha256(content).hexdigest()
+    previous = {}
+    if FEATURE_MAP_FILE.exists() and FEATURE_MAP_INFO_FILE.exists():
+        with open(FEATURE_MAP_INFO_FILE, "r") as f:
+            previous = json.load(f)
+        if previous.get("sha256") == sha256:
+            print(f"[INFO] The bundled feature map is up to date: {FEATURE_MAP_FILE}")
+            return True
+
+    FEATURE_MAP_FILE.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = FEATURE_MAP_FILE.with_name(FEATURE_MAP_FILE.name + ".tmp")
+    with open(temp_file, "wb") as f:
+        f.write(content)
+    os.replace(temp_file, FEATURE_MAP_FILE)
+    info = {
+        "version": previous.get("version", 0) + 1,
+        "source": url,
+        "retrieved": datetime.now().strftime("%Y-%m-%d"),
+        "sha256": sha256,
+    }
+    with open(FEATURE_MAP_INFO_FILE, "w") as f:
+        json.dump(info, f, indent=2)
+        f.write("\n")
+    print(f"[INFO] Feature map downloaded from {url}: {FEATURE_MAP_FILE}")
+    return True
 
-idc_client=index.IDCClient()
 
 
 
@@ -150,34 +209,52 @@ def log_failed_to_save_raw_radiomics_features(series_id: str) -> None:
     with open(log_file_path, 'a') as f:
         f.write(error_message)
 
-def is_series_greater_than_800_slices(series_id: str) -> bool:
+# Memory model of the extraction: images are held in memory with their on-disk data types, and PyRadiomics
+# and the firstorder features keep working copies of the voxels they process
+WORKER_MEMORY_FACTOR = 3
+# Memory of an idle worker process (interpreter, PyRadiomics, SimpleITK)
+WORKER_BASE_MEMORY = 512 * 1024 ** 2
+# Fraction of the currently available memory the workers may use
+MEMORY_HEADROOM = 0.8
+# Working memory of the firstorder pass in this process per labelled voxel (sort order, float64 intensities,
+# deviations, percentile masks, bins), and the number of labelled voxels whose labels are computed together
+FIRST_ORDER_BYTES_PER_VOXEL = 48
+FIRST_ORDER_CHUNK_VOXELS = 1 << 25
+
+
+def estimate_series_memory(ct_file: Path, seg_file: Path) -> int:
     """
-    Gets the SOPInstance count of the corresponding seriesInstanceUID from idc-index
-    Refer to this query for additional columns available in idc-index!
-    The reason why we are checking for 800 slices is whether to extract radiomics features
-    using multiprocessor or sequentially. We validated that series with slices upto 800 slices
-    work with out any issues with multiprocessor. However, above 800 we did find erratic
-    behavior. While it is inefficient to do extract radiomics features sequentially, we
-    expect it to work.
+    Estimate the peak memory in bytes needed to hold and process the full CT and `seg_file`.
 
-    https://github.com/ImagingDataCommons/idc-index/blob/main/queries/idc_index.sql
+    This includes the firstorder pass over the labelled voxels (compute_first_order_features),
+    which are at most all voxels of the CT grid and are processed in chunks of
+    FIRST_ORDER_CHUNK_VOXELS. Only the NIfTI headers are read (dimensions and data type); no
+    voxel data is loaded.
+    """
+    import nibabel as nib
+    import numpy as np
 
-    Args:
-    series_id: The DICOM Tag SeriesInstanceUID of the DICOM series to be processed.
+    image_bytes = 0
+    for nifti_file in (ct_file, seg_file):
+        header = nib.load(str(nifti_file)).header
+        image_bytes += int(np.prod(header.get_data_shape(), dtype=np.int64)) * header.get_data_dtype().itemsize
+    ct_voxels = int(np.prod(nib.load(str(ct_file)).header.get_data_shape(), dtype=np.int64))
+    return WORKER_MEMORY_FACTOR * image_bytes + FIRST_ORDER_BYTES_PER_VOXEL * min(ct_voxels, FIRST_ORDER_CHUNK_VOXELS)
+
+
+def plan_worker_count(worker_memory: int, num_tasks: int, reserved_memory: int = 0) -> int:
     """
+    Choose how many worker processes fit into the available memory.
 
-    query = f"""
-    SELECT
-    instanceCount
-    FROM index
-    WHERE SeriesInstanceUID = '{series_id}'
+    The count is bounded by the number of CPUs, the number of tasks and the memory reported
+    as available by psutil minus `reserved_memory`, so large series run with fewer workers
+    instead of sequentially.
     """
-    print(series_id)
-    sopInstanceCount_df = idc_client.sql_query(query)
-    if int(sopInstanceCount_df["instanceCount"][0]) > 800:
-        return True
-    else:
-        return False
+    import psutil
+
+    available_memory = psutil.virtual_memory().available * MEMORY_HEADROOM - reserved_memory
+    workers = min(os.cpu_count() or 1, num_tasks, int(available_memory // max(worker_memory, 1)))
+    return max(1, workers)
     
 def ndarray_to_list(obj):
 
@@ -191,25 +268,108 @@ def ndarray_to_list(obj):
       A list representation of the numpy array.
     """
 
+    import numpy as np
+
     if isinstance(obj, np.ndarray):
         return obj.tolist()
     return obj
 
-def resample_segmentation_to_ct(seg_file: Path, ct_file: Path):
-    
-    seg_image = sitk.ReadImage(str(seg_file))
-    ct_image = sitk.ReadImage(str(ct_file))
-    
-    resampler = sitk.ResampleImageFilter()
-    resampler.SetReferenceImage(ct_image)
-    resampler.SetInterpolator(sitk.sitkNearestNeighbor)
-    resampler.SetOutputPixelType(seg_image.GetPixelID())
-    
-    resampled_seg = resampler.Execute(seg_image)
-    sitk.WriteImage(resampled_seg, str(seg_file))
-    print(f"[INFO] Resampled segmentation saved to {seg_file}")
+# Segmentations resampled to the CT grid are cached in this folder of the results directory, so the input
+# segmentations are never modified
+RESAMPLED_CACHE_FOLDER = ".resampled_segmentations"
+
+
+def read_image_information(image_file: Path):
+    # Image reader holding only the header (size, spacing, origin, direction) of an image file
+    import SimpleITK as sitk
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(image_file))
+    reader.ReadImageInformation()
+    return reader
+
+
+def same_geometry(image, reference, tolerance=1e-3):
+    # True if two images (or image readers) share size, spacing, origin and direction
+    import numpy as np
+
+    return (
+        tuple(image.GetSize()) == tuple(reference.GetSize())
+        and np.allclose(image.GetSpacing(), reference.GetSpacing(), atol=tolerance)
+        and np.allclose(image.GetOrigin(), reference.GetOrigin(), atol=tolerance)
+        and np.allclose(image.GetDirection(), reference.GetDirection(), atol=tolerance)
+    )
+
+
+def resample_to_reference(image, reference):
+    # Nearest-neighbour resampling of a label map onto the grid of `reference` (an image or image reader)
+    import SimpleITK as sitk
+
+    return sitk.Resample(
+        image,
+        reference.GetSize(),
+        sitk.Transform(),
+        sitk.sitkNearestNeighbor,
+        reference.GetOrigin(),
+        reference.GetSpacing(),
+        reference.GetDirection(),
+        0,
+        image.GetPixelID(),
+    )
+
+
+def resample_segmentation_to_ct(seg_file: Path, ct_file: Path, cache_folder: Path) -> Path:
+    """
+    Return a segmentation file on the grid of the CT, without modifying the input segmentation.
+
+    If both grids are the same (compared on the file headers only), `seg_file` itself is
+    returned. Otherwise the resampled segmentation is written to `cache_folder` once, under a
+    name derived from the source file (path, size, modification time) and the CT geometry, and
+    reused by later runs as long as neither of them changes.
+
+    Returns:
+        The path of the segmentation to extract the features from.
+    """
+    import SimpleITK as sitk
+
+    ct_reader = read_image_information(ct_file)
+    if same_geometry(read_image_information(seg_file), ct_reader):
+        return Path(seg_file)
+
+    stat = os.stat(seg_file)
+    cache_key = json.dumps(
+        {
+            "source": str(Path(seg_file).resolve()),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "size_ct": list(ct_reader.GetSize()),
+            "spacing_ct": list(ct_reader.GetSpacing()),
+            "origin_ct": list(ct_reader.GetOrigin()),
+            "direction_ct": list(ct_reader.GetDirection()),
+        },
+        sort_keys=True,
+    )
+    seg_stem = re.sub(r"\.nii(\.gz)?$", "", Path(seg_file).name)
+    cached_file = Path(cache_folder) / f"{seg_stem}_{hashlib.sha256(cache_key.encode()).hexdigest()[:16]}.nii"
+    if cached_file.exists():
+        return cached_file
+
+    # Remove files cached for an older version of this segmentation or another CT geometry
+    cached_file.parent.mkdir(parents=True, exist_ok=True)
+    for old_file in cached_file.parent.iterdir():
+        if re.fullmatch(re.escape(seg_stem) + r"_[0-9a-f]{16}\.nii", old_file.name):
+            old_file.unlink()
+
+    # Uncompressed and written under a temporary name first, so an interrupted run leaves no partial cache file
+    resampled_seg = resample_to_reference(sitk.ReadImage(str(seg_file)), ct_reader)
+    temp_file = cached_file.with_name(f".{cached_file.stem}.tmp.nii")
+    sitk.WriteImage(resampled_seg, str(temp_file), useCompression=False)
+    os.replace(temp_file, cached_file)
+    print(f"[INFO] Resampled segmentation cached in {cached_file}")
+    return cached_file
 
 def get_label_id_body_part_df(meta_json_path: Path):
+    import pandas as pd
 
     with open(meta_json_path, "r", encoding="utf-8") as f:
         data = json.load(f)
@@ -229,34 +389,167 @@ def get_label_id_body_part_df(meta_json_path: Path):
     return df
 
 
-def extract_features_for_all_labels(series_id: str, ct_file: Path, seg_file: Path, json_file: Path, output_file: Path):
-    
-    resample_segmentation_to_ct(seg_file, ct_file)
-    
-    label_id_body_part_df = get_label_id_body_part_df(json_file)
-    print(label_id_body_part_df)
-    
-    stats = {}
-    raw_stats = {}
-    
-    labels = [
-        int(x) for x in np.unique(nib.load(seg_file).get_fdata()).tolist() if x != 0
-    ]
-    
-    func = partial(
-        extract_radiomics_features_from_one_label,
-        str(seg_file), 
-        str(ct_file),       
-        label_id_body_part_df,
+def create_radiomics_extractor(vectorized_first_order=False):
+    """
+    Create a feature extractor with the shape and firstorder features of the feature map enabled.
+
+    Args:
+        vectorized_first_order: If True, the firstorder features computed by
+            first_order_features.py are left out of the extractor; they are computed for all
+            labels at once by compute_first_order_features instead.
+
+    Returns:
+        The configured extractor and the list of enabled shape features.
+    """
+    """the tolerance value is taken from the totalsegmentator repo
+    # https://github.com/wasserth/TotalSegmentator/blob/master/totalsegmentator/statistics.py#L31
+    """
+    import radiomics
+    from radiomics import featureextractor
+
+    radiomics.logger.setLevel(logging.WARNING)
+    settings = {"geometryTolerance": 1e-3}
+
+    # Create the feature extractor
+    extractor = featureextractor.RadiomicsFeatureExtractor(**settings)
+
+    # Get the list of shape and firstorder features
+    feature_map = load_feature_map()
+    shape_features = feature_map.get("shape", [])
+    firstorder_features = feature_map.get("firstorder", [])
+    if vectorized_first_order:
+        firstorder_features = [f for f in firstorder_features if f not in vectorized_first_order_features()]
+
+    # Enable the shape and firstorder features
+    extractor.disableAllFeatures()
+    extractor.enableFeaturesByName(
+        shape=shape_features, firstorder=firstorder_features
     )
+    return extractor, shape_features
 
-    if not is_series_greater_than_800_slices(series_id):
-        # Use a multiprocessing pool to apply the function to all labels
-        with multiprocessing.Pool() as pool:
-            results = list(tqdm(pool.imap(func, labels), total=len(labels)))
-    else:
-        # Apply the function to all labels sequentially
-        results = [func(label) for label in tqdm(labels)]
+
+def vectorized_first_order_features():
+    # The firstorder features of the feature map that first_order_features.py computes
+    from first_order_features import FIRST_ORDER_FEATURES
+
+    return [f for f in load_feature_map().get("firstorder", []) if f in FIRST_ORDER_FEATURES]
+
+
+# State of a worker process: the extractor is configured once per worker
+_worker_state = {}
+
+# Margin in voxels around the bounding box of a label when it is cropped for its task; PyRadiomics crops
+# to the bounding box with the same margin (padDistance), so the features do not change
+ROI_PADDING = 5
+
+
+def crop_to_bounding_box(image, bounding_box, padding=ROI_PADDING):
+    # Region of `image` around a bounding box (index, size), padded and clipped to the image; the crop keeps its physical position
+    import SimpleITK as sitk
+
+    index, size = bounding_box
+    start = [max(i - padding, 0) for i in index]
+    stop = [min(i + s + padding, n) for i, s, n in zip(index, size, image.GetSize())]
+    return sitk.RegionOfInterest(image, [b - a for a, b in zip(start, stop)], start)
+
+
+def extract_label_task(task):
+    """
+    Extract the PyRadiomics features of one (series, segmentation, label) task of the work queue.
+
+    Args:
+        task: Tuple (job_index, label, body_part, image, segmentation) with the CT and the
+            segmentation cropped to the label (crop_to_bounding_box).
+
+    Returns:
+        A tuple (job_index, label, (body_part, mask_stats, raw_features), task_timings), where
+        task_timings holds the start time, wall and CPU time of the task and the peak RSS of the
+        worker (see extraction_profile.py).
+    """
+    from extraction_profile import peak_rss
+
+    started, start_cpu_time = time.time(), time.process_time()
+    job_index, label, body_part, image, segmentation = task
+    if "extractor" not in _worker_state:
+        _worker_state["extractor"], _worker_state["shape_features"] = create_radiomics_extractor(
+            vectorized_first_order=True
+        )
+    mask_stats, raw_features = compute_label_features(
+        image, segmentation, label, _worker_state["extractor"], _worker_state["shape_features"]
+    )
+    task_timings = {
+        "started": started,
+        "wall_time": round(time.time() - started, 4),
+        "cpu_time": round(time.process_time() - start_cpu_time, 4),
+        "peak_rss": peak_rss(),
+    }
+    return job_index, label, (body_part, mask_stats, raw_features), task_timings
+
+
+def compute_first_order_features(image, segmentation, labels):
+    """
+    Compute the firstorder features of all labels of one segmentation in a single pass (first_order_features.py).
+
+    The labels are passed in groups of at most FIRST_ORDER_CHUNK_VOXELS labelled voxels (a label
+    larger than that forms a group of its own), so the working memory of the pass is bounded
+    and accounted for in estimate_series_memory.
+
+    Returns:
+        A dictionary mapping each label to its firstorder features; it is empty if the
+        computation failed.
+    """
+    import numpy as np
+    import SimpleITK as sitk
+    from first_order_features import first_order_features
+    from label_maps import label_voxel_counts
+
+    try:
+        image_array = sitk.GetArrayViewFromImage(image)
+        label_array = sitk.GetArrayViewFromImage(segmentation)
+        counts = label_voxel_counts(label_array)
+        features = {}
+        for chunk in chunk_labels(labels, counts, FIRST_ORDER_CHUNK_VOXELS):
+            features.update(first_order_features(
+                image_array,
+                label_array,
+                chunk,
+                voxel_volume=float(np.prod(image.GetSpacing())),
+                feature_names=vectorized_first_order_features(),
+            ))
+        return features
+    except Exception as e:
+        print(f"WARNING: firstorder features could not be computed: {e}")
+        return {}
+
+
+def chunk_labels(labels, counts, chunk_voxels):
+    # Consecutive groups of `labels` with at most `chunk_voxels` voxels in total according to `counts` (label_voxel_counts)
+    chunk, chunk_size = [], 0
+    for label in labels:
+        size = int(counts[label]) if label < len(counts) else 0
+        if chunk and chunk_size + size > chunk_voxels:
+            yield chunk
+            chunk, chunk_size = [], 0
+        chunk.append(label)
+        chunk_size += size
+    if chunk:
+        yield chunk
+
+
+def merge_first_order_features(mask_stats, raw_features, features):
+    # Add the vectorized firstorder features of a label under the names PyRadiomics gives them. Labels
+    # PyRadiomics failed on keep their zeroed features, so they are still left out of the output
+    if not any(v != 0 for v in mask_stats.values()):
+        return
+    for name, value in features.items():
+        mask_stats[f"firstorder_{name}"] = round(value, 4)
+        raw_features[f"original_firstorder_{name}"] = value
+
+
+def save_label_features(series_id: str, output_file: Path, results):
+    # Write the features of all labels of one segmentation; `results` holds (body_part, mask_stats, raw_features) in label order
+    stats = {}
+    raw_stats = {}
 
     # Process the results
     for body_part, mask_stats, raw_features in results:
@@ -274,56 +567,288 @@ def extract_features_for_all_labels(series_id: str, ct_file: Path, seg_file: Pat
     except:
         log_failed_to_save_raw_radiomics_features(series_id)
 
-def extract_radiomics_features_from_one_label(
-    segmentation_file, image_file, label_id_body_part_df, label=None
-):
+
+def prepare_segmentation_job(job, stopwatch=None):
     """
-    Extract radiomics features from a given ct nifti image and segmentation file.
+    Load the CT and the segmentation of a job on the CT grid and find the labels to extract.
 
-    Args:
-        segmentation_file: The path to the segmentation file.
-        image_file: The path to the ct nifti image file.
-        label: The label of the region of interest in the segmentation file.
+    The bounding boxes of all labels are found in one pass over the segmentation
+    (label_maps.label_bounding_boxes). If a Stopwatch (extraction_profile.py) is given, the
+    time spent resampling, reading and finding the bounding boxes is added to it.
 
     Returns:
-        A dictionary containing the extracted radiomics features.
+        The CT and the segmentation as SimpleITK images and a list of (label, body_part,
+        bounding_box) tuples.
     """
-    body_part = label_id_body_part_df.loc[label_id_body_part_df["label_id"] == label][
-        "body_part"
-    ].values[0]
+    import SimpleITK as sitk
+    from extraction_profile import Stopwatch
+    from label_maps import label_bounding_boxes, read_label_map
+
+    stopwatch = stopwatch or Stopwatch()
+    with stopwatch("resample"):
+        seg_file = resample_segmentation_to_ct(
+            job["seg_file"], job["ct_file"], Path(job["output_file"]).parent / RESAMPLED_CACHE_FOLDER
+        )
+    with stopwatch("io"):
+        label_id_body_part_df = get_label_id_body_part_df(job["json_file"])
+        body_parts = dict(zip(label_id_body_part_df["label_id"], label_id_body_part_df["body_part"]))
+        # Read in the compact on-disk data type of the segmentation
+        segmentation = read_label_map(seg_file)
+
+    # Labels present in the segmentation
+    labels = []
+    with stopwatch("bounding_box"):
+        bounding_boxes = label_bounding_boxes(segmentation)
+    for label, bounding_box in bounding_boxes.items():
+        if label in body_parts:
+            labels.append((label, body_parts[label], bounding_box))
+        else:
+            print(f"[WARN] Label {label} of {job['seg_file']} is not in {job['json_file']}, skipping it.")
+    with stopwatch("io"):
+        image = sitk.ReadImage(str(job["ct_file"])) if labels else None
+    return image, segmentation, labels
+
+
+class MemoryBudget:
+    """
+    Admit work queue tasks only while the memory of the tasks in flight fits into a budget.
+
+    A task that alone exceeds the budget is admitted when no other task is in flight, so the
+    queue never stalls. close() releases a feeder that is still waiting.
+    """
+
+    def __init__(self, budget):
+        import threading
+
+        self.free = budget
+        self.in_flight = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def acquire(self, memory):
+        # Wait until `memory` bytes are free; returns False if the budget was closed in the meantime
+        with self.condition:
+            self.condition.wait_for(lambda: self.closed or self.in_flight == 0 or memory <= self.free)
+            if self.closed:
+                return False
+            self.free -= memory
+            self.in_flight += 1
+            return True
+
+    def release(self, memory):
+        with self.condition:
+            self.free += memory
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+def extract_features_for_jobs(jobs, profile_file=None):
+    """
+    Extract the radiomics features of many segmentations with one long-lived worker pool.
+
+    All (series, segmentation, label) tasks of all jobs are fed into a single work queue, so
+    workers move on to the next segmentation while the last labels of another one are still
+    running, instead of waiting at the end of every file. The segmentations are prepared
+    while the queue is consumed: the CT and the segmentation are read once, in this process,
+    the bounding boxes of all labels are found in one pass, and the firstorder features of all
+    labels are computed in one pass (first_order_features.py). Every label task then only
+    carries a padded crop of the CT and the segmentation around its label, on which the
+    PyRadiomics shape features are computed. The output files of a segmentation are written as
+    soon as all its labels are done.
+
+    Workers therefore never hold a full series. Their number is bounded by the CPUs and by
+    the memory left next to the one series held by this process; the crops in flight are kept
+    within that memory by a MemoryBudget.
+
+    Args:
+        jobs: List of dictionaries with the keys series_id, ct_file, seg_file, json_file and
+            output_file, one per segmentation file.
+        profile_file: Optional JSON lines file for a profile of the run (extraction_profile.py):
+            the time spent per segmentation on I/O, resampling and features, and the wall time,
+            CPU time, queue time and peak RSS of every label task.
+    """
+    import psutil
+    from tqdm import tqdm
+    from extraction_profile import ExtractionProfile, Stopwatch
+
+    if not jobs:
+        return
+    # Download the feature map once, before the worker processes are started (they inherit it)
+    load_feature_map()
+
+    profile = ExtractionProfile(profile_file) if profile_file else None
+
+    # The task generator runs in the pool's feeder thread; it only yields tasks and reports the tasks and the end of
+    # every job through `events`. All bookkeeping and the output files are done by this thread (drain_events, on_result)
+    events = queue.SimpleQueue()
+    jobs_state = {}
+    task_info = {}
+
+    def finish_job(job_index, state):
+        job = jobs[job_index]
+        stopwatch = state["stopwatch"]
+        results = []
+        for label in sorted(state["results"]):
+            body_part, mask_stats, raw_features = state["results"][label]
+            merge_first_order_features(mask_stats, raw_features, state["first_order"].get(label, {}))
+            results.append((body_part, mask_stats, raw_features))
+        with stopwatch("write"):
+            save_label_features(job["series_id"], job["output_file"], results)
+        if profile:
+            profile.record_segmentation(job["series_id"], job["seg_file"], len(results), stopwatch.timings)
+
+    def check_job(job_index):
+        # Write the output files of a job once the generator is done with it and all its tasks returned
+        state = jobs_state[job_index]
+        if state["num_tasks"] is None or len(state["results"]) < state["num_tasks"]:
+            return
+        del jobs_state[job_index]
+        if state["failed"]:
+            return
+        try:
+            finish_job(job_index, state)
+        except Exception as e:
+            print(f"[ERROR] Could not save the features of {jobs[job_index]['seg_file']}: {e}")
+
+    def drain_events():
+        while True:
+            try:
+                event = events.get_nowait()
+            except queue.Empty:
+                return
+            if event[0] == "task":
+                _, job_index, label, info = event
+                task_info[job_index, label] = info
+                jobs_state.setdefault(job_index, {"results": {}, "num_tasks": None})
+            else:
+                _, job_index, num_tasks, first_order, stopwatch, failed = event
+                state = jobs_state.setdefault(job_index, {"results": {}})
+                state.update(num_tasks=num_tasks, first_order=first_order, stopwatch=stopwatch, failed=failed)
+                check_job(job_index)
+
+    def job_tasks(job_index, job, image, segmentation, labels, stopwatch):
+        # Crops of the labels of one prepared job as work queue tasks; reports each task through `events`
+        voxel_bytes = (image.GetSizeOfPixelComponent() * image.GetNumberOfComponentsPerPixel()
+                       + segmentation.GetSizeOfPixelComponent())
+        for label, body_part, bounding_box in labels:
+            crop_start = time.perf_counter()
+            image_crop = crop_to_bounding_box(image, bounding_box)
+            segmentation_crop = crop_to_bounding_box(segmentation, bounding_box)
+            crop_time = time.perf_counter() - crop_start
+            stopwatch.timings["crop"] += crop_time
+            memory = WORKER_MEMORY_FACTOR * image_crop.GetNumberOfPixels() * voxel_bytes
+            if not budget.acquire(memory):
+                return
+            events.put(("task", job_index, label, {
+                "memory": memory,
+                "queued": time.time(),
+                "crop_time": round(crop_time, 4),
+                "crop_voxels": image_crop.GetNumberOfPixels(),
+            }))
+            yield job_index, label, body_part, image_crop, segmentation_crop
+
+    def tasks():
+        for job_index, job in enumerate(jobs):
+            stopwatch = Stopwatch()
+            num_tasks, first_order, failed = 0, {}, False
+            try:
+                image, segmentation, labels = prepare_segmentation_job(job, stopwatch)
+                if labels:
+                    with stopwatch("firstorder"):
+                        first_order = compute_first_order_features(image, segmentation, [label for label, _, _ in labels])
+                    for task in job_tasks(job_index, job, image, segmentation, labels, stopwatch):
+                        num_tasks += 1
+                        yield task
+                    if budget.closed:
+                        return
+            except Exception as e:
+                print(f"[ERROR] Could not extract the features of {job['seg_file']}, skipping it: {e}")
+                failed = True
+            # Release the full images before the next series is read
+            image = segmentation = None
+            events.put(("end", job_index, num_tasks, first_order, stopwatch, failed))
+
+    def on_result(result):
+        drain_events()
+        job_index, label, value, task_timings = result
+        info = task_info.pop((job_index, label))
+        budget.release(info["memory"])
+        if profile:
+            task_timings = dict(task_timings, queue_time=round(max(task_timings.pop("started") - info["queued"], 0), 4))
+            task_timings.update(crop_time=info["crop_time"], crop_voxels=info["crop_voxels"])
+            job = jobs[job_index]
+            profile.record_label(job["series_id"], job["seg_file"], label, value[0], task_timings)
+        jobs_state[job_index]["results"][label] = value
+        check_job(job_index)
+
     try:
-        # Define the settings for the feature extractor
+        # This process holds one full series at a time; the workers share the memory that is left
+        series_memory = max(estimate_series_memory(job["ct_file"], job["seg_file"]) for job in jobs)
+        workers = plan_worker_count(WORKER_BASE_MEMORY, os.cpu_count() or 1, reserved_memory=series_memory)
+        budget = MemoryBudget(psutil.virtual_memory().available * MEMORY_HEADROOM - series_memory - workers * WORKER_BASE_MEMORY)
+        print(f"[INFO] Extracting {len(jobs)} segmentations with {workers} worker(s), ~{series_memory / 1024 ** 3:.1f} GiB per series")
+
+        with tqdm(unit="label") as progress:
+            if workers > 1:
+                with multiprocessing.Pool(processes=workers) as pool:
+                    try:
+                        for result in pool.imap_unordered(extract_label_task, tasks()):
+                            on_result(result)
+                            progress.update()
+                        # Jobs without labels at the end of the queue
+                        drain_events()
+                    finally:
+                        budget.close()
+            else:
+                # Apply the function to all tasks sequentially in this process
+                try:
+                    for task in tasks():
+                        on_result(extract_label_task(task))
+                        progress.update()
+                    drain_events()
+                finally:
+                    _worker_state.clear()
+    finally:
+        if profile:
+            profile.close()
 
-        """the tolerance value is taken from the totalsegmentator repo
-        # https://github.com/wasserth/TotalSegmentator/blob/master/totalsegmentator/statistics.py#L31
-        """
-        settings = {"geometryTolerance": 1e-3}
 
-        # Create the feature extractor
-        extractor = featureextractor.RadiomicsFeatureExtractor(**settings)
+def extract_features_for_all_labels(series_id: str, ct_file: Path, seg_file: Path, json_file: Path, output_file: Path):
+    # Extract the features of all labels of one segmentation file
+    extract_features_for_jobs([
+        {"series_id": series_id, "ct_file": ct_file, "seg_file": seg_file, "json_file": json_file, "output_file": output_file}
+    ])
 
-        # Get the list of shape and firstorder features
-        shape_features = totalsegmentator_radiomics_features_code_mapping_df[
-            totalsegmentator_radiomics_features_code_mapping_df[
-                "pyradiomics_feature_class"
-            ]
-            == "shape"
-        ]["feature"].tolist()
-        firstorder_features = totalsegmentator_radiomics_features_code_mapping_df[
-            totalsegmentator_radiomics_features_code_mapping_df[
-                "pyradiomics_feature_class"
-            ]
-            == "firstorder"
-        ]["feature"].tolist()
 
-        # Enable the shape and firstorder features
-        extractor.disableAllFeatures()
-        extractor.enableFeaturesByName(
-            shape=shape_features, firstorder=firstorder_features
-        )
-        # Extract the features
+def compute_label_features(image, segmentation, label, extractor, shape_features):
+    """
+    Compute the features of one label with a configured extractor.
+
+    Args:
+        image: The CT as SimpleITK image or the path of the CT nifti file.
+        segmentation: The segmentation as SimpleITK image or the path of the segmentation file.
+        label: The label of the region of interest in the segmentation.
+        extractor: Extractor from create_radiomics_extractor.
+        shape_features: The shape features enabled in `extractor`.
+
+    Returns:
+        A tuple (mask_stats, raw_features) of the cleaned, rounded features and the raw
+        PyRadiomics output. If PyRadiomics fails, all shape features are set to 0.
+    """
+    import numpy as np
+    import SimpleITK as sitk
+
+    try:
+        # Extract the features; SimpleITK images are used as they are, paths are read from disk
         raw_features = extractor.execute(
-            str(image_file), str(segmentation_file), label=label
+            image if isinstance(image, sitk.Image) else str(image),
+            segmentation if isinstance(segmentation, sitk.Image) else str(segmentation),
+            label=label,
         )
 
         # Clean the feature names and round the values
@@ -346,15 +871,135 @@ def extract_radiomics_features_from_one_label(
             k: v.tolist() if isinstance(v, np.ndarray) else v
             for k, v in cleaned_features.items()
         }
+    return mask_stats, raw_features
+
+
+def extract_radiomics_features_from_one_label(
+    segmentation_file, image_file, label_id_body_part_df, label=None, extractor=None, shape_features=None
+):
+    """
+    Extract radiomics features from a given ct nifti image and segmentation file.
+
+    Args:
+        segmentation_file: The path to the segmentation file, or the segmentation as SimpleITK image.
+        image_file: The path to the ct nifti image file, or the CT as SimpleITK image.
+        label: The label of the region of interest in the segmentation file.
+        extractor: Optional extractor from create_radiomics_extractor to reuse; a new one is
+            created if None.
+        shape_features: The shape features enabled in `extractor`.
+
+    Returns:
+        A dictionary containing the extracted radiomics features.
+    """
+    body_part = label_id_body_part_df.loc[label_id_body_part_df["label_id"] == label][
+        "body_part"
+    ].values[0]
+    if extractor is None:
+        extractor, shape_features = create_radiomics_extractor()
+    mask_stats, raw_features = compute_label_features(image_file, segmentation_file, label, extractor, shape_features)
     return body_part, mask_stats, raw_features
 
 
-def process_ct_and_segments(base_output_dir_ct: str, base_output_dir_seg: str, base_output_dir_results: str):
-    
-    base_output_dir_ct = Path(base_output_dir_ct)
-    base_output_dir_seg = Path(base_output_dir_seg)
-    base_output_dir_results = Path(base_output_dir_results)
+def extract_volumes_for_all_labels(series_id: str, ct_file: Path, seg_file: Path, json_file: Path, output_file: Path):
+    """
+    Compute the volume of every label of a segmentation without PyRadiomics.
+
+    The voxels of all labels are counted in one np.bincount over the label map and multiplied
+    by the voxel volume. As in the radiomics mode, volumes are measured on the CT grid: the
+    segmentation is resampled to the CT (in memory) if the grids differ, and only the CT
+    header is read. The output file has the schema of the radiomics mode, restricted to
+    shape_VoxelVolume, so get_volume_csv.py reads both.
+    """
+    import numpy as np
+    from label_maps import label_voxel_counts, read_label_map
+
+    label_id_body_part_df = get_label_id_body_part_df(json_file)
+    body_parts = dict(zip(label_id_body_part_df["label_id"], label_id_body_part_df["body_part"]))
+
+    seg_image = read_label_map(seg_file)
+    ct_reader = read_image_information(ct_file)
+    if not same_geometry(seg_image, ct_reader):
+        seg_image = resample_to_reference(seg_image, ct_reader)
+
+    voxel_counts = label_voxel_counts(seg_image)
+    voxel_volume = float(np.prod(seg_image.GetSpacing()))
+
+    stats = {}
+    for label in np.flatnonzero(voxel_counts[1:]) + 1:
+        body_part = body_parts.get(int(label))
+        if body_part is None:
+            print(f"[WARN] Label {label} of {seg_file} is not in {json_file}, skipping it.")
+            continue
+        stats[body_part] = {"shape_VoxelVolume": round(float(voxel_counts[label]) * voxel_volume, 4)}
+
+    with open(output_file, "w") as f:
+        json.dump(stats, f, indent=4)
+    print(f"[INFO] Volumes of {len(stats)} labels of series {series_id} saved to {output_file}")
+
+
+def validate_first_order_features(ct_file: Path, seg_file: Path, tolerance: float = 1e-6) -> bool:
+    """
+    Compare the vectorized firstorder features of every label with the ones PyRadiomics computes.
 
+    The segmentation is resampled to the CT as in the radiomics mode. A feature matches if its
+    absolute difference is at most `tolerance` times max(1, |PyRadiomics value|).
+
+    Returns:
+        True if all features of all labels match.
+    """
+    import numpy as np
+    import radiomics
+    import SimpleITK as sitk
+    from radiomics import featureextractor
+    from first_order_features import first_order_features
+    from label_maps import present_labels, read_label_map
+
+    image = sitk.ReadImage(str(ct_file))
+    segmentation = read_label_map(seg_file)
+    if not same_geometry(segmentation, image):
+        segmentation = resample_to_reference(segmentation, image)
+    labels = present_labels(segmentation)
+    feature_names = vectorized_first_order_features()
+
+    vectorized = first_order_features(
+        sitk.GetArrayViewFromImage(image),
+        sitk.GetArrayViewFromImage(segmentation),
+        labels,
+        voxel_volume=float(np.prod(image.GetSpacing())),
+        feature_names=feature_names,
+    )
+
+    radiomics.logger.setLevel(logging.WARNING)
+    extractor = featureextractor.RadiomicsFeatureExtractor(geometryTolerance=1e-3)
+    extractor.disableAllFeatures()
+    extractor.enableFeaturesByName(firstorder=feature_names)
+
+    num_mismatches = 0
+    for label in labels:
+        try:
+            reference = extractor.execute(image, segmentation, label=label)
+        except Exception as e:
+            print(f"[WARN] PyRadiomics failed on label {label}, not compared: {e}")
+            continue
+        for name in feature_names:
+            expected = float(reference[f"original_firstorder_{name}"])
+            difference = abs(vectorized[label][name] - expected)
+            if difference > tolerance * max(1.0, abs(expected)):
+                num_mismatches += 1
+                print(f"[MISMATCH] Label {label} {name}: vectorized {vectorized[label][name]}, PyRadiomics {expected}")
+
+    print(f"[INFO] Compared {len(feature_names)} firstorder features of {len(labels)} labels: {num_mismatches} mismatch(es)")
+    return num_mismatches == 0
+
+
+def find_segmentation_jobs(base_output_dir_ct: Path, base_output_dir_seg: Path, base_output_dir_results: Path):
+    """
+    Find every segmentation NIfTI below `base_output_dir_seg` together with its CT, meta.json and output file.
+
+    Returns:
+        A list of dictionaries with the keys series_id, ct_file, seg_file, json_file and output_file.
+    """
+    jobs = []
     for root, dirs, files in os.walk(base_output_dir_seg):
         root_path = Path(root)
 
@@ -399,16 +1044,71 @@ def process_ct_and_segments(base_output_dir_ct: str, base_output_dir_seg: str, b
             seg_stem = seg_file_path.stem  
             output_file = results_folder / f"{seg_stem}_features.json" 
 
-            extract_features_for_all_labels(
-                series_id=str(series_id),
-                ct_file=ct_nifti_file,
-                seg_file=seg_file_path,
-                json_file=meta_json_path,
-                output_file=output_file
+            jobs.append({
+                "series_id": str(series_id),
+                "ct_file": ct_nifti_file,
+                "seg_file": seg_file_path,
+                "json_file": meta_json_path,
+                "output_file": output_file,
+            })
+    return jobs
+
+
+def process_ct_and_segments(base_output_dir_ct: str, base_output_dir_seg: str, base_output_dir_results: str, volume_only: bool = False,
+                            profile_file: str = None, case_folders=None):
+    """
+    Extract the features of every segmentation NIfTI below `base_output_dir_seg`.
+
+    The radiomics features of all segmentations are extracted through one work queue
+    (extract_features_for_jobs), optionally writing a profile of the run to `profile_file`.
+    If `volume_only` is True, only the label volumes are computed
+    (extract_volumes_for_all_labels) instead of the PyRadiomics shape and firstorder features.
+    If `case_folders` is given, only the CT folders at these paths relative to the base
+    directories (e.g. <PatientID>/<StudyInstanceUID>/CT_<SeriesInstanceUID>) are processed.
+    """
+    if case_folders is None:
+        jobs = find_segmentation_jobs(Path(base_output_dir_ct), Path(base_output_dir_seg), Path(base_output_dir_results))
+    else:
+        jobs = []
+        for case_folder in case_folders:
+            if not Path(base_output_dir_seg, case_folder).is_dir():
+                print(f"[WARN] {Path(base_output_dir_seg, case_folder)} does not exist, skipping.")
+                continue
+            jobs += find_segmentation_jobs(
+                Path(base_output_dir_ct, case_folder), Path(base_output_dir_seg, case_folder), Path(base_output_dir_results, case_folder)
             )
 
+    if volume_only:
+        for job in jobs:
+            extract_volumes_for_all_labels(**job)
+    else:
+        extract_features_for_jobs(jobs, profile_file=profile_file)
+
 if __name__ == "__main__":
 
+    # Optional profile of the radiomics mode: --profile <jsonl_file>
+    profile_file = None
+    if "--profile" in sys.argv:
+        position = sys.argv.index("--profile")
+        if position + 1 >= len(sys.argv):
+            print("Usage: --profile <jsonl_file>")
+            sys.exit(1)
+        profile_file = sys.argv[position + 1]
+        del sys.argv[position:position + 2]
+        if len(sys.argv) < 2 or sys.argv[1].lower() != "radiomics":
+            print("Usage: --profile <jsonl_file> is only supported by the radiomics mode")
+            sys.exit(1)
+
+    # Restrict the radiomics and volume modes to some CT folders: --case <relative_ct_folder> (repeatable)
+    case_folders = None
+    while "--case" in sys.argv:
+        position = sys.argv.index("--case")
+        if position + 1 >= len(sys.argv):
+            print("Usage: --case <relative_ct_folder>")
+            sys.exit(1)
+        case_folders = (case_folders or []) + [sys.argv[position + 1]]
+        del sys.argv[position:position + 2]
+
     if len(sys.argv) < 2:
         print(
             "Usage:\n"
@@ -417,7 +1117,14 @@ if __name__ == "__main__":
             "<dicom_input_dir> <dicom_output_dir> <dcm2niix_path> <segimage2itkimage_path>\n\n"
             "  Extract radiomics:\n"
             "    python radiomics_pipeline.py radiomics "
-            "<ct_nifti_base_dir> <seg_nifti_base_dir> <results_dir>"
+            "<ct_nifti_base_dir> <seg_nifti_base_dir> <results_dir> [--profile <jsonl_file>] [--case <relative_ct_folder> ...]\n\n"
+            "  Extract volumes only:\n"
+            "    python radiomics_pipeline.py volume "
+            "<ct_nifti_base_dir> <seg_nifti_base_dir> <results_dir> [--case <relative_ct_folder> ...]\n\n"
+            "  Download the radiomics feature map again (requires network access):\n"
+            "    python radiomics_pipeline.py refresh-feature-map [<url>]\n\n"
+            "  Check the vectorized firstorder features against PyRadiomics:\n"
+            "    python radiomics_pipeline.py validate-firstorder <ct_nifti_file> <seg_nifti_file>"
         )
         sys.exit(1)
 
@@ -445,11 +1152,11 @@ if __name__ == "__main__":
             segimage2itkimage_path=segimage2itkimage_path,
         )
 
-    elif mode == "radiomics":
+    elif mode in ("radiomics", "volume"):
         if len(sys.argv) != 5:
             print(
                 "Usage:\n"
-                "  python radiomics_pipeline.py radiomics "
+                f"  python radiomics_pipeline.py {mode} "
                 "<ct_nifti_base_dir> <seg_nifti_base_dir> <results_dir>"
             )
             sys.exit(1)
@@ -462,8 +1169,33 @@ if __name__ == "__main__":
             base_output_dir_ct=ct_nifti_base_dir,
             base_output_dir_seg=seg_nifti_base_dir,
             base_output_dir_results=results_dir,
+            volume_only=(mode == "volume"),
+            profile_file=profile_file,
+            case_folders=case_folders,
         )
 
+    elif mode == "refresh-feature-map":
+        if len(sys.argv) > 3:
+            print(
+                "Usage:\n"
+                "  python radiomics_pipeline.py refresh-feature-map [<url>]"
+            )
+            sys.exit(1)
+
+        if not refresh_feature_map(*sys.argv[2:]):
+            sys.exit(1)
+
+    elif mode == "validate-firstorder":
+        if len(sys.argv) != 4:
+            print(
+                "Usage:\n"
+                "  python radiomics_pipeline.py validate-firstorder <ct_nifti_file> <seg_nifti_file>"
+            )
+            sys.exit(1)
+
+        if not validate_first_order_features(Path(sys.argv[2]), Path(sys.argv[3])):
+            sys.exit(1)
+
     else:
-        print(f"Unknown mode '{mode}'. Use 'convert' or 'radiomics'.")
+        print(f"Unknown mode '{mode}'. Use 'convert', 'radiomics', 'volume', 'refresh-feature-map' or 'validate-firstorder'.")
         sys.exit(1)
@@ -0,0 +1,130 @@
+# Optional profile of a radiomics extraction run: one JSON line per segmentation and per label task, plus a summary
+# of the slowest structures. Only standard-library modules are used, so worker processes stay light.
+from collections import defaultdict
+import json
+import sys
+import time
+
+
+# Number of slowest label tasks listed in the summary report
+SUMMARY_TOP_TASKS = 20
+
+
+def peak_rss() -> int:
+    # Highest resident set size of this process so far, in bytes
+    try:
+        import resource
+    except ImportError:
+        import psutil
+
+        return psutil.Process().memory_info().rss
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Stopwatch:
+    """
+    Accumulate the wall time of named phases, e.g. timings["io"] += elapsed.
+
+    Usage:
+        stopwatch = Stopwatch()
+        with stopwatch("io"):
+            image = sitk.ReadImage(path)
+    """
+
+    def __init__(self):
+        self.timings = defaultdict(float)
+        self._phase = None
+
+    def __call__(self, phase):
+        self._phase = phase
+        return self
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings[self._phase] += time.perf_counter() - self._start
+        return False
+
+
+class ExtractionProfile:
+    """
+    Write profiling records of an extraction run as JSON lines and summarize them at the end.
+
+    Two kinds of records are written:
+        - "segmentation": the work done once per segmentation in the main process (reading the
+          images, resampling, finding the bounding boxes, the firstorder pass, writing the
+          output files), in seconds.
+        - "label": one PyRadiomics task: the time it waited in the work queue, its wall and CPU
+          time in the worker, the worker's peak RSS so far, the time spent cropping it and the
+          number of voxels of the crop.
+
+    close() writes a summary report of the slowest structures next to the JSON lines file
+    (`<profile_file>.summary.txt`) and prints it.
+    """
+
+    def __init__(self, profile_file):
+        self.profile_file = str(profile_file)
+        self._file = open(self.profile_file, "w")
+        self._segmentations = []
+        self._labels = []
+        self._start = time.perf_counter()
+
+    def _write(self, record):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def record_segmentation(self, series_id, seg_file, num_labels, timings):
+        record = {"record": "segmentation", "series_id": series_id, "seg_file": str(seg_file), "num_labels": num_labels}
+        record.update({f"{phase}_time": round(seconds, 4) for phase, seconds in timings.items()})
+        self._segmentations.append(record)
+        self._write(record)
+
+    def record_label(self, series_id, seg_file, label, body_part, task_timings):
+        record = {"record": "label", "series_id": series_id, "seg_file": str(seg_file), "label": label, "body_part": body_part}
+        record.update(task_timings)
+        self._labels.append(record)
+        self._write(record)
+
+    def summary(self):
+        total_time = time.perf_counter() - self._start
+        lines = [f"Radiomics extraction profile ({self.profile_file})", f"Total wall time: {total_time:.1f} s", ""]
+
+        phase_totals = defaultdict(float)
+        for record in self._segmentations:
+            for key, value in record.items():
+                if key.endswith("_time"):
+                    phase_totals[key[:-len("_time")]] += value
+        for key in ("queue_time", "wall_time", "cpu_time"):
+            phase_totals[f"label task {key[:-len('_time')]}"] = sum(record[key] for record in self._labels)
+        lines.append(f"Time per phase over {len(self._segmentations)} segmentations and {len(self._labels)} label tasks:")
+        for phase, seconds in sorted(phase_totals.items(), key=lambda item: -item[1]):
+            lines.append(f"  {phase:<24} {seconds:10.1f} s")
+
+        by_structure = defaultdict(list)
+        for record in self._labels:
+            by_structure[record["body_part"]].append(record)
+        lines += ["", "Structures by total task time:", f"  {'structure':<40} {'tasks':>5} {'total s':>9} {'mean s':>8} {'max voxels':>12}"]
+        for body_part, records in sorted(by_structure.items(), key=lambda item: -sum(r["wall_time"] for r in item[1]))[:SUMMARY_TOP_TASKS]:
+            total = sum(r["wall_time"] for r in records)
+            lines.append(
+                f"  {body_part:<40} {len(records):>5} {total:>9.1f} {total / len(records):>8.2f} {max(r['crop_voxels'] for r in records):>12}"
+            )
+
+        lines += ["", f"Slowest {SUMMARY_TOP_TASKS} label tasks:", f"  {'structure':<40} {'wall s':>8} {'cpu s':>8} {'queue s':>8} {'peak RSS MiB':>13}  series"]
+        for record in sorted(self._labels, key=lambda r: -r["wall_time"])[:SUMMARY_TOP_TASKS]:
+            lines.append(
+                f"  {record['body_part']:<40} {record['wall_time']:>8.2f} {record['cpu_time']:>8.2f} "
+                f"{record['queue_time']:>8.2f} {record['peak_rss'] / 1024 ** 2:>13.0f}  {record['series_id']}"
+            )
+        return "\n".join(lines)
+
+    def close(self):
+        self._file.close()
+        report = self.summary()
+        with open(self.profile_file + ".summary.txt", "w") as f:
+            f.write(report + "\n")
+        print(report)
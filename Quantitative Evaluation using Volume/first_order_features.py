@@ -0,0 +1,131 @@
+# Vectorized first-order intensity features of all labels of a label map in one pass, following the
+# definitions of PyRadiomics' firstorder feature class (default settings: binWidth 25, voxelArrayShift 0)
+import numpy as np
+
+
+FIRST_ORDER_FEATURES = (
+    "10Percentile", "90Percentile", "Energy", "Entropy", "InterquartileRange", "Kurtosis", "Maximum",
+    "MeanAbsoluteDeviation", "Mean", "Median", "Minimum", "Range", "RobustMeanAbsoluteDeviation",
+    "RootMeanSquared", "Skewness", "TotalEnergy", "Uniformity", "Variance",
+)
+
+
+def _segment_sums(values, starts):
+    # Sum of `values` over the consecutive segments beginning at `starts`
+    return np.add.reduceat(values, starts) if len(values) else np.zeros(len(starts))
+
+
+def _segment_percentiles(sorted_values, starts, counts, q):
+    # Linear-interpolation percentile of every sorted segment, computed like np.percentile
+    positions = (counts - 1) * (q / 100.0)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.minimum(lower + 1, counts - 1)
+    a = sorted_values[starts + lower]
+    b = sorted_values[starts + upper]
+    t = positions - lower
+    return np.where(t >= 0.5, b - (b - a) * (1 - t), a + (b - a) * t)
+
+
+def first_order_features(image_array, label_array, labels, voxel_volume, bin_width=25, voxel_array_shift=0,
+                         feature_names=FIRST_ORDER_FEATURES):
+    """
+    Compute PyRadiomics first-order features of many labels at once.
+
+    Instead of masking and scanning the image once per label, the (label, intensity) pairs of
+    all labelled voxels are sorted once; every feature is then a segmented reduction over the
+    sorted array. Entropy and Uniformity use the same fixed bin width discretization as
+    PyRadiomics: bins start at a multiple of the bin width below each label's minimum, so the
+    bin counts only depend on floor(intensity / bin_width).
+
+    Args:
+        image_array: Intensity array (e.g. the CT in HU).
+        label_array: Integer label map of the same shape.
+        labels: Labels to compute the features for; labels without voxels are left out.
+        voxel_volume: Volume of one voxel in mm^3 (for TotalEnergy).
+        bin_width: Bin width of the discretization used by Entropy and Uniformity.
+        voxel_array_shift: Shift added to the intensities by Energy, TotalEnergy and RootMeanSquared.
+        feature_names: Features to return.
+
+    Returns:
+        A dictionary mapping each label with at least one voxel to a dictionary of feature values.
+    """
+    label_flat = np.asarray(label_array).reshape(-1)
+    image_flat = np.asarray(image_array).reshape(-1)
+
+    selected = np.isin(label_flat, np.asarray(list(labels), dtype=label_flat.dtype))
+    voxel_labels = label_flat[selected]
+    voxel_values = image_flat[selected]
+    del selected
+    if not len(voxel_values):
+        return {}
+
+    # One sort by (label, intensity); each label becomes a contiguous, sorted segment
+    order = np.lexsort((voxel_values, voxel_labels))
+    voxel_labels = voxel_labels[order]
+    values = voxel_values[order].astype(np.float64)
+    del order, voxel_values
+
+    starts = np.flatnonzero(np.r_[True, voxel_labels[1:] != voxel_labels[:-1]]) if len(values) else np.zeros(0, dtype=np.int64)
+    segment_labels = voxel_labels[starts]
+    counts = np.diff(np.r_[starts, len(values)])
+    segment_ids = np.repeat(np.arange(len(starts)), counts)
+
+    minimum = values[starts]
+    maximum = values[starts + counts - 1]
+    mean = _segment_sums(values, starts) / counts
+    deviations = values - mean[segment_ids]
+    m2 = _segment_sums(deviations ** 2, starts) / counts
+    m3 = _segment_sums(deviations ** 3, starts) / counts
+    m4 = _segment_sums(deviations ** 4, starts) / counts
+    mean_absolute_deviation = _segment_sums(np.abs(deviations), starts) / counts
+    del deviations
+    energy = _segment_sums((values + voxel_array_shift) ** 2, starts)
+
+    percentiles = {q: _segment_percentiles(values, starts, counts, q) for q in (10, 25, 50, 75, 90)}
+
+    # Mean absolute deviation of the voxels between the 10th and 90th percentile
+    in_range = (values >= percentiles[10][segment_ids]) & (values <= percentiles[90][segment_ids])
+    robust_counts = np.bincount(segment_ids[in_range], minlength=len(starts))
+    robust_mean = np.bincount(segment_ids[in_range], weights=values[in_range], minlength=len(starts)) / robust_counts
+    robust_mean_absolute_deviation = np.bincount(
+        segment_ids[in_range], weights=np.abs(values[in_range] - robust_mean[segment_ids[in_range]]), minlength=len(starts)
+    ) / robust_counts
+    del in_range
+
+    # Bin counts per label: values are sorted within a label, so equal bins form runs
+    bins = np.floor(values / bin_width)
+    run_starts = np.flatnonzero(np.r_[True, (bins[1:] != bins[:-1]) | (segment_ids[1:] != segment_ids[:-1])])
+    run_probabilities = np.diff(np.r_[run_starts, len(values)]) / counts[segment_ids[run_starts]]
+    run_segments = segment_ids[run_starts]
+    entropy = -np.bincount(
+        run_segments, weights=run_probabilities * np.log2(run_probabilities + np.spacing(1)), minlength=len(starts)
+    )
+    uniformity = np.bincount(run_segments, weights=run_probabilities ** 2, minlength=len(starts))
+
+    # Flat regions (no variance) have a skewness and kurtosis of 0, as in PyRadiomics
+    flat = m2 == 0
+    m2_safe = np.where(flat, 1, m2)
+    features = {
+        "10Percentile": percentiles[10],
+        "90Percentile": percentiles[90],
+        "Energy": energy,
+        "Entropy": entropy,
+        "InterquartileRange": percentiles[75] - percentiles[25],
+        "Kurtosis": np.where(flat, 0, m4) / m2_safe ** 2,
+        "Maximum": maximum,
+        "MeanAbsoluteDeviation": mean_absolute_deviation,
+        "Mean": mean,
+        "Median": percentiles[50],
+        "Minimum": minimum,
+        "Range": maximum - minimum,
+        "RobustMeanAbsoluteDeviation": robust_mean_absolute_deviation,
+        "RootMeanSquared": np.sqrt(energy / counts),
+        "Skewness": np.where(flat, 0, m3) / m2_safe ** 1.5,
+        "TotalEnergy": voxel_volume * energy,
+        "Uniformity": uniformity,
+        "Variance": m2,
+    }
+    return {
+        int(label): {name: float(features[name][i]) for name in feature_names}
+        for i, label in enumerate(segment_labels)
+    }
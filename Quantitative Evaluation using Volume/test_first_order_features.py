@@ -0,0 +1,118 @@
+# Checks the vectorized firstorder features against a per-label transcription of PyRadiomics' firstorder formulas
+import numpy as np
+import pytest
+
+from first_order_features import FIRST_ORDER_FEATURES, first_order_features
+
+
+def reference_features(values, voxel_volume, bin_width=25, voxel_array_shift=0):
+    # The firstorder feature class of PyRadiomics (radiomics/firstorder.py) for the voxels of one label
+    values = np.asarray(values, dtype=np.float64)
+    count = values.size
+
+    # Fixed bin width discretization (radiomics.imageoperations.getBinEdges and binImage)
+    minimum, maximum = values.min(), values.max()
+    low_bound = minimum - (minimum % bin_width)
+    high_bound = maximum + 2 * bin_width
+    bin_edges = np.arange(low_bound, high_bound, bin_width)
+    if len(bin_edges) == 1:
+        bin_edges = [bin_edges[0] - 0.5, bin_edges[0] + 0.5]
+    binned = np.digitize(values, bin_edges)
+    histogram = np.bincount(binned)[1:]
+    probabilities = histogram[histogram > 0] / count
+
+    mean = values.mean()
+    deviations = values - mean
+    m2 = np.mean(deviations ** 2)
+    m3 = np.mean(deviations ** 3)
+    m4 = np.mean(deviations ** 4)
+    p10, p25, median, p75, p90 = np.percentile(values, [10, 25, 50, 75, 90])
+    robust = values[(values >= p10) & (values <= p90)]
+    energy = np.sum((values + voxel_array_shift) ** 2)
+    return {
+        "10Percentile": p10,
+        "90Percentile": p90,
+        "Energy": energy,
+        "Entropy": -np.sum(probabilities * np.log2(probabilities + np.spacing(1))),
+        "InterquartileRange": p75 - p25,
+        "Kurtosis": 0.0 if m2 == 0 else m4 / m2 ** 2,
+        "Maximum": maximum,
+        "MeanAbsoluteDeviation": np.mean(np.abs(deviations)),
+        "Mean": mean,
+        "Median": median,
+        "Minimum": minimum,
+        "Range": maximum - minimum,
+        "RobustMeanAbsoluteDeviation": np.mean(np.abs(robust - robust.mean())),
+        "RootMeanSquared": np.sqrt(energy / count),
+        "Skewness": 0.0 if m2 == 0 else m3 / m2 ** 1.5,
+        "TotalEnergy": voxel_volume * energy,
+        "Uniformity": np.sum(probabilities ** 2),
+        "Variance": m2,
+    }
+
+
+def assert_matches_reference(image, label_map, labels, voxel_volume=1.0, **settings):
+    features = first_order_features(image, label_map, labels, voxel_volume, **settings)
+    present = [label for label in labels if np.any(label_map == label)]
+    assert sorted(features) == sorted(present)
+    for label in present:
+        expected = reference_features(image[label_map == label], voxel_volume, **settings)
+        assert set(features[label]) == set(FIRST_ORDER_FEATURES)
+        for name in FIRST_ORDER_FEATURES:
+            assert features[label][name] == pytest.approx(expected[name], rel=1e-9, abs=1e-9), (label, name)
+
+
+def test_random_labels():
+    rng = np.random.default_rng(0)
+    image = rng.normal(0, 300, size=(12, 20, 24)).round().astype(np.int16)
+    label_map = rng.integers(0, 8, size=image.shape).astype(np.uint8)
+    assert_matches_reference(image, label_map, range(1, 8), voxel_volume=0.7 * 0.7 * 2.5)
+
+
+def test_float_image_and_settings():
+    rng = np.random.default_rng(1)
+    image = rng.uniform(-1024, 2000, size=(6, 30, 30)).astype(np.float32)
+    label_map = rng.integers(0, 4, size=image.shape).astype(np.int32)
+    assert_matches_reference(image, label_map, [1, 2, 3], voxel_volume=3.0, bin_width=10, voxel_array_shift=1000)
+
+
+def test_constant_region():
+    image = np.full((4, 5, 6), 37, dtype=np.int16)
+    label_map = np.zeros(image.shape, dtype=np.uint8)
+    label_map[1:3, 1:4, 2:5] = 1
+    label_map[0, 0, :] = 2
+    image[0, 0, :] = -1000
+    assert_matches_reference(image, label_map, [1, 2])
+    features = first_order_features(image, label_map, [1], 1.0)[1]
+    assert features["Entropy"] == pytest.approx(0.0, abs=1e-12)
+    assert features["Uniformity"] == 1.0
+    assert features["Skewness"] == features["Kurtosis"] == features["Variance"] == 0.0
+
+
+def test_single_voxel():
+    image = np.arange(60, dtype=np.int16).reshape(3, 4, 5) - 30
+    label_map = np.zeros(image.shape, dtype=np.uint8)
+    label_map[1, 2, 3] = 5
+    assert_matches_reference(image, label_map, [5], voxel_volume=2.0)
+    features = first_order_features(image, label_map, [5], 2.0)[5]
+    assert features["Minimum"] == features["Maximum"] == features["Median"] == features["10Percentile"] == image[1, 2, 3]
+
+
+def test_bin_edges():
+    # Intensities exactly on and next to multiples of the bin width, including negative ones
+    values = np.array([-50, -25, -25.0001, -24.9999, 0, 0.0001, 24.9999, 25, 50, 75, 75, 99.9999, 100])
+    image = np.tile(values, (2, 1)).reshape(2, 1, -1)
+    label_map = np.zeros(image.shape, dtype=np.uint8)
+    label_map[0] = 1
+    label_map[1, 0, 4:] = 2
+    assert_matches_reference(image, label_map, [1, 2])
+
+
+def test_absent_and_unrequested_labels():
+    rng = np.random.default_rng(2)
+    image = rng.integers(-200, 200, size=(5, 6, 7)).astype(np.int16)
+    label_map = rng.integers(0, 4, size=image.shape).astype(np.uint16)
+    features = first_order_features(image, label_map, [2, 3, 9], 1.0)
+    assert sorted(features) == [2, 3]
+    assert_matches_reference(image, label_map, [2, 3, 9])
+    assert first_order_features(image, label_map, [9], 1.0) == {}
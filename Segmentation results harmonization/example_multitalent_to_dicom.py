@@ -4,6 +4,9 @@ import subprocess
 import pydicom
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from series_index import ct_folders_by_uid, load_series_index
+
 if len(sys.argv) != 6:
     print(
         "Usage: python convert_to_dicom_seg.py "
@@ -20,6 +23,10 @@ itkimage2segimage_path = sys.argv[5]
 
 os.makedirs(output_base_dir, exist_ok=True)
 
+# SeriesInstanceUID -> CT_<SeriesInstanceUID> folder, read from the series index of the DICOM base directory,
+# which is kept in the output directory
+dicom_folders = ct_folders_by_uid(load_series_index(dicom_base_dir, index_dir=output_base_dir))
+
 def extract_dicom_metadata(dicom_folder):
     for dicom_file in os.listdir(dicom_folder):
         dicom_path = os.path.join(dicom_folder, dicom_file)
@@ -67,45 +74,10 @@ for study_id in os.listdir(nifti_base_dir):
     output_dir = os.path.join(output_base_dir, study_id)
     os.makedirs(output_dir, exist_ok=True)
 
-    dicom_ct_folder = None  
-
-    for patient_folder in os.listdir(dicom_base_dir):
-        if patient_folder.startswith("."):
-            continue
-
-        patient_path = os.path.join(dicom_base_dir, patient_folder)
-        if not os.path.isdir(patient_path):
-            continue
-
-        for study_folder in os.listdir(patient_path):
-            if study_folder.startswith("."):
-                continue
-
-            study_folder_path = os.path.join(patient_path, study_folder)
-            if not os.path.isdir(study_folder_path):
-                continue
-
-            for series_folder in os.listdir(study_folder_path):
-                if series_folder.startswith("."):
-                    continue
-
-                series_path = os.path.join(study_folder_path, series_folder)
-                if not os.path.isdir(series_path):
-                    continue
-
-                if series_folder.startswith("CT_"):
-                    ct_id = series_folder.split("_")[1] 
-                    if ct_id == study_id:
-                        dicom_ct_folder = series_path
-                        print(f"Found DICOM CT folder: {dicom_ct_folder} for CT {study_id}")
-                        break
-
-            if dicom_ct_folder:
-                break
-        if dicom_ct_folder:
-            break
+    dicom_ct_folder = dicom_folders.get(study_id)
 
     if dicom_ct_folder:
+        print(f"Found DICOM CT folder: {dicom_ct_folder} for CT {study_id}")
         output_seg_file = os.path.join(output_dir, f"SEG_MultiTalent_CT_{study_id}.dcm")
         series_description, series_number = extract_dicom_metadata(dicom_ct_folder)
                 
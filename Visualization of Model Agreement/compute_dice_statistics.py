@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import os
 import sys
 import numpy as np
 import pandas as pd
@@ -6,6 +7,18 @@ import pandas as pd
 
 def load_results(csv_file):
 
+    if os.path.isdir(csv_file) or csv_file.endswith(".parquet"):
+        # Long-format Dice table written by analyze_disagreement_dice_score.py (<output_nii>/results/dice)
+        df_long = pd.read_parquet(csv_file, columns=["CT_SeriesInstanceUID", "Structure", "Model", "Dice_Score"])
+        df_results = df_long.pivot_table(
+            values="Dice_Score",
+            index="Structure",
+            columns=["CT_SeriesInstanceUID", "Model"],
+            aggfunc="first"
+        )
+        df_results.columns = [f"{case_id}_{model}" for case_id, model in df_results.columns]
+        return df_results.reset_index()
+
     df_results = pd.read_csv(csv_file, skiprows=1)
     df_results = df_results.rename(columns={df_results.columns[0]: "Structure"})
     df_results = df_results.iloc[1:].reset_index(drop=True)
@@ -33,7 +46,7 @@ def compute_statistics(df_results: pd.DataFrame) -> pd.DataFrame:
 
 if __name__ == "__main__":
     if len(sys.argv) != 3:
-        print("Usage: python compute_dice_statistics.py <input_scores_csv> <output_stats_csv>")
+        print("Usage: python compute_dice_statistics.py <input_scores_csv | results/dice> <output_stats_csv>")
         sys.exit(1)
 
     input_csv = sys.argv[1]
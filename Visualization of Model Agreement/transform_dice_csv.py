@@ -1,3 +1,4 @@
+import os
 import pandas as pd
 import re
 import sys
@@ -11,7 +12,29 @@ def clean_method_name(method):
 
     return re.sub(r"\.\d+$", "", method)
 
+def is_results_store(input_path):
+    # Long-format Dice table written by analyze_disagreement_dice_score.py (<output_nii>/results/dice)
+    return os.path.isdir(input_path) or input_path.endswith(".parquet")
+
+
+def load_results_store(input_path):
+    df = pd.read_parquet(input_path, columns=["CT_SeriesInstanceUID", "Structure", "Model", "Dice_Score"])
+    df = df.rename(columns={
+        "Structure": "segment",
+        "Model": "method",
+        "Dice_Score": "dsc",
+        "CT_SeriesInstanceUID": "caseID"
+    })
+    return df[["segment", "method", "dsc", "caseID"]]
+
+
 def transform_csv(input_path, output_path):
+    if is_results_store(input_path):
+        # Already in long format, no un-pivoting needed
+        load_results_store(input_path).to_csv(output_path, index=False, na_rep="")
+        print(f"Saved transformed CSV to: {output_path}")
+        return
+
     df = pd.read_csv(input_path, header=None)
 
     case_ids = df.iloc[0, 1:].fillna("Unknown_Case").astype(str).tolist()
@@ -41,7 +64,7 @@ def transform_csv(input_path, output_path):
 
 if __name__ == "__main__":
     if len(sys.argv) != 3:
-        print("Usage: python transform_csv.py <input_pivot_csv> <output_long_csv>")
+        print("Usage: python transform_csv.py <input_pivot_csv | results/dice> <output_long_csv>")
         sys.exit(1)
 
     transform_csv(sys.argv[1], sys.argv[2])
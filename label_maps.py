@@ -0,0 +1,102 @@
+# Memory-bounded loading of integer label maps (segmentation NIfTI/NRRD files) in their compact on-disk data type
+import numpy as np
+import SimpleITK as sitk
+
+
+# Voxels counted per np.bincount call; bincount works on an intp copy of its input, so counting in chunks
+# bounds that copy to 8 bytes per chunk voxel instead of 8 bytes per voxel of the whole label map
+COUNT_CHUNK_VOXELS = 1 << 24
+
+_COMPACT_PIXEL_TYPES = {np.uint8: sitk.sitkUInt8, np.uint16: sitk.sitkUInt16, np.uint32: sitk.sitkUInt32}
+
+
+def compact_label_dtype(num_labels):
+    # Smallest unsigned integer type that holds the label values 0 .. num_labels - 1
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if num_labels <= np.iinfo(dtype).max + 1:
+            return dtype
+    return np.uint64
+
+
+def read_label_map(path):
+    """
+    Read a label map as a SimpleITK image without widening its data type.
+
+    Integer label maps keep their on-disk type (e.g. 1 byte per voxel for UInt8). Label maps
+    stored as floating point are cast to the smallest unsigned type that holds their largest
+    label, instead of being converted to float64 like nibabel's get_fdata(). A ValueError is
+    raised for floating point label maps with negative values.
+    """
+    image = sitk.ReadImage(str(path))
+    if image.GetPixelID() in (sitk.sitkFloat32, sitk.sitkFloat64):
+        statistics = sitk.MinimumMaximumImageFilter()
+        statistics.Execute(image)
+        if statistics.GetMinimum() < 0:
+            raise ValueError(f"Label map {path} contains negative labels (minimum {statistics.GetMinimum()})")
+        dtype = compact_label_dtype(int(statistics.GetMaximum()) + 1)
+        image = sitk.Cast(image, _COMPACT_PIXEL_TYPES.get(dtype, sitk.sitkUInt64))
+    return image
+
+
+def label_voxel_counts(label_map, chunk_voxels=COUNT_CHUNK_VOXELS):
+    """
+    Count the voxels of every label value in one pass over a label map.
+
+    Args:
+        label_map: SimpleITK image or NumPy array with non-negative integer labels.
+        chunk_voxels: Maximum number of voxels counted at once, which bounds the temporary memory.
+
+    Returns:
+        An int64 array whose entry i is the number of voxels with label i.
+
+    Raises:
+        ValueError: If the label map is not an integer map, contains negative labels (signed
+            types), or labels beyond the range of np.intp (uint64), which np.bincount cannot count.
+    """
+    array = sitk.GetArrayViewFromImage(label_map) if isinstance(label_map, sitk.Image) else np.asarray(label_map)
+    if not np.issubdtype(array.dtype, np.integer):
+        raise ValueError(f"Label maps must have an integer data type, got {array.dtype}")
+    flat = array.reshape(-1)
+    counts = np.zeros(1, dtype=np.int64)
+    for start in range(0, flat.size, chunk_voxels):
+        chunk = flat[start:start + chunk_voxels]
+        if np.issubdtype(chunk.dtype, np.signedinteger) and chunk.size and chunk.min() < 0:
+            raise ValueError(f"Label maps must not contain negative labels, found {int(chunk.min())}")
+        if chunk.dtype == np.uint64:
+            # np.bincount only accepts values it can cast to intp safely
+            if chunk.size and chunk.max() > np.iinfo(np.intp).max:
+                raise ValueError(f"Label {int(chunk.max())} is too large to be counted")
+            chunk = chunk.astype(np.intp)
+        chunk_counts = np.bincount(chunk)
+        if len(chunk_counts) > len(counts):
+            counts = np.pad(counts, (0, len(chunk_counts) - len(counts)))
+        counts[:len(chunk_counts)] += chunk_counts
+    return counts
+
+
+def present_labels(label_map, chunk_voxels=COUNT_CHUNK_VOXELS):
+    # Non-zero labels with at least one voxel, in ascending order
+    counts = label_voxel_counts(label_map, chunk_voxels)
+    return [int(label) for label in np.flatnonzero(counts[1:]) + 1]
+
+
+def label_bounding_boxes(label_map):
+    """
+    Find the bounding box of every non-zero label of a label map in one pass.
+
+    Args:
+        label_map: SimpleITK image with non-negative integer labels.
+
+    Returns:
+        A dictionary mapping each label with at least one voxel, in ascending order, to its
+        bounding box as (index, size) tuples in SimpleITK (x, y, z) order.
+    """
+    statistics = sitk.LabelShapeStatisticsImageFilter()
+    statistics.SetComputePerimeter(False)
+    statistics.Execute(label_map)
+    boxes = {}
+    for label in sorted(statistics.GetLabels()):
+        bounding_box = statistics.GetBoundingBox(label)
+        dimension = len(bounding_box) // 2
+        boxes[int(label)] = (bounding_box[:dimension], bounding_box[dimension:])
+    return boxes
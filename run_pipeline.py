@@ -0,0 +1,800 @@
+#!/usr/bin/env python3
+# Runs the whole workflow (harmonization, Dice/consensus, consensus SEG, NIfTI conversion, radiomics, volume CSV,
+# plots) as one dependency graph of stages, caching the result of every stage per CT series in the work directory
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+from series_index import find_ct_folders, find_seg_files, load_series_index
+
+REPO_FOLDER = os.path.dirname(os.path.abspath(__file__))
+DICE_SCRIPTS = os.path.join(REPO_FOLDER, "Quantitative Evaluation using Dice Score")
+CONVERT_SCRIPTS = os.path.join(REPO_FOLDER, "Convert consensus to DICOM")
+VOLUME_SCRIPTS = os.path.join(REPO_FOLDER, "Quantitative Evaluation using Volume")
+VISUALIZATION_SCRIPTS = os.path.join(REPO_FOLDER, "Visualization of Model Agreement")
+# The in-process stages import the functions of the stage scripts; each module is only imported by the stage using it
+for folder in (CONVERT_SCRIPTS, VOLUME_SCRIPTS, VISUALIZATION_SCRIPTS):
+    sys.path.insert(0, folder)
+
+# Layout of the work directory. The per-case folders mirror <PatientID>/<StudyInstanceUID>/CT_<SeriesInstanceUID>
+CONSENSUS_DIR = "consensus"
+CONSENSUS_SEG_DIR = "consensus_seg"
+NIFTI_DIR = "nifti"
+FEATURES_DIR = "features"
+PLOTS_DIR = "plots"
+CONSENSUS_SEG_FILE = "SEG_Consensus.dcm"
+DICE_CSV = "dice_scores_transformed.csv"
+DICE_STATISTICS_CSV = "dice_statistics.csv"
+VOLUME_CSV = "segmentation_volumes.csv"
+
+CACHE_FILE = "pipeline_cache.json"
+CACHE_VERSION = 1
+
+REQUIRED_CONFIG = ("dicom_base_dir", "work_dir", "structure_overview_csv", "structure_codes_csv")
+DEFAULT_CONFIG = {
+    "harmonization": [],
+    "dice_arguments": [],
+    "dcm2niix": "dcm2niix",
+    "segimage2itkimage": "segimage2itkimage",
+    "itkimage2segimage": None,
+    "radiomics_mode": "radiomics",
+    "plots": False,
+}
+
+
+# -------------------------------------------------------------------------
+# Fingerprints of stage inputs
+# -------------------------------------------------------------------------
+
+def file_state(path):
+    # Size and modification time of a file, or None if it does not exist
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def tree_state(folder, include=None):
+    # File states of all files below `folder` by relative path, optionally only the file names accepted by `include`
+    states = {}
+    for root, _, files in os.walk(folder):
+        for file_name in files:
+            if include is None or include(file_name):
+                path = os.path.join(root, file_name)
+                states[os.path.relpath(path, folder)] = file_state(path)
+    return states
+
+
+@lru_cache(maxsize=None)
+def code_hash(path):
+    # Content hash of a stage script, so results computed by an older version are not reused
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def input_hash(inputs):
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def read_table(csv_file):
+    # The structure tables are read once per run and shared by all cases
+    import pandas as pd
+
+    return pd.read_csv(csv_file, delimiter=",")
+
+
+# -------------------------------------------------------------------------
+# Stage cache
+# -------------------------------------------------------------------------
+
+def empty_cache():
+    return {"version": CACHE_VERSION, "stages": {}}
+
+
+def load_cache(work_dir):
+    """Load the stage cache of a previous run, or return an empty one if there is none or it is unreadable."""
+    cache_path = os.path.join(work_dir, CACHE_FILE)
+    if not os.path.exists(cache_path):
+        return empty_cache()
+    try:
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Could not read stage cache {cache_path}, running all stages: {e}")
+        return empty_cache()
+    if cache.get("version") != CACHE_VERSION:
+        return empty_cache()
+    return cache
+
+
+def save_cache(work_dir, cache):
+    # Write to a temporary file first, so an interrupted run never leaves a truncated cache
+    os.makedirs(work_dir, exist_ok=True)
+    cache_path = os.path.join(work_dir, CACHE_FILE)
+    temp_path = cache_path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(cache, f)
+    os.replace(temp_path, cache_path)
+
+
+class Pipeline:
+    """
+    Settings, CT series and stage cache of one run.
+
+    Cases are identified by the path of their CT_<SeriesInstanceUID> folder relative to the DICOM
+    base directory. Stages can pass results to a later stage of the same case in memory with
+    hand_off / take, instead of the later stage reading them back from disk.
+    """
+
+    def __init__(self, config, rerun_stages=(), rerun_all=False):
+        self.config = {**DEFAULT_CONFIG, **config}
+        self.dicom_base_dir = os.path.abspath(self.config["dicom_base_dir"])
+        self.work_dir = os.path.abspath(self.config["work_dir"])
+        self.rerun_stages = set(rerun_stages)
+        self.cache = empty_cache() if rerun_all else load_cache(self.work_dir)
+        self.index = None
+        self.all_cases = []
+        self.cases = []
+        self._handoff = {}
+        self._lock = threading.Lock()
+
+    def discover_cases(self, case_filter=None, save_index=True):
+        # Read the CT folders from the series index, kept in the work directory; called after harmonization,
+        # which may add SEG files
+        self.index = load_series_index(self.dicom_base_dir, index_dir=self.work_dir, save=save_index)
+        self.all_cases = [os.path.relpath(folder, self.index["root"]) for folder in find_ct_folders(self.index)]
+        self.cases = self.all_cases
+        if case_filter is not None:
+            case_filter = [os.path.normpath(case) for case in case_filter]
+            unknown = [case for case in case_filter if case not in self.all_cases]
+            if unknown:
+                print(f"CT folders not found in {self.dicom_base_dir}: {unknown}")
+            self.cases = [case for case in self.all_cases if case in case_filter]
+
+    def path(self, *parts):
+        return os.path.join(self.work_dir, *parts)
+
+    def relative(self, paths):
+        return sorted(os.path.relpath(path, self.work_dir) for path in paths)
+
+    def ct_folder(self, case):
+        return os.path.join(self.dicom_base_dir, case)
+
+    def seg_files(self, case):
+        return find_seg_files(self.index, self.ct_folder(case))
+
+    def hand_off(self, stage_name, case, value):
+        with self._lock:
+            self._handoff[(stage_name, case)] = value
+
+    def take(self, stage_name, case):
+        with self._lock:
+            return self._handoff.pop((stage_name, case), None)
+
+    def is_current(self, stage_name, case, stage_hash):
+        """Return True if the cached result of a stage was computed from the same inputs and its outputs still exist."""
+        if stage_name in self.rerun_stages:
+            return False
+        entry = self.cache["stages"].get(stage_name, {}).get(case or "*")
+        if not entry or entry["input_hash"] != stage_hash:
+            return False
+        return all(os.path.exists(self.path(f)) for f in entry["outputs"])
+
+    def record(self, stage_name, case, stage_hash, outputs):
+        with self._lock:
+            self.cache["stages"].setdefault(stage_name, {})[case or "*"] = {"input_hash": stage_hash, "outputs": outputs}
+            save_cache(self.work_dir, self.cache)
+
+    def forget(self, stage_name, cases):
+        # Drop the cache entries of a failed stage, whose outputs may be partly overwritten
+        with self._lock:
+            for case in cases:
+                self.cache["stages"].get(stage_name, {}).pop(case or "*", None)
+            save_cache(self.work_dir, self.cache)
+
+
+# -------------------------------------------------------------------------
+# Stages
+# -------------------------------------------------------------------------
+
+class Stage:
+    """
+    One step of the workflow.
+
+    A per-case stage runs once for every CT series, a global stage once per run. A batch stage is
+    cached per CT series like a per-case stage, but processes all changed series in one call (one
+    worker pool for the radiomics extraction).
+
+    inputs(pipeline, case) returns a JSON-serializable description of everything the result of a
+    case depends on (file sizes and modification times, settings); together with the hash of the
+    `code` files it decides whether the cached result can be reused. run(pipeline, case) does the
+    work and returns the written files relative to the work directory; for batch stages,
+    run(pipeline, cases) returns them as a dictionary per case.
+    """
+
+    def __init__(self, name, depends, inputs, run, per_case=False, batch=False, code=()):
+        self.name = name
+        self.depends = depends
+        self.inputs = inputs
+        self.run = run
+        self.per_case = per_case
+        self.batch = batch
+        self.code = code
+
+    def fingerprint(self, pipeline, case):
+        return input_hash({"inputs": self.inputs(pipeline, case), "code": [code_hash(path) for path in self.code]})
+
+
+def harmonization_inputs(pipeline, case):
+    return [
+        {
+            "command": entry["command"],
+            "inputs": {path: tree_state(path) if os.path.isdir(path) else file_state(path) for path in entry.get("inputs", [])},
+        }
+        for entry in pipeline.config["harmonization"]
+    ]
+
+
+def run_harmonization(pipeline, case):
+    # Model-specific conversion commands (e.g. the examples in "Segmentation results harmonization"), run in order
+    for entry in pipeline.config["harmonization"]:
+        print(f"[harmonize] {' '.join(entry['command'])}")
+        subprocess.run(entry["command"], check=True)
+    return []
+
+
+def dice_inputs(pipeline, case):
+    return {
+        "segmentations": {
+            ct_case: {os.path.basename(f): file_state(f) for f in pipeline.seg_files(ct_case)} for ct_case in pipeline.all_cases
+        },
+        "structure_overview_csv": file_state(pipeline.config["structure_overview_csv"]),
+        "arguments": pipeline.config["dice_arguments"],
+    }
+
+
+def run_dice(pipeline, case):
+    # Runs in its own process with its own worker pool; it skips unchanged CT series itself (dice_manifest.json)
+    output_folder = pipeline.path(CONSENSUS_DIR)
+    command = [
+        sys.executable, os.path.join(DICE_SCRIPTS, "analyze_disagreement_dice_score.py"),
+        pipeline.dicom_base_dir, output_folder, pipeline.config["structure_overview_csv"], *pipeline.config["dice_arguments"],
+        "--index-dir", pipeline.work_dir,
+    ]
+    subprocess.run(command, check=True)
+    pivot_csv = os.path.join(output_folder, "segmentation_dice_scores_pivot.csv")
+    return pipeline.relative([pivot_csv] if os.path.exists(pivot_csv) else [])
+
+
+def ct_slices_state(pipeline, case):
+    # File states of the CT slices of a series: the .dcm files that are not SEG files, as in mirror_and_convert_dicom
+    return tree_state(pipeline.ct_folder(case), include=lambda f: f.lower().endswith(".dcm") and not f.startswith("SEG_"))
+
+
+def nifti_inputs(pipeline, case):
+    return {
+        "ct_slices": ct_slices_state(pipeline, case),
+        "segmentations": {os.path.basename(f): file_state(f) for f in pipeline.seg_files(case)},
+        "tools": [pipeline.config["dcm2niix"], pipeline.config["segimage2itkimage"]],
+    }
+
+
+def run_nifti(pipeline, case):
+    # CT with dcm2niix and every model SEG with segimage2itkimage, into <work_dir>/nifti/<case>
+    from calculate_radiomics import mirror_and_convert_dicom
+
+    output_folder = pipeline.path(NIFTI_DIR, case)
+    # Remove the outputs of an earlier run (e.g. of a SEG file that was deleted since), but not those of run_consensus_nifti
+    consensus_folder = os.path.splitext(CONSENSUS_SEG_FILE)[0]
+    if os.path.isdir(output_folder):
+        for entry in os.scandir(output_folder):
+            if entry.name == consensus_folder:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+    mirror_and_convert_dicom(pipeline.ct_folder(case), output_folder, pipeline.config["dcm2niix"], pipeline.config["segimage2itkimage"])
+
+    outputs = glob.glob(os.path.join(glob.escape(output_folder), "CT*.nii*"))
+    if not outputs:
+        raise RuntimeError(f"no CT NIfTI written to {output_folder}")
+    for seg_file in pipeline.seg_files(case):
+        meta_json = os.path.join(output_folder, os.path.splitext(os.path.basename(seg_file))[0], "meta.json")
+        if not os.path.exists(meta_json):
+            raise RuntimeError(f"{seg_file} was not converted")
+        outputs.append(meta_json)
+    return pipeline.relative(outputs)
+
+
+def consensus_masks(pipeline, case):
+    # Consensus mask files of a CT series written by the Dice stage, in any --consensus-format
+    from convert_consensus_to_dicom import consensus_structure_name
+
+    folder = pipeline.path(CONSENSUS_DIR, case)
+    if not os.path.isdir(folder):
+        return []
+    return sorted(os.path.join(folder, f) for f in os.listdir(folder) if consensus_structure_name(f) is not None)
+
+
+def consensus_metadata_file(pipeline, case):
+    from convert_csv_to_json_for_consensus import algorithm
+
+    return pipeline.path(CONSENSUS_DIR, case, f"{algorithm}-dcmqi_seg_dict.json")
+
+
+def consensus_json_inputs(pipeline, case):
+    return {
+        "structures": [os.path.basename(f) for f in consensus_masks(pipeline, case)],
+        "structure_codes_csv": file_state(pipeline.config["structure_codes_csv"]),
+        "structure_overview_csv": file_state(pipeline.config["structure_overview_csv"]),
+    }
+
+
+def run_consensus_json(pipeline, case):
+    # filtered_structures.csv and the dcmqi segment metadata; the metadata is handed to the SEG stage in memory
+    from create_csv_file_for_consensus import filter_structures
+    from convert_csv_to_json_for_consensus import algorithm, consensus_seg_dict, write_seg_dict
+
+    folder = pipeline.path(CONSENSUS_DIR, case)
+    if not consensus_masks(pipeline, case):
+        return []
+    df_filtered = filter_structures(read_table(pipeline.config["structure_codes_csv"]), folder)
+    seg_dict = consensus_seg_dict(df_filtered, read_table(pipeline.config["structure_overview_csv"]))
+    json_file = write_seg_dict(seg_dict, folder, algorithm)
+    pipeline.hand_off("consensus_json", case, seg_dict)
+    return pipeline.relative([os.path.join(folder, "filtered_structures.csv"), json_file])
+
+
+def consensus_seg_inputs(pipeline, case):
+    return {
+        "masks": {os.path.basename(f): file_state(f) for f in consensus_masks(pipeline, case)},
+        "metadata": file_state(consensus_metadata_file(pipeline, case)),
+        # The SEG references the SOP instances and positions of the CT slices
+        "ct_slices": ct_slices_state(pipeline, case),
+        "itkimage2segimage": pipeline.config["itkimage2segimage"],
+    }
+
+
+def run_consensus_seg(pipeline, case):
+    from convert_consensus_to_dicom import convert_consensus_folder
+
+    json_data = pipeline.take("consensus_json", case)
+    if json_data is None:
+        metadata_file = consensus_metadata_file(pipeline, case)
+        if not os.path.exists(metadata_file):
+            return []
+        with open(metadata_file, "r") as f:
+            json_data = json.load(f)
+
+    output_dicom = pipeline.path(CONSENSUS_SEG_DIR, case, CONSENSUS_SEG_FILE)
+    if os.path.exists(output_dicom):
+        os.remove(output_dicom)
+    written = convert_consensus_folder(
+        pipeline.path(CONSENSUS_DIR, case), consensus_masks(pipeline, case), pipeline.ct_folder(case), output_dicom,
+        pipeline.config["itkimage2segimage"], json_data=json_data,
+    )
+    if not written:
+        raise RuntimeError("no consensus SEG written")
+    return pipeline.relative([output_dicom])
+
+
+def consensus_nifti_inputs(pipeline, case):
+    return {
+        "seg": file_state(pipeline.path(CONSENSUS_SEG_DIR, case, CONSENSUS_SEG_FILE)),
+        "segimage2itkimage": pipeline.config["segimage2itkimage"],
+    }
+
+
+def run_consensus_nifti(pipeline, case):
+    # The consensus SEG next to the model segmentations, as <work_dir>/nifti/<case>/SEG_Consensus
+    from calculate_radiomics import mirror_and_convert_dicom
+
+    output_folder = pipeline.path(NIFTI_DIR, case, os.path.splitext(CONSENSUS_SEG_FILE)[0])
+    if not os.path.exists(pipeline.path(CONSENSUS_SEG_DIR, case, CONSENSUS_SEG_FILE)):
+        # No consensus (any more): drop the conversion of an earlier run, so it is not extracted again
+        shutil.rmtree(output_folder, ignore_errors=True)
+        return []
+    mirror_and_convert_dicom(
+        pipeline.path(CONSENSUS_SEG_DIR, case), pipeline.path(NIFTI_DIR, case), pipeline.config["dcm2niix"], pipeline.config["segimage2itkimage"]
+    )
+    if not os.path.exists(os.path.join(output_folder, "meta.json")):
+        raise RuntimeError(f"{CONSENSUS_SEG_FILE} was not converted")
+    return pipeline.relative(os.path.join(output_folder, f) for f in tree_state(output_folder))
+
+
+def radiomics_inputs(pipeline, case):
+    inputs = {"nifti": tree_state(pipeline.path(NIFTI_DIR, case)), "mode": pipeline.config["radiomics_mode"]}
+    if pipeline.config["radiomics_mode"] == "radiomics":
+        # The features to extract (the bundled feature map); only its file state is hashed, the map is not read
+        from calculate_radiomics import FEATURE_MAP_FILE
+
+        inputs["feature_map"] = file_state(FEATURE_MAP_FILE)
+        if inputs["feature_map"] is None:
+            raise FileNotFoundError(f"the radiomics feature map {FEATURE_MAP_FILE} is missing (see refresh-feature-map)")
+    return inputs
+
+
+def run_radiomics(pipeline, cases):
+    # One process for all changed CT series, so their labels share one worker pool (calculate_radiomics.py --case)
+    nifti_folder = pipeline.path(NIFTI_DIR)
+    features_folder = pipeline.path(FEATURES_DIR)
+    command = [
+        sys.executable, os.path.join(VOLUME_SCRIPTS, "calculate_radiomics.py"), pipeline.config["radiomics_mode"],
+        nifti_folder, nifti_folder, features_folder,
+    ]
+    for case in cases:
+        command += ["--case", case]
+    subprocess.run(command, check=True)
+    return {
+        case: pipeline.relative(glob.glob(os.path.join(glob.escape(os.path.join(features_folder, case)), "**", "*_features.json"), recursive=True))
+        for case in cases
+    }
+
+
+def dice_store_inputs(pipeline, case):
+    return {"dice": tree_state(pipeline.path(CONSENSUS_DIR, "results", "dice"))}
+
+
+def run_dice_csv(pipeline, case):
+    from transform_dice_csv import transform_csv
+
+    store_folder = pipeline.path(CONSENSUS_DIR, "results", "dice")
+    if not os.path.isdir(store_folder):
+        return []
+    transform_csv(store_folder, pipeline.path(DICE_CSV))
+    return [DICE_CSV]
+
+
+def run_dice_statistics(pipeline, case):
+    from compute_dice_statistics import compute_statistics, load_results
+
+    store_folder = pipeline.path(CONSENSUS_DIR, "results", "dice")
+    if not os.path.isdir(store_folder):
+        return []
+    compute_statistics(load_results(store_folder)).to_csv(pipeline.path(DICE_STATISTICS_CSV), index=False)
+    print(f"Saved statistics CSV to: {pipeline.path(DICE_STATISTICS_CSV)}")
+    return [DICE_STATISTICS_CSV]
+
+
+def volume_csv_inputs(pipeline, case):
+    return {"features": tree_state(pipeline.path(FEATURES_DIR), include=lambda f: f.endswith("_features.json"))}
+
+
+def run_volume_csv(pipeline, case):
+    from get_volume_csv import collect_volumes
+
+    collect_volumes(pipeline.path(FEATURES_DIR)).to_csv(pipeline.path(VOLUME_CSV), index=False)
+    print(f"Volume CSV written to: {pipeline.path(VOLUME_CSV)}")
+    return [VOLUME_CSV]
+
+
+def run_dice_plot(pipeline, case):
+    output_html = pipeline.path(PLOTS_DIR, "dice_plot.html")
+    os.makedirs(pipeline.path(PLOTS_DIR), exist_ok=True)
+    subprocess.run([sys.executable, os.path.join(VISUALIZATION_SCRIPTS, "plot_interactive_dice.py"), pipeline.path(DICE_CSV), output_html], check=True)
+    return pipeline.relative([output_html])
+
+
+def run_volume_plot(pipeline, case):
+    output_folder = pipeline.path(PLOTS_DIR, "volume")
+    subprocess.run(
+        [sys.executable, os.path.join(VISUALIZATION_SCRIPTS, "plot_interactive_volume_plot.py"), pipeline.path(VOLUME_CSV), output_folder], check=True
+    )
+    return pipeline.relative(os.path.join(output_folder, f) for f in tree_state(output_folder))
+
+
+HARMONIZATION_STAGE = Stage("harmonize", [], harmonization_inputs, run_harmonization)
+
+# In dependency order. Harmonization runs before all of them, since it may add the SEG files the others read.
+STAGES = [
+    Stage(
+        "dice", [], dice_inputs, run_dice,
+        code=tuple(
+            sorted(f for f in glob.glob(os.path.join(glob.escape(DICE_SCRIPTS), "*.py")) if not os.path.basename(f).startswith("test_"))
+        ) + (os.path.join(REPO_FOLDER, "label_maps.py"), os.path.join(REPO_FOLDER, "series_index.py")),
+    ),
+    Stage("nifti", [], nifti_inputs, run_nifti, per_case=True),
+    Stage(
+        "consensus_json", ["dice"], consensus_json_inputs, run_consensus_json, per_case=True,
+        code=(os.path.join(CONVERT_SCRIPTS, "create_csv_file_for_consensus.py"), os.path.join(CONVERT_SCRIPTS, "convert_csv_to_json_for_consensus.py"), os.path.join(DICE_SCRIPTS, "consensus_io.py")),
+    ),
+    Stage(
+        "consensus_seg", ["consensus_json"], consensus_seg_inputs, run_consensus_seg, per_case=True,
+        code=(os.path.join(CONVERT_SCRIPTS, "convert_consensus_to_dicom.py"), os.path.join(CONVERT_SCRIPTS, "dicom_seg_writer.py"), os.path.join(DICE_SCRIPTS, "consensus_io.py")),
+    ),
+    Stage("consensus_nifti", ["consensus_seg"], consensus_nifti_inputs, run_consensus_nifti, per_case=True),
+    Stage(
+        "radiomics", ["nifti", "consensus_nifti"], radiomics_inputs, run_radiomics, per_case=True, batch=True,
+        code=(
+            os.path.join(VOLUME_SCRIPTS, "calculate_radiomics.py"), os.path.join(VOLUME_SCRIPTS, "first_order_features.py"),
+            os.path.join(REPO_FOLDER, "label_maps.py"),
+        ),
+    ),
+    Stage("dice_csv", ["dice"], dice_store_inputs, run_dice_csv, code=(os.path.join(VISUALIZATION_SCRIPTS, "transform_dice_csv.py"),)),
+    Stage("dice_statistics", ["dice"], dice_store_inputs, run_dice_statistics, code=(os.path.join(VISUALIZATION_SCRIPTS, "compute_dice_statistics.py"),)),
+    Stage("volume_csv", ["radiomics"], volume_csv_inputs, run_volume_csv, code=(os.path.join(VISUALIZATION_SCRIPTS, "get_volume_csv.py"),)),
+    Stage(
+        "dice_plot", ["dice_csv"], lambda pipeline, case: {"csv": file_state(pipeline.path(DICE_CSV))}, run_dice_plot,
+        code=(os.path.join(VISUALIZATION_SCRIPTS, "plot_interactive_dice.py"),),
+    ),
+    Stage(
+        "volume_plot", ["volume_csv"], lambda pipeline, case: {"csv": file_state(pipeline.path(VOLUME_CSV))}, run_volume_plot,
+        code=(os.path.join(VISUALIZATION_SCRIPTS, "plot_interactive_volume_plot.py"),),
+    ),
+]
+PLOT_STAGES = ("dice_plot", "volume_plot")
+STAGE_NAMES = [HARMONIZATION_STAGE.name] + [stage.name for stage in STAGES]
+
+
+# -------------------------------------------------------------------------
+# Scheduling
+# -------------------------------------------------------------------------
+
+def build_graph(stages, cases):
+    """
+    Expand the stages into nodes: one (stage, case) node per CT series for per-case stages and one
+    (stage, None) node for global and batch stages.
+
+    A per-case node depends on the node of the same case of a per-case stage before it, so each
+    case moves through the pipeline on its own; global and batch nodes wait for all cases.
+
+    Returns:
+        A dictionary of node -> list of the nodes it depends on, in dependency order.
+    """
+    by_name = {stage.name: stage for stage in stages}
+    graph = {}
+    for stage in stages:
+        depends = [name for name in stage.depends if name in by_name]
+        if stage.per_case and not stage.batch:
+            for case in cases:
+                graph[(stage.name, case)] = [
+                    (name, case if by_name[name].per_case and not by_name[name].batch else None) for name in depends
+                ]
+        else:
+            graph[(stage.name, None)] = [
+                (name, case)
+                for name in depends
+                for case in (cases if by_name[name].per_case and not by_name[name].batch else [None])
+            ]
+    return graph
+
+
+def run_graph(graph, run_node, jobs=1):
+    """
+    Run the nodes of `graph` with up to `jobs` threads, each node as soon as all nodes it depends on are finished.
+
+    run_node(node, dependency_status) returns the status of the node ("done", "cached",
+    "failed", ...); dependency_status maps the nodes it depends on to their status.
+
+    Returns:
+        A dictionary of node -> status.
+    """
+    dependents = {node: [] for node in graph}
+    waiting_for = {}
+    for node, depends in graph.items():
+        waiting_for[node] = len(depends)
+        for dependency in depends:
+            dependents[dependency].append(node)
+
+    status = {}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        running = {}
+
+        def submit(nodes):
+            for node in nodes:
+                running[executor.submit(run_node, node, {d: status[d] for d in graph[node]})] = node
+
+        submit([node for node, count in waiting_for.items() if count == 0])
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                status[node] = future.result()
+                ready = []
+                for dependent in dependents[node]:
+                    waiting_for[dependent] -= 1
+                    if waiting_for[dependent] == 0:
+                        ready.append(dependent)
+                submit(ready)
+    return status
+
+
+FAILED = ("failed", "skipped")
+OUT_OF_DATE = ("out of date", "pending")
+
+
+def make_node_runner(pipeline, stages, selected=None, dry_run=False):
+    """
+    Return the run_node function for run_graph.
+
+    A node is skipped if a node of the same case (or a global node) it depends on failed; global
+    and batch nodes still run for the cases that succeeded. Stages not in `selected` are neither
+    run nor checked. With `dry_run`, nodes are only compared with the cache: a node downstream of
+    an out-of-date node is reported as pending, since its inputs are only known once that has run.
+    """
+    by_name = {stage.name: stage for stage in stages}
+
+    def run_node(node, dependency_status):
+        stage_name, case = node
+        stage = by_name[stage_name]
+        label = stage_name if case is None else f"{stage_name} {case}"
+        if selected is not None and stage_name not in selected:
+            return "not selected"
+
+        # Per-case nodes need their own case; global and batch nodes only need the global nodes
+        blocking = [
+            value for (_, dependency_case), value in dependency_status.items()
+            if (stage.per_case and not stage.batch) or dependency_case is None
+        ]
+        if any(value in FAILED for value in blocking):
+            print(f"[{label}] skipped, an earlier stage failed")
+            return "skipped"
+        if dry_run and any(value in OUT_OF_DATE for value in dependency_status.values()):
+            return "pending"
+
+        try:
+            if stage.batch:
+                cases = [case for case in pipeline.cases if not any(dependency_status.get((name, case)) in FAILED for name in stage.depends)]
+                hashes = {case: stage.fingerprint(pipeline, case) for case in cases}
+                pending = [case for case in cases if not pipeline.is_current(stage_name, case, hashes[case])]
+                if not pending:
+                    print(f"[{label}] all {len(cases)} cases unchanged")
+                    return "cached"
+                if dry_run:
+                    print(f"[{label}] out of date for {len(pending)} of {len(cases)} cases")
+                    return "out of date"
+                print(f"[{label}] running {len(pending)} of {len(cases)} cases")
+            else:
+                stage_hash = stage.fingerprint(pipeline, case)
+                if pipeline.is_current(stage_name, case, stage_hash):
+                    return "cached"
+                if dry_run:
+                    print(f"[{label}] out of date")
+                    return "out of date"
+
+        except Exception as e:
+            print(f"[{label}] failed: {e}")
+            return "failed"
+
+        start = time.perf_counter()
+        try:
+            outputs = stage.run(pipeline, pending if stage.batch else case)
+        except Exception as e:
+            print(f"[{label}] failed: {e}")
+            pipeline.forget(stage_name, pending if stage.batch else [case])
+            return "failed"
+
+        if stage.batch:
+            for case in pending:
+                pipeline.record(stage_name, case, hashes[case], outputs[case])
+        else:
+            pipeline.record(stage_name, case, stage_hash, outputs)
+        print(f"[{label}] done in {time.perf_counter() - start:.1f} s")
+        return "done"
+
+    return run_node
+
+
+def print_summary(status):
+    counts = {}
+    for (stage_name, _), value in status.items():
+        counts.setdefault(stage_name, {}).setdefault(value, 0)
+        counts[stage_name][value] += 1
+    print("\nPipeline summary:")
+    for stage_name, values in sorted(counts.items(), key=lambda item: STAGE_NAMES.index(item[0])):
+        print(f"  {stage_name:<16} " + ", ".join(f"{count} {value}" for value, count in sorted(values.items())))
+
+
+def run_pipeline(config, jobs=1, rerun_stages=(), rerun_all=False, selected=None, case_filter=None, dry_run=False):
+    """
+    Run all stages of the workflow for the CT series below the DICOM base directory of `config`.
+
+    Every stage result is cached per CT series in `<work_dir>/pipeline_cache.json` together with
+    a hash of its inputs, so a rerun only processes the stages and cases whose inputs changed,
+    e.g. only the new CT series. Independent stages and cases run at the same time in up to
+    `jobs` threads. Returns True if no stage failed.
+    """
+    pipeline = Pipeline(config, rerun_stages=rerun_stages, rerun_all=rerun_all)
+    stages = [stage for stage in STAGES if pipeline.config["plots"] or stage.name not in PLOT_STAGES]
+
+    harmonization = run_graph(
+        {(HARMONIZATION_STAGE.name, None): []}, make_node_runner(pipeline, [HARMONIZATION_STAGE], selected, dry_run)
+    )
+    if harmonization[(HARMONIZATION_STAGE.name, None)] == "failed":
+        print("Harmonization failed, the other stages were not run.")
+        return False
+
+    pipeline.discover_cases(case_filter, save_index=not dry_run)
+    print(f"{len(pipeline.cases)} CT series in {pipeline.dicom_base_dir}")
+    status = run_graph(build_graph(stages, pipeline.cases), make_node_runner(pipeline, stages, selected, dry_run), jobs=jobs)
+    status.update(harmonization)
+    print_summary(status)
+    return not any(value == "failed" for value in status.values())
+
+
+def load_config(config_file):
+    with open(config_file, "r") as f:
+        config = json.load(f)
+    missing = [key for key in REQUIRED_CONFIG if key not in config]
+    if missing:
+        print(f"Missing settings in {config_file}: {missing}")
+        sys.exit(1)
+    if config.get("radiomics_mode", DEFAULT_CONFIG["radiomics_mode"]) not in ("radiomics", "volume"):
+        print("radiomics_mode must be 'radiomics' or 'volume'")
+        sys.exit(1)
+    return config
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Run the whole segmentation comparison workflow as one dependency graph of cached stages."
+    )
+    parser.add_argument("config", help="Pipeline configuration (JSON file, see README)")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of stages and CT series processed at the same time (default: number of CPUs)"
+    )
+    parser.add_argument(
+        "--case",
+        action="append",
+        default=None,
+        metavar="CT_FOLDER",
+        help="Only run the per-case stages for this CT folder, relative to the DICOM base directory (repeatable)"
+    )
+    parser.add_argument(
+        "--only",
+        action="append",
+        default=None,
+        choices=STAGE_NAMES,
+        metavar="STAGE",
+        help=f"Only run this stage (repeatable); the other stages are neither run nor checked. Stages: {', '.join(STAGE_NAMES)}"
+    )
+    parser.add_argument(
+        "--rerun",
+        action="append",
+        default=[],
+        choices=STAGE_NAMES,
+        metavar="STAGE",
+        help="Run this stage again for all cases, even if its inputs did not change (repeatable)"
+    )
+    parser.add_argument(
+        "--rerun-all",
+        action="store_true",
+        help="Ignore the stage cache and run every stage again"
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only report which stages and cases are out of date"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    succeeded = run_pipeline(
+        load_config(args.config),
+        jobs=args.jobs,
+        rerun_stages=args.rerun,
+        rerun_all=args.rerun_all,
+        selected=set(args.only) if args.only else None,
+        case_filter=args.case,
+        dry_run=args.dry_run,
+    )
+    if not succeeded:
+        sys.exit(1)
@@ -0,0 +1,161 @@
+# On-disk index of the CT_<SeriesInstanceUID> folders and SEG files below a DICOM base directory
+import json
+import os
+import sys
+
+
+INDEX_FILE = ".series_index.json"
+INDEX_VERSION = 1
+
+
+def _empty_index(base_dir):
+    return {"version": INDEX_VERSION, "root": os.path.abspath(base_dir), "directories": {}}
+
+
+def _scan_directory(path):
+    # One directory listing: visible subdirectories and SEG_*.dcm files
+    subdirs, seg_files = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                subdirs.append(entry.name)
+            elif entry.name.startswith("SEG") and entry.name.lower().endswith(".dcm"):
+                seg_files.append(entry.name)
+    return sorted(subdirs), sorted(seg_files)
+
+
+def refresh_series_index(index):
+    """
+    Bring an index up to date with the directory tree.
+
+    A directory is only listed again if its modification time changed since the last scan;
+    unchanged directories reuse their cached listing and only cost one stat call. CT_ folders
+    are treated as leaves. Directories that no longer exist are dropped.
+
+    Returns:
+        The number of directories that had to be listed.
+    """
+    root = index["root"]
+    cached = index["directories"]
+    directories = {}
+    num_listed = 0
+
+    stack = ["."]
+    while stack:
+        relative_path = stack.pop()
+        path = os.path.normpath(os.path.join(root, relative_path))
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+
+        entry = cached.get(relative_path)
+        if entry is None or entry["mtime_ns"] != mtime_ns:
+            subdirs, seg_files = _scan_directory(path)
+            entry = {"mtime_ns": mtime_ns, "subdirs": subdirs, "seg_files": seg_files}
+            num_listed += 1
+        directories[relative_path] = entry
+
+        if relative_path != "." and os.path.basename(relative_path).startswith("CT_"):
+            continue
+        # Reversed, so the stack visits the subdirectories in sorted order
+        for subdir in reversed(entry["subdirs"]):
+            stack.append(os.path.normpath(os.path.join(relative_path, subdir)))
+
+    index["directories"] = directories
+    return num_listed
+
+
+def _directories_changed(previous, current, ignore_root_mtime=False):
+    # Whether a refresh changed the stored index. The modification time of the root is ignored if the
+    # index file lives in the root, since saving the index changes it
+    if previous.keys() != current.keys():
+        return True
+    for relative_path, entry in current.items():
+        if relative_path == "." and ignore_root_mtime:
+            if (entry["subdirs"], entry["seg_files"]) != (previous["."]["subdirs"], previous["."]["seg_files"]):
+                return True
+        elif entry != previous[relative_path]:
+            return True
+    return False
+
+
+def load_series_index(base_dir, refresh=True, index_dir=None, save=True):
+    """
+    Load the index of `base_dir`, building it on first use.
+
+    The index is refreshed incrementally (see refresh_series_index) and saved to
+    `<index_dir>/.series_index.json`. By default `index_dir` is `base_dir`; pass an output or
+    work directory to leave the DICOM tree untouched. If the index cannot be written, or
+    `save` is False, it is only kept in memory.
+    """
+    index_dir = base_dir if index_dir is None else index_dir
+    index_path = os.path.join(index_dir, INDEX_FILE)
+    index = _empty_index(base_dir)
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, "r") as f:
+                stored = json.load(f)
+            if stored.get("version") == INDEX_VERSION and stored.get("root") == index["root"]:
+                index = stored
+        except (OSError, ValueError) as e:
+            print(f"Could not read series index {index_path}, rebuilding it: {e}")
+
+    if refresh:
+        previous = index["directories"]
+        refresh_series_index(index)
+        in_root = os.path.abspath(index_dir) == index["root"]
+        if save and _directories_changed(previous, index["directories"], ignore_root_mtime=in_root):
+            save_series_index(index, index_path)
+    return index
+
+
+def save_series_index(index, index_path):
+    # Written to a temporary file that replaces the index, so an interrupted run never leaves a truncated index
+    temp_path = os.path.join(os.path.dirname(index_path), f".{os.path.basename(index_path)}.tmp")
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+        with open(temp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(temp_path, index_path)
+    except OSError as e:
+        print(f"Could not save series index {index_path}, using it in memory only: {e}")
+
+
+def find_ct_folders(index):
+    # All CT_<SeriesInstanceUID> folders, in sorted directory order
+    return [
+        os.path.normpath(os.path.join(index["root"], relative_path))
+        for relative_path in sorted(index["directories"])
+        if os.path.basename(relative_path).startswith("CT_")
+    ]
+
+
+def ct_folders_by_uid(index):
+    # SeriesInstanceUID -> CT folder; if a series is stored twice, the first folder in sorted order is used
+    folders = {}
+    for ct_folder in find_ct_folders(index):
+        folders.setdefault(os.path.basename(ct_folder)[len("CT_"):], ct_folder)
+    return folders
+
+
+def find_seg_files(index, ct_folder):
+    # SEG_*.dcm files stored in a CT folder of the index
+    relative_path = os.path.normpath(os.path.relpath(os.path.abspath(ct_folder), index["root"]))
+    entry = index["directories"].get(relative_path)
+    if entry is None:
+        return []
+    return [os.path.join(ct_folder, f) for f in entry["seg_files"]]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python series_index.py <dicom_base_dir> [<index_dir>]")
+        sys.exit(1)
+
+    series_index = load_series_index(sys.argv[1], index_dir=sys.argv[2] if len(sys.argv) == 3 else None)
+    ct_folders = find_ct_folders(series_index)
+    num_seg_files = sum(len(find_seg_files(series_index, ct_folder)) for ct_folder in ct_folders)
+    print(f"Indexed {len(ct_folders)} CT series and {num_seg_files} SEG files in {sys.argv[1]}")